@@ -1,3 +1,5 @@
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from app.chat.session_manager import session_manager
 from app.chat.crypto_controller import CryptoController
 import binascii
 from app.chat.crypto.crypto_utils import (
@@ -7,6 +9,9 @@ from app.chat.crypto.crypto_utils import (
     create_public_key_from_b64,
     create_shared_key_X3DH_establisher,
 )
+from app.chat.crypto.crypto_executor import (
+    create_shared_key_X3DH_establisher_async,
+)
 from app.routes import ApiRoutes
 from app.config import (
     DEFAULT_DB_PATH,
@@ -15,11 +20,13 @@ from app.config import (
     PREFFERED_ENCODING,
     SERVER_URL,
 )
-from typing import Optional, Tuple, List
+from typing import Dict, Optional, Tuple, List
 from aiohttp.client import ClientSession
 from app.user.user_state import UserState
 import random
+from app.database.async_db import AsyncDatabase, database_thread
 from app.database.db_controller import DatabaseController
+from app.database.owner_dao import OwnerDAO
 import asyncio
 
 
@@ -37,6 +44,7 @@ class ApiController:
         init_session: bool = True,
         register_user: bool = False,
         db_path: str = DEFAULT_DB_PATH,
+        owner_dao: Optional[OwnerDAO] = None,
     ) -> None:
         self._client_session: Optional[ClientSession] = (
             ClientSession() if init_session else None
@@ -47,6 +55,11 @@ class ApiController:
         self._contact: Optional[str] = None
         self.register_user = register_user
         self.db_path = db_path
+        self._owner_dao = owner_dao
+        self._async_dao: Optional[AsyncDatabase] = None
+        # check if the contact exists and its approval go together,
+        # the invite and the first message can come at the same time
+        self._approval_locks: Dict[str, asyncio.Lock] = {}
 
     @property
     def contact(self) -> str:
@@ -65,6 +78,20 @@ class ApiController:
             raise ApiControllerException("client session not set!")
         return self._client_session
 
+    @property
+    def owner_dao(self) -> OwnerDAO:
+        # made on the first use, the user may be registered later
+        if self._owner_dao is None:
+            self._owner_dao = OwnerDAO(self.db_controller, self.user_state)
+        return self._owner_dao
+
+    @property
+    def async_dao(self) -> AsyncDatabase:
+        """owner_dao with the operations done on the database thread"""
+        if self._async_dao is None:
+            self._async_dao = AsyncDatabase(self.owner_dao)
+        return self._async_dao
+
     @property
     def url(self) -> str:
         return self._url
@@ -83,12 +110,8 @@ class ApiController:
     async def estabish_self_to_server(self):
         user_model = {
             "login": self.user_state.login,
-            "public_id_key": create_b64_from_public_key(
-                self.user_state.id_key.public_key()
-            ),
-            "public_signed_pre_key": create_b64_from_public_key(
-                self.user_state.signed_pre_key.public_key()
-            ),
+            "public_id_key": self.user_state.public_id_key_b64,
+            "public_signed_pre_key": self.user_state.public_signed_pre_key_b64,
             "signature": self.user_state.signature,
             "number_of_otk": MAX_ONE_TIME_KEYS,
             "one_time_keys": None,
@@ -120,7 +143,7 @@ class ApiController:
         await self.estabish_self_to_server()
 
         otk_keys = []
-        for priv_key in self.db_controller.get_user_otk(self.user_state):
+        for priv_key in self.owner_dao.get_otk():
             otk_keys.append(
                 create_b64_from_public_key(
                     create_private_key_from_b64(priv_key).public_key()
@@ -140,20 +163,54 @@ class ApiController:
         await self.establish_initial_otk(otk_initial)
 
     def approve_new_contact(self, invite: dict) -> str:
-        curr_otk, new_otk = self.db_controller.replace_one_time_key(
-            self.user_state, invite["otk_index"]
+        curr_otk, new_otk = self._take_one_time_key(invite)
+        shared_key = create_shared_key_X3DH_establisher(
+            *self._establisher_keys(invite, curr_otk)
+        )
+        return self._store_new_contact(invite, curr_otk, new_otk, shared_key)
+
+    async def approve_new_contact_async(self, invite: dict) -> str:
+        """
+        approve_new_contact with the X3DH done off the event loop and
+        the database work done on the database thread
+        """
+        curr_otk, new_otk = await database_thread.run(
+            self._take_one_time_key, invite
+        )
+        shared_key = await create_shared_key_X3DH_establisher_async(
+            *self._establisher_keys(invite, curr_otk)
+        )
+        return await database_thread.run(
+            self._store_new_contact, invite, curr_otk, new_otk, shared_key
         )
-        new_otk_b64 = create_b64_from_private_key(new_otk).decode(
-            PREFFERED_ENCODING
+
+    def _approval_lock(self, contact: str) -> asyncio.Lock:
+        if contact not in self._approval_locks:
+            self._approval_locks[contact] = asyncio.Lock()
+        return self._approval_locks[contact]
+
+    def _take_one_time_key(
+        self, invite: dict
+    ) -> Tuple[X25519PrivateKey, X25519PrivateKey]:
+        # the key of the approved contact must not be replaced again
+        if self.owner_dao.contact_exists(invite["my_login"]):
+            raise ApiControllerException(
+                f"{invite['my_login']} is already approved!"
+            )
+        return self.db_controller.replace_one_time_key(
+            self.user_state, invite["otk_index"]
         )
 
+    def _establisher_keys(
+        self, invite: dict, curr_otk: X25519PrivateKey
+    ) -> tuple:
         if (
             self.user_state.id_key is None
             or self.user_state.signed_pre_key is None
         ):
             raise ApiControllerException("All user keys must be present!")
 
-        shared_key = create_shared_key_X3DH_establisher(
+        return (
             self.user_state.id_key,
             self.user_state.signed_pre_key,
             curr_otk,
@@ -161,8 +218,14 @@ class ApiController:
             create_public_key_from_b64(invite["public_ephemeral_key"]),
         )
 
-        self.db_controller.add_contact(
-            self.user_state,
+    def _store_new_contact(
+        self,
+        invite: dict,
+        curr_otk: X25519PrivateKey,
+        new_otk: X25519PrivateKey,
+        shared_key: bytes,
+    ) -> str:
+        added = self.owner_dao.add_contact(
             invite["my_login"],
             invite["public_id_key"],
             binascii.b2a_base64(shared_key).decode(PREFFERED_ENCODING),
@@ -171,18 +234,20 @@ class ApiController:
                 PREFFERED_ENCODING
             ),
         )
+        if not added:
+            raise ApiControllerException(
+                f"{invite['my_login']} is already approved!"
+            )
         self.init_ratchet_configuration(invite["my_login"])
 
-        return new_otk_b64
+        return create_b64_from_private_key(new_otk).decode(PREFFERED_ENCODING)
 
     def init_ratchet_configuration(self, login: str):
-        crypto_controller = CryptoController(
+        session_manager.init_session(
             self.user_state,
             login,
             DB_PATH=self.db_path,
-        )
-        crypto_controller.init_ratchets(
-            opt_private_key=self.user_state.signed_pre_key
+            opt_private_key=self.user_state.signed_pre_key,
         )
 
     async def send_friend_request(self, invite: dict):
@@ -210,22 +275,85 @@ class ApiController:
                 print(await resp.text())
                 return
         for invite in inv_list:
-            new_otk = self.approve_new_contact(invite)
-            otk_model = {
-                "login": self.user_state.login,
-                "signature": self.user_state.signature.decode(
-                    PREFFERED_ENCODING
-                ),
-                "one_time_public_key": new_otk,
-                "otk_index": invite["otk_index"],
-            }
-            async with self.client_session.put(
-                self._url + ApiRoutes.ONE_TIME_KEY, json=otk_model
-            ) as resp:
-                if resp.status == 200:
-                    print(await resp.json())
-                else:
-                    print(f"Could not set otk key: {await resp.text()}")
+            # contact could already start the session with its first
+            # message, its one time key is used up then
+            async with self._approval_lock(invite["my_login"]):
+                if await self.async_dao.contact_exists(invite["my_login"]):
+                    continue
+                new_otk = await self.approve_new_contact_async(invite)
+            await self.publish_one_time_key(new_otk, invite["otk_index"])
+
+    async def publish_one_time_key(self, new_otk: str, index: int) -> None:
+        """Replace the used one time key on the server"""
+        otk_model = {
+            "login": self.user_state.login,
+            "signature": self.user_state.signature.decode(PREFFERED_ENCODING),
+            "one_time_public_key": new_otk,
+            "otk_index": index,
+        }
+        async with self.client_session.put(
+            self._url + ApiRoutes.ONE_TIME_KEY, json=otk_model
+        ) as resp:
+            if resp.status == 200:
+                print(await resp.json())
+            else:
+                print(f"Could not set otk key: {await resp.text()}")
+
+    async def accept_session_start(self, message: dict) -> str:
+        """
+        First message of the new contact (X3DH_SESSION_START). The
+        X3DH is done with the keys from its header and the message is
+        decrypted right away, there is no need to wait for the invite.
+        Returns the decrypted message
+        """
+        header = message["head"]
+        contact = header["sender"]
+        # the same fields as in the invite
+        invite = {"my_login": contact, **header["x3dh"]}
+        async with self._approval_lock(contact):
+            # invite could be approved first, the session is the same
+            if await self.async_dao.contact_exists(contact):
+                new_otk = None
+            else:
+                # anyone can send it, so it is decrypted before anything
+                # is stored. Forged message does not use up the one
+                # time key
+                await self.check_session_start(invite, message)
+                new_otk = await self.approve_new_contact_async(invite)
+        if new_otk is not None:
+            await self.publish_one_time_key(new_otk, invite["otk_index"])
+        return await self._decrypt_in_session(contact, message)
+
+    async def _decrypt_in_session(self, contact: str, message: dict) -> str:
+        # the session is not evicted till the message is decrypted
+        session = await session_manager.acquire_async(
+            self.user_state, contact, DB_PATH=self.db_path
+        )
+        try:
+            return await session.decrypt_json_message_async(message)
+        finally:
+            session_manager.release(self.user_state.login, contact)
+
+    async def check_session_start(self, invite: dict, message: dict) -> None:
+        """
+        Decrypt the first message with the session made from the
+        invite, nothing is saved. Raises CryptoControllerException
+        when the keys do not match
+        """
+        curr_otk = await database_thread.run(
+            self.db_controller.get_one_time_key,
+            self.user_state,
+            invite["otk_index"],
+        )
+        shared_key = await create_shared_key_X3DH_establisher_async(
+            *self._establisher_keys(invite, curr_otk)
+        )
+        # the same as init_ratchet_configuration, without the database
+        trial = CryptoController(self.user_state, invite["my_login"], False)
+        trial.initialize_symmertic_ratchets(
+            shared_key, opt_private_key=self.user_state.signed_pre_key
+        )
+        await trial.decrypt_json_message_async(message)
 
     async def check_contact(self, contact: str) -> bool:
         async with self.client_session.get(
@@ -242,10 +370,45 @@ class ApiController:
             self._url + ApiRoutes.CHAT_OPER, json=data
         ) as resp:
             for m in (await resp.json())["pending_messages"]:
-                # TODO : might be problematic.
-                # Dont know the sequence of messages
+                # the order does not matter, every message carries its
+                # number so the ratchets can handle any delivery order
                 await message_queue.put(m)
 
+    async def send_messages(self, messages: List[dict]) -> None:
+        """
+        Send many messages in one request, server delivers every
+        one of them to its "reciever" (see broadcast)
+        """
+        data = {
+            "login": self.user_state.login,
+            "signature": self.user_state.signature.decode(PREFFERED_ENCODING),
+            "messages": messages,
+        }
+        async with self.client_session.post(
+            self._url + ApiRoutes.CHAT_OPER, json=data
+        ) as resp:
+            if resp.status != 200:
+                print(f"Could not send messages: {await resp.text()}")
+
+    async def send_group_message(
+        self, members: List[str], message: dict
+    ) -> None:
+        """
+        Send the group message once, server delivers the same
+        message to every member (see group_session)
+        """
+        data = {
+            "login": self.user_state.login,
+            "signature": self.user_state.signature.decode(PREFFERED_ENCODING),
+            "members": members,
+            "message": message,
+        }
+        async with self.client_session.post(
+            self._url + ApiRoutes.GROUP_OPER, json=data
+        ) as resp:
+            if resp.status != 200:
+                print(f"Could not send group message: {await resp.text()}")
+
     async def get_contact_info(self, contact: str):
         async with self.client_session.get(
             self._url + ApiRoutes.USER_OPER, params={"login": contact}
@@ -6,3 +6,7 @@ class ResponseType(Enum):
     X3DH_SESSION_START = 2
     X3DH_SESSION_HANDSHAKE = 3
     AUTH = 4
+    FILE_TRANSFER = 5
+    BROADCAST_MESSAGE = 6
+    SENDER_KEY_DISTRIBUTION = 7
+    GROUP_MESSAGE = 8
@@ -1,5 +1,5 @@
 from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PublicKey
-from app.chat.crypto_controller import CryptoController
+from app.chat.session_manager import session_manager
 import binascii
 from typing import Optional
 
@@ -7,8 +7,11 @@ from app.chat.crypto.crypto_utils import (
     create_b64_from_private_key,
     create_b64_from_public_key,
     create_public_key_from_b64,
-    generate_DH,
-    create_shared_key_X3DH_guest,
+    preferred_cipher_suite,
+)
+from app.chat.crypto.crypto_executor import (
+    create_shared_key_X3DH_guest_async,
+    shutdown_crypto_executor,
 )
 from .api.api_controller import ApiController
 from .user.user_state import UserState
@@ -20,8 +23,13 @@ from .config import (
     SERVER_URL,
 )
 from .database.db_controller import DatabaseController
+from .database.async_db import database_thread, shutdown_database_thread
+from .database.connection_registry import connection_registry
+from .database.owner_dao import OwnerDAO
+from .chat.crypto.key_pool import key_pool, pooled_DH
 from .chat.chat_controller import ChatController
 import asyncio
+import functools
 import urllib.request
 from colorama import init, deinit
 import urllib.error
@@ -52,7 +60,7 @@ class AppController:
         Returns:
             str: chosen contact login
         """
-        contacts = self.db_controller.get_user_contacts(self.user_state)
+        contacts = self.owner_dao.get_contacts()
         contacts.append("Back")
         chosen = chat.choose_contact(contacts)
         if chosen == len(contacts) - 1:
@@ -67,13 +75,25 @@ class AppController:
         except urllib.error.URLError:
             print(f"Cannot connect to the server URL: {self._url}")
 
+        # runs the cipher suite benchmark (if enabled) before any chat starts
+        preferred_cipher_suite()
+        # key pairs are generated in the background from now on
+        key_pool.start()
         init(autoreset=True)
 
     def spin_async_event_loop(self):
         loop = asyncio.get_event_loop()
         serv_task = loop.create_task(self.api_controller.server_task())
+        write_behind = session_manager.write_behind
+        flush_task = (
+            loop.create_task(write_behind.run())
+            if write_behind is not None
+            else None
+        )
         loop.run_until_complete(self.main_menu())
         serv_task.cancel()
+        if flush_task is not None:
+            flush_task.cancel()
 
     def start(self, start_session: bool = True):
         utilities.startup()
@@ -84,8 +104,10 @@ class AppController:
 
         if not user_exist:
             self.db_controller.create_user(self.user_state)
-        else:
-            id_key, sg_key = self.db_controller.get_user_keys(self.user_state)
+        # the user is checked only here, for the whole session
+        self.owner_dao = OwnerDAO(self.db_controller, self.user_state)
+        if user_exist:
+            id_key, sg_key = self.owner_dao.get_keys()
             self.user_state.id_key = id_key
             self.user_state.signed_pre_key = sg_key
 
@@ -96,6 +118,7 @@ class AppController:
             self.db_controller,
             register_user=not user_exist,
             init_session=start_session,
+            owner_dao=self.owner_dao,
         )
 
         self.spin_async_event_loop()
@@ -116,7 +139,8 @@ class AppController:
                 del self.__chat_controller
             elif option == MainMenuOptions.ADD_FRIEND:
                 contact_name = await utilities.get_contact_name()
-                await self.add_contact(contact_name)
+                first_message = await utilities.get_first_message()
+                await self.add_contact(contact_name, first_message)
             elif option == MainMenuOptions.CHANGE_CREDENTIALS:
                 print("not implemented")
             elif option == MainMenuOptions.REMOVE_ACCOUNT:
@@ -130,6 +154,12 @@ class AppController:
                 raise RuntimeError("This option currently is not implemented")
         print("cleanup")
         await self.api_controller.client_session.close()
+        session_manager.clear()
+        shutdown_crypto_executor()
+        # waits for the sessions saved in the background
+        shutdown_database_thread()
+        # sessions are saved, no one needs the database anymore
+        connection_registry.close_all()
         deinit()
 
     async def init_waitroom(self):
@@ -138,12 +168,21 @@ class AppController:
     def init_ratchet_configuration(
         self, contact: str, contact_spk: X25519PublicKey
     ):
-        crypto_controller = CryptoController(
-            self.user_state, contact, DB_PATH=self._db_path
+        session_manager.init_session(
+            self.user_state,
+            contact,
+            DB_PATH=self._db_path,
+            opt_public_key=contact_spk,
         )
-        crypto_controller.init_ratchets(opt_public_key=contact_spk)
 
-    async def add_contact(self, contact: str) -> bool:
+    async def add_contact(
+        self, contact: str, first_message: Optional[str] = None
+    ) -> bool:
+        """
+        Send the invite to the contact. With first_message the message
+        goes right after the invite (X3DH_SESSION_START), contact does
+        not have to approve the invite before it can read it
+        """
         if not await self.api_controller.check_contact(contact):
             raise ContactNotFoundException()
 
@@ -163,7 +202,7 @@ class AppController:
             return False
 
         contact_info = contact_info["user_data"]
-        ephemeral_key = generate_DH()
+        ephemeral_key = pooled_DH()
 
         if contact_info["login"] != contact:
             AppControllerException(
@@ -172,25 +211,30 @@ class AppController:
                 f"rather than {contact}"
             )
 
+        # our part of the X3DH, the same for the invite and
+        # the first message
+        x3dh = {
+            "public_id_key": self.user_state.public_id_key_b64.decode(
+                PREFFERED_ENCODING
+            ),
+            "public_ephemeral_key": create_b64_from_public_key(
+                ephemeral_key.public_key()
+            ).decode(PREFFERED_ENCODING),
+            "otk_index": otk_idx,
+        }
         await self.api_controller.send_friend_request(
             {
                 "my_login": self.user_state.login,
                 "signature": self.user_state.signature,
                 "contact_login": contact,
-                "public_id_key": create_b64_from_public_key(
-                    self.user_state.id_key.public_key()
-                ).decode(PREFFERED_ENCODING),
-                "public_ephemeral_key": create_b64_from_public_key(
-                    ephemeral_key.public_key()
-                ).decode(PREFFERED_ENCODING),
-                "otk_index": otk_idx,
+                **x3dh,
             }
         )
 
         if self.user_state.id_key is None:
             raise AppControllerException("somehow my id key dissapeard")
 
-        shared_key = create_shared_key_X3DH_guest(
+        shared_key = await create_shared_key_X3DH_guest_async(
             self.user_state.id_key,
             ephemeral_key,
             create_public_key_from_b64(
@@ -206,23 +250,45 @@ class AppController:
             ),
         )
 
-        self.db_controller.add_contact(
-            self.user_state,
-            contact,
-            contact_info["public_id_key"],
-            binascii.b2a_base64(shared_key).decode(PREFFERED_ENCODING),
-            contact_signed_pre_key=contact_info["public_signed_pre_key"],
-            my_ephemeral_key=create_b64_from_private_key(ephemeral_key).decode(
-                PREFFERED_ENCODING
-            ),
-            contact_otk_key=one_time_key,
+        # contact and its ratchets in one trip to the database thread
+        await database_thread.run_many(
+            [
+                functools.partial(
+                    self.owner_dao.add_contact,
+                    contact,
+                    contact_info["public_id_key"],
+                    binascii.b2a_base64(shared_key).decode(PREFFERED_ENCODING),
+                    contact_signed_pre_key=contact_info[
+                        "public_signed_pre_key"
+                    ],
+                    my_ephemeral_key=create_b64_from_private_key(
+                        ephemeral_key
+                    ).decode(PREFFERED_ENCODING),
+                    contact_otk_key=one_time_key,
+                ),
+                functools.partial(
+                    self.init_ratchet_configuration,
+                    contact,
+                    create_public_key_from_b64(
+                        contact_info["public_signed_pre_key"]
+                    ),
+                ),
+            ]
         )
 
-        # initializing ratchets
-        self.init_ratchet_configuration(
-            contact,
-            create_public_key_from_b64(contact_info["public_signed_pre_key"]),
-        )
+        if first_message:
+            session = await session_manager.acquire_async(
+                self.user_state, contact, DB_PATH=self._db_path
+            )
+            try:
+                async with session.session_lock:
+                    message = session.encrypt_session_start(
+                        first_message, x3dh
+                    )
+                await session.settle_state()
+            finally:
+                session_manager.release(self.user_state.login, contact)
+            await self.api_controller.send_messages([message])
 
         print(f"You had send {contact} an invite")
         return True
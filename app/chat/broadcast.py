@@ -0,0 +1,165 @@
+from .crypto_controller import CryptoController
+from .session_manager import session_manager
+from .crypto.crypto_utils import aead_encrypt, preferred_cipher_suite
+from .crypto.crypto_executor import run_in_crypto_executor
+from .crypto.compression import MessageCompressor, default_compressor
+from app.api.api_controller import ApiController
+from app.database.db_controller import DatabaseController
+from app.config import (
+    COMPRESSION_ENABLED,
+    PREFFERED_ENCODING,
+    SHARED_KEY_LENGTH,
+)
+from typing import Iterable, List, Optional, Sequence, Tuple
+import binascii
+import hashlib
+import os
+
+
+def encrypt_broadcast_payload(
+    plaintext: str, /, compressor: Optional[MessageCompressor] = None
+) -> Tuple[bytes, dict, bytes]:
+    """
+    Encrypt the payload once with the fresh random key.
+    Returns key material for the recievers (payload key and
+    payload hash), the header fields and the encoded payload
+    """
+    compressor = (
+        compressor if compressor is not None else default_compressor()
+    )
+    payload = plaintext.encode(PREFFERED_ENCODING)
+    compressed = compressor.compress(payload) if COMPRESSION_ENABLED else None
+    suite = preferred_cipher_suite()
+
+    content_key = os.urandom(SHARED_KEY_LENGTH)
+    encrypted = aead_encrypt(
+        content_key,
+        compressed if compressed is not None else payload,
+        suite=suite,
+    )
+    return (
+        content_key + hashlib.sha256(encrypted).digest(),
+        {"payload_suite": suite.value, "compressed": compressed is not None},
+        binascii.b2a_base64(encrypted),
+    )
+
+
+def wrap_broadcast(
+    sessions: Sequence[CryptoController],
+    key_material: bytes,
+    head: dict,
+    payload: bytes,
+) -> List[dict]:
+    messages = []
+    for session in sessions:
+        message = session.wrap_broadcast_key(key_material, persist=False)
+        message["head"].update(head)
+        # the same encoded payload object in every message
+        message["body"]["payload"] = payload
+        messages.append(message)
+    return messages
+
+
+def save_broadcast_sessions(
+    sessions: Sequence[CryptoController],
+    db_controller: Optional[DatabaseController],
+) -> None:
+    """
+    Sessions with the write behind store are saved by it, writing
+    their exact ratchets here would put the database behind the keys
+    the store has reserved
+    """
+    if db_controller is None:
+        for session in sessions:
+            session.save_state()
+        return
+
+    direct = []
+    for session in sessions:
+        if session.write_behind is not None:
+            session.save_state()
+        else:
+            direct.append(session)
+    if not direct:
+        return
+    db_controller.save_ratchets_many(
+        (
+            session.user_state,
+            session.contact,
+            session.get_ratchet_set(),
+            session.my_turn,
+        )
+        for session in direct
+    )
+
+
+def encrypt_broadcast(
+    sessions: Sequence[CryptoController],
+    plaintext: str,
+    /,
+    db_controller: Optional[DatabaseController] = None,
+    compressor: Optional[MessageCompressor] = None,
+) -> List[dict]:
+    """
+    The same message for many contacts. Payload is encrypted once,
+    for every contact only the payload key (and the payload hash)
+    goes through its ratchets. With db_controller all the ratchets
+    are saved in a single transaction
+    """
+    key_material, head, payload = encrypt_broadcast_payload(
+        plaintext, compressor=compressor
+    )
+    messages = wrap_broadcast(sessions, key_material, head, payload)
+    save_broadcast_sessions(sessions, db_controller)
+    return messages
+
+
+async def encrypt_broadcast_async(
+    sessions: Sequence[CryptoController],
+    plaintext: str,
+    /,
+    db_controller: Optional[DatabaseController] = None,
+    compressor: Optional[MessageCompressor] = None,
+) -> List[dict]:
+    """
+    encrypt_broadcast with the payload encrypted off the event
+    loop. Wrapping the key is too small to go to the thread pool,
+    it is done here under the lock of every session
+    """
+    key_material, head, payload = await run_in_crypto_executor(
+        encrypt_broadcast_payload, plaintext, compressor=compressor
+    )
+    messages = []
+    for session in sessions:
+        async with session.session_lock:
+            messages += wrap_broadcast(
+                [session], key_material, head, payload
+            )
+    save_broadcast_sessions(sessions, db_controller)
+    for session in sessions:
+        await session.settle_state()
+    return messages
+
+
+async def send_broadcast(
+    api_controller: ApiController, contacts: Iterable[str], plaintext: str
+) -> None:
+    """Send the message to all the contacts in a single request"""
+    contacts = list(contacts)
+    # the first ones are not evicted while the rest is loaded
+    sessions = [
+        session_manager.acquire(
+            api_controller.user_state,
+            contact,
+            DB_PATH=api_controller.db_path,
+        )
+        for contact in contacts
+    ]
+    try:
+        messages = await encrypt_broadcast_async(
+            sessions, plaintext, db_controller=api_controller.db_controller
+        )
+    finally:
+        for contact in contacts:
+            session_manager.release(api_controller.user_state.login, contact)
+    await api_controller.send_messages(messages)
@@ -1,10 +1,24 @@
 from app.api.api_controller import ApiController
-from .crypto_controller import CryptoController, CryptoControllerException
+from .crypto_controller import CryptoControllerException
+from .session_manager import session_manager
+from .group_session import GroupSession, GroupSessionException
 from app.cli.message import Message
 from app.cli.chat import display_message
 from app.cli.utilities import get_timestamp
+from app.api.response_type import ResponseType
+from app.config import HISTORY_PAGE_SIZE
+from app.chat.crypto.crypto_executor import run_in_crypto_executor
+from app.chat.crypto.file_stream import StreamDecryptor
+from app.database.async_db import database_thread
+from app.database.blob_store import BlobStore, BlobWriter
+from app.database.db_controller import HistoryCursor, HistoryMessage
+from typing import Dict, List, Optional, Tuple
 import asyncio
 import aioconsole
+import contextlib
+import functools
+import os
+import time
 
 
 class ChatController:
@@ -16,7 +30,24 @@ class ChatController:
         self.partner = partner
         self.user_state = api_controller.user_state
         self.api_controller = api_controller
-        self.crypto_controller = CryptoController(self.user_state, partner)
+        # the same session is used by every chat with the partner, it
+        # is kept in the session manager till the chat is closed
+        self.crypto_controller = session_manager.acquire(
+            self.user_state, partner, DB_PATH=api_controller.db_path
+        )
+        self.blob_store = BlobStore(api_controller.db_controller)
+        # files being recieved: transfer id -> (decryptor, blob, name)
+        self.incoming_files: Dict[
+            str, Tuple[StreamDecryptor, BlobWriter, str]
+        ] = {}
+        # the page of the history shown first, older ones on :more
+        self.history_cursor: Optional[HistoryCursor] = None
+        self.history_page_size = HISTORY_PAGE_SIZE
+        # messages not saved in the history yet, with their contact
+        self.history_buffer: List[Tuple[str, HistoryMessage]] = []
+        self.history_task: Optional[asyncio.Task] = None
+        # groups we got messages of, so they are not loaded every time
+        self.groups: Dict[str, GroupSession] = {}
 
     async def start(self):
         await self.run_workers()
@@ -44,6 +75,7 @@ class ChatController:
         # here, rather than in constructor
 
         await self.init_ws_connection()
+        await self.show_history()
 
         ws_task = asyncio.create_task(self.websocket_worker())
         ui_task = asyncio.create_task(self.user_input_worker())
@@ -51,6 +83,12 @@ class ChatController:
         # whole chat is alive till the user chooses to end it
         await ui_task
         ws_task.cancel()
+        self.drop_incoming_files()
+        if self.history_task is not None:
+            await self.history_task
+        # ratchets of the closed chat are not left for the next batch
+        session_manager.flush(self.user_state.login)
+        session_manager.release(self.user_state.login, self.partner)
         await self.websocket_con.close()
         self.messageQueue.task_done()
 
@@ -60,16 +98,128 @@ class ChatController:
         while True:
             output = await self.websocket_con.receive_json()
 
-            # the decryption is done at that exact moment
+            # the decryption is done at that exact moment, on the crypto
+            # thread pool so the user input is not blocked meanwhile
             try:
-                translated: str = self.crypto_controller.decrypt_json_message(
-                    output
-                )
-                message = Message(self.partner, get_timestamp(), translated)
-            except CryptoControllerException as e:
+                translated = await self.decrypt_message(output)
+                sender, contact = self.message_origin(output)
+                message = Message(sender, get_timestamp(), translated)
+                self.remember(sender, translated, contact=contact)
+            except (CryptoControllerException, GroupSessionException) as e:
                 message = Message(self.partner, get_timestamp(), str(e))
 
-            await self.messageQueue.put(message)
+            if message.body:
+                await self.messageQueue.put(message)
+            # waiting for the next message is our idle time
+            await self.crypto_controller.refill_key_windows_async()
+
+    async def decrypt_message(self, message: dict) -> str:
+        message_type = message["head"]["message_type"]
+        if message_type == ResponseType.FILE_TRANSFER:
+            return await self.recieve_file_message(message)
+        if message_type == ResponseType.SENDER_KEY_DISTRIBUTION:
+            async with self.crypto_controller.session_lock:
+                group = await database_thread.run(
+                    GroupSession.accept_distribution,
+                    self.crypto_controller,
+                    message,
+                    self.api_controller.db_controller,
+                )
+            self.groups[group.group_id] = group
+            return f"<sender key of the group {group.name}>"
+        if message_type == ResponseType.X3DH_SESSION_START:
+            return await self.api_controller.accept_session_start(message)
+        if message_type == ResponseType.GROUP_MESSAGE:
+            # sender keys are saved (and loaded the first time) off
+            # the loop
+            return await database_thread.run(
+                self.decrypt_group_message, message
+            )
+        return await self.crypto_controller.decrypt_json_message_async(
+            message
+        )
+
+    def message_origin(self, message: dict) -> Tuple[str, str]:
+        """
+        Who sent the message and which history it goes to. The first
+        message of the new contact comes through any open chat, it
+        is shown and saved as the message of that contact. Group
+        messages stay in the history of this chat
+        """
+        header = message["head"]
+        sender = header.get("sender", self.partner)
+        if header["message_type"] == ResponseType.X3DH_SESSION_START:
+            return sender, sender
+        return sender, self.partner
+
+    async def show_history(self, older: bool = False) -> None:
+        """
+        Show the newest page of the history, or with older the page
+        before the ones shown already. Only one page is read, long
+        history costs nothing more
+        """
+        if older and self.history_cursor is None:
+            print("No older messages")
+            return
+        page, self.history_cursor = await database_thread.run(
+            self.api_controller.db_controller.load_messages,
+            self.user_state,
+            self.partner,
+            before=self.history_cursor if older else None,
+            limit=self.history_page_size,
+        )
+        if older:
+            print("--- older messages ---")
+        for sender, timestamp, body in page:
+            display_message(Message(sender, get_timestamp(timestamp), body))
+
+    def remember(
+        self, sender: str, body: str, /, contact: Optional[str] = None
+    ) -> None:
+        """
+        Add the message to the history (of this chat by default),
+        in the background
+        """
+        if not body:
+            return
+        self.history_buffer.append(
+            (
+                contact if contact is not None else self.partner,
+                (sender, time.time(), body),
+            )
+        )
+        if self.history_task is None or self.history_task.done():
+            self.history_task = asyncio.create_task(self.save_history())
+
+    async def save_history(self) -> None:
+        """
+        Messages which came while the previous batch was written are
+        appended together, in one trip to the database thread
+        """
+        while self.history_buffer:
+            batch, self.history_buffer = self.history_buffer, []
+            by_contact: Dict[str, List[HistoryMessage]] = {}
+            for contact, message in batch:
+                by_contact.setdefault(contact, []).append(message)
+            await database_thread.run_many(
+                functools.partial(
+                    self.api_controller.db_controller.append_messages,
+                    self.user_state,
+                    contact,
+                    messages,
+                )
+                for contact, messages in by_contact.items()
+            )
+
+    def decrypt_group_message(self, message: dict) -> str:
+        group_id = message["head"]["group_id"]
+        group = self.groups.get(group_id)
+        if group is None:
+            group = GroupSession.load(
+                self.user_state, group_id, self.api_controller.db_controller
+            )
+            self.groups[group_id] = group
+        return group.decrypt_group_message(message)
 
     async def user_input_worker(self):
         """This worker decides about the life of the event loop"""
@@ -93,13 +243,22 @@ class ChatController:
             if in_message == ":q":
                 end = True
 
-            if in_message:
+            if in_message.startswith(":file "):
+                await self.send_file(in_message[len(":file "):].strip())
+            elif in_message == ":more":
+                await self.show_history(older=True)
+            elif in_message:
                 # sending raw message to the ws controller to be send by
                 # the websocket to the end reciever
                 # await self._websocket_controller.send_message(in_message)
-                await self.websocket_con.send_json(
-                    self.crypto_controller.encrypt_to_json_message(in_message)
+                message = (
+                    await self.crypto_controller.encrypt_to_json_message_async(
+                        in_message
+                    )
                 )
+                await self.websocket_con.send_json(message)
+                self.remember(self.user_state.login, in_message)
+                await self.crypto_controller.refill_key_windows_async()
 
                 # we put user message on the screen
                 # we can only access the screen by the message queue
@@ -113,3 +272,110 @@ class ChatController:
                         # what is actually send to second user
                     )
                 )
+
+    async def send_file(self, path: str) -> None:
+        """
+        Send the file chunk by chunk, it is never whole in memory.
+        Recieved file (the path shown for it is in the blob store) is
+        read through the memory map of its blob, under its own name
+        """
+        digest = self.blob_store.digest_of(path)
+        name = os.path.basename(path)
+        if digest is not None:
+            name = (
+                await database_thread.run(
+                    self.api_controller.db_controller.get_file_name,
+                    self.user_state,
+                    digest,
+                )
+                or name
+            )
+        with contextlib.ExitStack() as stack:
+            try:
+                source = stack.enter_context(
+                    self.blob_store.open(digest)
+                    if digest is not None
+                    else open(path, "rb")
+                )
+            except OSError as e:
+                print(f"Cannot send {path}: {e.strerror}")
+                return
+            messages = self.crypto_controller.encrypt_file_to_json_messages(
+                source, name
+            )
+            # the offer turns the ratchets, the chunks do not
+            async with self.crypto_controller.session_lock:
+                offer = await run_in_crypto_executor(next, messages)
+            await self.crypto_controller.settle_state()
+            await self.websocket_con.send_json(offer)
+
+            while True:
+                message = await run_in_crypto_executor(next, messages, None)
+                if message is None:
+                    break
+                await self.websocket_con.send_json(message)
+
+        self.remember(self.user_state.login, f"<file {path}>")
+        await self.messageQueue.put(
+            Message(self.user_state.login, get_timestamp(), f"<file {path}>")
+        )
+
+    def drop_incoming_files(self) -> None:
+        """Files which did not come whole are not kept"""
+        for _, blob, _ in self.incoming_files.values():
+            blob.abort()
+        self.incoming_files.clear()
+
+    async def recieve_file_message(self, message: dict) -> str:
+        """
+        Write the chunk of the file to the blob store. Returns text
+        to show to the user, empty for the chunks in the middle
+        of the file
+        """
+        header = message["head"]
+        if "chunk" not in header:
+            (
+                metadata,
+                decryptor,
+            ) = await self.crypto_controller.open_file_transfer_async(message)
+            # name is only shown, contact must not choose any path
+            name = os.path.basename(metadata["name"])
+            self.incoming_files[header["transfer_id"]] = (
+                decryptor,
+                await database_thread.run(self.blob_store.writer),
+                name,
+            )
+            return f"<recieving file {name}>"
+
+        transfer: Optional[
+            Tuple[StreamDecryptor, BlobWriter, str]
+        ] = self.incoming_files.get(header["transfer_id"])
+        if transfer is None:
+            raise CryptoControllerException("Chunk of unknown file!")
+
+        decryptor, blob, name = transfer
+        try:
+            # chunks of one file come one after another, the worker
+            # writes the chunk right after decrypting it
+            await run_in_crypto_executor(
+                self.write_file_chunk, message, decryptor, blob
+            )
+        except CryptoControllerException:
+            del self.incoming_files[header["transfer_id"]]
+            blob.abort()
+            raise
+
+        if not header["last"]:
+            return ""
+        del self.incoming_files[header["transfer_id"]]
+        digest = await database_thread.run(
+            blob.commit, self.user_state, self.partner, name
+        )
+        return f"<file {name}: {self.blob_store.path(digest)}>"
+
+    def write_file_chunk(
+        self, message: dict, decryptor: StreamDecryptor, blob: BlobWriter
+    ) -> None:
+        blob.write(
+            self.crypto_controller.decrypt_file_chunk(message, decryptor)
+        )
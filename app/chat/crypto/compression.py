@@ -0,0 +1,152 @@
+from app.config import (
+    COMPRESSION_DICTIONARY_PATH,
+    COMPRESSION_DICTIONARY_SIZE,
+    COMPRESSION_LEVEL,
+    COMPRESSION_MIN_SIZE,
+    MAX_DECOMPRESSED_SIZE,
+)
+from collections import Counter
+from typing import Iterable, Optional, Union
+import re
+import sys
+import zlib
+
+# words with the whitespace after them
+_TOKEN = re.compile(rb"\S+\s*")
+# longest phrases (in words) the dictionary is built from
+_MAX_PHRASE = 3
+
+
+class CompressionException(Exception):
+    ...
+
+
+def train_dictionary(
+    samples: Iterable[Union[str, bytes]],
+    size: int = COMPRESSION_DICTIONARY_SIZE,
+) -> bytes:
+    """
+    Build preset dictionary for zlib from the sample messages.
+    Words and short phrases which repeat across the samples are
+    scored by the bytes they would save (count * length). The best
+    ones go to the END of the dictionary, zlib finds the matches
+    closer to the compressed data cheaper
+    """
+    counts: Counter = Counter()
+    for sample in samples:
+        data = sample.encode("utf-8") if isinstance(sample, str) else sample
+        tokens = _TOKEN.findall(data)
+        for length in range(1, _MAX_PHRASE + 1):
+            for i in range(len(tokens) - length + 1):
+                counts[b"".join(tokens[i:i + length])] += 1
+
+    # what was seen only once is not going to help other messages
+    ranked = sorted(
+        (phrase for phrase, count in counts.items() if count > 1),
+        key=lambda phrase: counts[phrase] * len(phrase),
+        reverse=True,
+    )
+
+    chosen = []
+    used = 0
+    for phrase in ranked:
+        if used + len(phrase) > size:
+            continue
+        chosen.append(phrase)
+        used += len(phrase)
+    return b"".join(reversed(chosen))
+
+
+class MessageCompressor:
+    """
+    zlib compression of the message before it is encrypted.
+    Messages shorter than min_size and those which did not get
+    smaller are send as they are.
+
+    Both sides must use the same dictionary, the dictionary id
+    is checked by zlib when decompressing
+    """
+
+    __slots__ = ("dictionary", "min_size", "level")
+
+    def __init__(
+        self,
+        dictionary: bytes = b"",
+        min_size: int = COMPRESSION_MIN_SIZE,
+        level: int = COMPRESSION_LEVEL,
+    ) -> None:
+        self.dictionary = dictionary
+        self.min_size = min_size
+        self.level = level
+
+    def compress(self, data: bytes) -> Optional[bytes]:
+        """Compressed data or None when it is not worth it"""
+        if len(data) < self.min_size:
+            return None
+
+        if self.dictionary:
+            compressor = zlib.compressobj(self.level, zdict=self.dictionary)
+        else:
+            compressor = zlib.compressobj(self.level)
+        compressed = compressor.compress(data) + compressor.flush()
+        return compressed if len(compressed) < len(data) else None
+
+    def decompress(
+        self, data: bytes, max_size: int = MAX_DECOMPRESSED_SIZE
+    ) -> bytes:
+        if self.dictionary:
+            decompressor = zlib.decompressobj(zdict=self.dictionary)
+        else:
+            decompressor = zlib.decompressobj()
+
+        try:
+            # limit protects us from the messages which inflate to gigabytes
+            output = decompressor.decompress(data, max_size)
+        except zlib.error as e:
+            raise CompressionException(f"Cannot decompress message: {e}")
+
+        if decompressor.unconsumed_tail:
+            raise CompressionException(
+                f"Decompressed message is bigger than {max_size} bytes"
+            )
+        if not decompressor.eof:
+            raise CompressionException("Compressed message is truncated")
+        return output
+
+
+_compressor: Optional[MessageCompressor] = None
+
+
+def default_compressor() -> MessageCompressor:
+    """
+    Compressor with the dictionary from COMPRESSION_DICTIONARY_PATH,
+    loaded once for the whole process
+    """
+    global _compressor
+    if _compressor is None:
+        dictionary = b""
+        if COMPRESSION_DICTIONARY_PATH is not None:
+            with open(COMPRESSION_DICTIONARY_PATH, "rb") as dictionary_file:
+                dictionary = dictionary_file.read()
+        _compressor = MessageCompressor(dictionary)
+    return _compressor
+
+
+def main(samples_path: str, dictionary_path: str) -> None:
+    """Dictionary for COMPRESSION_DICTIONARY_PATH from the samples file"""
+    with open(samples_path, "rb") as samples:
+        dictionary = train_dictionary(
+            line for line in samples if line.strip()
+        )
+    with open(dictionary_path, "wb") as dictionary_file:
+        dictionary_file.write(dictionary)
+    print(f"{len(dictionary)} bytes of dictionary in {dictionary_path}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit(
+            "usage: python -m app.chat.crypto.compression"
+            " SAMPLES DICTIONARY"
+        )
+    main(sys.argv[1], sys.argv[2])
@@ -0,0 +1,141 @@
+from cryptography.hazmat.primitives.asymmetric.x25519 import (
+    X25519PrivateKey,
+    X25519PublicKey,
+)
+from concurrent.futures import ThreadPoolExecutor
+from .crypto_utils import (
+    aead_decrypt,
+    aead_encrypt,
+    create_shared_key_X3DH_establisher,
+    create_shared_key_X3DH_guest,
+)
+from app.config import (
+    AEAD_OFFLOAD_THRESHOLD,
+    CRYPTO_EXECUTOR_WORKERS,
+    CipherSuite,
+    DEFAULT_CIPHER_SUITE,
+)
+from typing import Any, Callable, Optional, TypeVar
+import asyncio
+import functools
+import threading
+
+ResultType = TypeVar("ResultType")
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_crypto_executor() -> ThreadPoolExecutor:
+    """
+    Thread pool for the cpu heavy crypto. The OpenSSL calls release
+    the GIL, so while they run the event loop can still read the
+    websocket and the user input
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=CRYPTO_EXECUTOR_WORKERS,
+                thread_name_prefix="crypto",
+            )
+        return _executor
+
+
+def shutdown_crypto_executor(wait: bool = True) -> None:
+    """The next get_crypto_executor call creates a fresh pool"""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
+
+
+async def run_in_crypto_executor(
+    func: Callable[..., ResultType], /, *args: Any, **kwargs: Any
+) -> ResultType:
+    """
+    Await func(*args, **kwargs) computed on the crypto thread pool.
+    Nothing here keeps the calls in order, objects shared between
+    calls (like the ratchets of a chat) must be guarded by the caller
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_crypto_executor(), functools.partial(func, *args, **kwargs)
+    )
+
+
+async def create_shared_key_X3DH_guest_async(
+    my_private_id_key: X25519PrivateKey,
+    my_private_ephemeral_key: X25519PrivateKey,
+    estab_public_id_key: X25519PublicKey,
+    estab_public_signed_pre_key: X25519PublicKey,
+    estab_public_one_time_key: X25519PublicKey,
+) -> bytes:
+    """create_shared_key_X3DH_guest off the event loop"""
+    return await run_in_crypto_executor(
+        create_shared_key_X3DH_guest,
+        my_private_id_key,
+        my_private_ephemeral_key,
+        estab_public_id_key,
+        estab_public_signed_pre_key,
+        estab_public_one_time_key,
+    )
+
+
+async def create_shared_key_X3DH_establisher_async(
+    my_private_id_key: X25519PrivateKey,
+    my_private_signed_pre_key: X25519PrivateKey,
+    my_private_one_time_key: X25519PrivateKey,
+    guest_public_id_key: X25519PublicKey,
+    guest_public_ephemeral_key: X25519PublicKey,
+) -> bytes:
+    """create_shared_key_X3DH_establisher off the event loop"""
+    return await run_in_crypto_executor(
+        create_shared_key_X3DH_establisher,
+        my_private_id_key,
+        my_private_signed_pre_key,
+        my_private_one_time_key,
+        guest_public_id_key,
+        guest_public_ephemeral_key,
+    )
+
+
+async def aead_encrypt_async(
+    key: bytes,
+    message: bytes,
+    additional_data: bytes = b"",
+    /,
+    pad: bool = False,
+    suite: CipherSuite = DEFAULT_CIPHER_SUITE,
+) -> bytes:
+    """
+    aead_encrypt which goes to the thread pool only for the big
+    payloads, for the small ones the thread hop costs more than
+    the encryption itself
+    """
+    if len(message) < AEAD_OFFLOAD_THRESHOLD:
+        return aead_encrypt(
+            key, message, additional_data, pad=pad, suite=suite
+        )
+    return await run_in_crypto_executor(
+        aead_encrypt, key, message, additional_data, pad=pad, suite=suite
+    )
+
+
+async def aead_decrypt_async(
+    key: bytes,
+    message: bytes,
+    additional_data: bytes = b"",
+    /,
+    pad: bool = False,
+    suite: CipherSuite = DEFAULT_CIPHER_SUITE,
+) -> bytes:
+    """aead_decrypt off the event loop, see aead_encrypt_async"""
+    if len(message) < AEAD_OFFLOAD_THRESHOLD:
+        return aead_decrypt(
+            key, message, additional_data, pad=pad, suite=suite
+        )
+    return await run_in_crypto_executor(
+        aead_decrypt, key, message, additional_data, pad=pad, suite=suite
+    )
@@ -7,10 +7,29 @@ from cryptography.hazmat.primitives.asymmetric.x25519 import (
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.ciphers.aead import (
+    AESGCM,
+    ChaCha20Poly1305,
+)
 from cryptography.hazmat.primitives.padding import PKCS7
-from app.config import HASH_SALT, AEAD_NONCE, BLOCK_SIZE, SHARED_KEY_LENGTH
+from app.config import (
+    HASH_SALT,
+    AEAD_NONCE,
+    BLOCK_SIZE,
+    SHARED_KEY_LENGTH,
+    KDF_BACKEND,
+    CipherSuite,
+    DEFAULT_CIPHER_SUITE,
+    CIPHER_SUITE_BENCHMARK,
+    PUBLIC_KEY_CACHE_SIZE,
+    PRIVATE_KEY_CACHE_SIZE,
+)
+from .key_cache import KeyCache
+from typing import Callable, Dict, Optional
+from time import perf_counter
 import binascii
+import hmac
+import os
 
 
 def generate_DH() -> X25519PrivateKey:
@@ -37,26 +56,101 @@ def hkdf(inp: bytes, length: int) -> bytes:
     return hkdf.derive(inp)
 
 
+_HKDF_HASH = "sha256"
+_HKDF_HASH_LENGTH = 32
+
+
+def hkdf_hmac(
+    inp: bytes, length: int, /, salt: bytes = HASH_SALT, info: bytes = b""
+) -> bytes:
+    """
+    The same HKDF (RFC 5869) as hkdf() but computed directly with
+    hmac.digest. It does not build any HKDF / hash / backend objects
+    so it is a lot cheaper for the short inputs of the ratchets.
+    Output is byte for byte identical with hkdf().
+    """
+    if length > 255 * _HKDF_HASH_LENGTH:
+        raise ValueError(
+            f"Cannot derive more than {255 * _HKDF_HASH_LENGTH} bytes"
+        )
+
+    # extract
+    prk = hmac.digest(salt, inp, _HKDF_HASH)
+
+    # expand
+    output = b""
+    block = b""
+    counter = 1
+    while len(output) < length:
+        block = hmac.digest(
+            prk, block + info + bytes((counter,)), _HKDF_HASH
+        )
+        output += block
+        counter += 1
+
+    return output[:length]
+
+
+KdfFunction = Callable[[bytes, int], bytes]
+
+KDF_BACKENDS: Dict[str, KdfFunction] = {
+    "cryptography": hkdf,
+    "hmac": hkdf_hmac,
+}
+
+
+def get_kdf(name: str = KDF_BACKEND) -> KdfFunction:
+    """Return key derivation function registered under given name"""
+    try:
+        return KDF_BACKENDS[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown kdf backend: {name}. "
+            f"Available: {', '.join(KDF_BACKENDS)}"
+        )
+
+
 def dh(private_key: X25519PrivateKey, public_key: X25519PublicKey) -> bytes:
     out = private_key.exchange(public_key)
     return out
 
 
+_AEAD_CIPHERS = {
+    CipherSuite.AES_GCM: AESGCM,
+    CipherSuite.CHACHA20_POLY1305: ChaCha20Poly1305,
+}
+
+
+def _pad_key(key: bytes, suite: CipherSuite) -> bytes:
+    # chacha accepts only 256 bit keys, aes-gcm is fine with 128 bits
+    block_size = 256 if suite is CipherSuite.CHACHA20_POLY1305 else BLOCK_SIZE
+    padder = PKCS7(block_size).padder()
+    padded_key = padder.update(key)
+    padded_key += padder.finalize()
+    return padded_key
+
+
+def aead_cipher(key: bytes, suite: CipherSuite = DEFAULT_CIPHER_SUITE):
+    """
+    Cipher object of the suite, for the callers which encrypt a lot
+    with the same key and their own nonces (see file_stream)
+    """
+    return _AEAD_CIPHERS[suite](key)
+
+
 def aead_encrypt(
     key: bytes,
     message: bytes,
     additional_data: bytes = b"",
     /,
     pad: bool = False,
+    suite: CipherSuite = DEFAULT_CIPHER_SUITE,
 ) -> bytes:
     if pad:
-        padder = PKCS7(BLOCK_SIZE).padder()
-        padded_key = padder.update(key)
-        padded_key += padder.finalize()
-        key = padded_key
+        key = _pad_key(key, suite)
 
-    aesgcm = AESGCM(key)
-    return aesgcm.encrypt(AEAD_NONCE, message, additional_data)
+    cipher = _AEAD_CIPHERS[suite](key)
+    return cipher.encrypt(AEAD_NONCE, message, additional_data)
 
 
 def aead_decrypt(
@@ -65,15 +159,70 @@ def aead_decrypt(
     additional_data: bytes = b"",
     /,
     pad: bool = False,
+    suite: CipherSuite = DEFAULT_CIPHER_SUITE,
 ) -> bytes:
     if pad:
-        padder = PKCS7(BLOCK_SIZE).padder()
-        padded_key = padder.update(key)
-        padded_key += padder.finalize()
-        key = padded_key
+        key = _pad_key(key, suite)
 
-    aesgcm = AESGCM(key)
-    return aesgcm.decrypt(AEAD_NONCE, message, additional_data)
+    cipher = _AEAD_CIPHERS[suite](key)
+    return cipher.decrypt(AEAD_NONCE, message, additional_data)
+
+
+def benchmark_cipher_suites(
+    payload_size: int = 4096, rounds: int = 200
+) -> Dict[CipherSuite, float]:
+    """
+    Measure how long it takes to encrypt and decrypt a payload
+    of given size with every cipher suite on this machine.
+    Returns time in seconds for each of the suites
+    """
+    key = os.urandom(SHARED_KEY_LENGTH)
+    payload = os.urandom(payload_size)
+    results = {}
+
+    for suite in CipherSuite:
+        # warm up, first call pays for the lazy loading of the backend
+        aead_decrypt(key, aead_encrypt(key, payload, suite=suite), suite=suite)
+
+        start = perf_counter()
+        for _ in range(rounds):
+            aead_decrypt(
+                key, aead_encrypt(key, payload, suite=suite), suite=suite
+            )
+        results[suite] = perf_counter() - start
+
+    return results
+
+
+def agree_cipher_suite(ours: CipherSuite, theirs: CipherSuite) -> CipherSuite:
+    """
+    Suite of the session when the sides may prefer different ones.
+    Both of them get the same one, whatever message came first.
+    ChaCha20 is fast on every cpu and AES only with the hardware
+    support, so the side without it decides
+    """
+    if ours is theirs:
+        return ours
+    return CipherSuite.CHACHA20_POLY1305
+
+
+_preferred_suite: Optional[CipherSuite] = None
+
+
+def preferred_cipher_suite() -> CipherSuite:
+    """
+    Cipher suite this client uses for the messages it sends.
+    When CIPHER_SUITE_BENCHMARK is set the fastest suite is
+    measured once and remembered for the rest of the process
+    """
+    global _preferred_suite
+    if _preferred_suite is None:
+        if CIPHER_SUITE_BENCHMARK:
+            results = benchmark_cipher_suites()
+            _preferred_suite = min(results, key=results.__getitem__)
+        else:
+            _preferred_suite = DEFAULT_CIPHER_SUITE
+    return _preferred_suite
 
 
 def create_shared_key_X3DH_guest(
@@ -176,13 +325,17 @@ def create_b64_from_private_key(private_key: X25519PrivateKey) -> bytes:
     return b64_bytes
 
 
-def create_private_key_from_b64(b64Key: bytes) -> X25519PrivateKey:
-    """Derive X25519 Private key from b64 ascii string"""
+def _load_private_key_from_b64(b64Key: bytes) -> X25519PrivateKey:
     private_bytes = binascii.a2b_base64(b64Key)
     loaded_private_key = X25519PrivateKey.from_private_bytes(private_bytes)
     return loaded_private_key
 
 
+def create_private_key_from_b64(b64Key: bytes) -> X25519PrivateKey:
+    """Derive X25519 Private key from b64 ascii string"""
+    return private_key_cache.get(b64Key)
+
+
 def create_b64_from_public_key(public_key: X25519PublicKey) -> bytes:
     """Create b64 ascii string from private key object"""
     public_bytes = public_key_to_bytes(public_key)
@@ -190,8 +343,37 @@ def create_b64_from_public_key(public_key: X25519PublicKey) -> bytes:
     return b64_bytes
 
 
-def create_public_key_from_b64(b64Key: bytes) -> X25519PublicKey:
-    """Derive X25519 Private key from b64 ascii string"""
+def _load_public_key_from_b64(b64Key: bytes) -> X25519PublicKey:
     public_bytes = binascii.a2b_base64(b64Key)
-    loaded_private_key = X25519PublicKey.from_public_bytes(public_bytes)
-    return loaded_private_key
+    loaded_public_key = X25519PublicKey.from_public_bytes(public_bytes)
+    return loaded_public_key
+
+
+def create_public_key_from_b64(b64Key: bytes) -> X25519PublicKey:
+    """Derive X25519 Public key from b64 ascii string"""
+    return public_key_cache.get(b64Key)
+
+
+# --- DECODED KEYS CACHE
+
+public_key_cache: KeyCache[X25519PublicKey] = KeyCache(
+    _load_public_key_from_b64, PUBLIC_KEY_CACHE_SIZE
+)
+private_key_cache: KeyCache[X25519PrivateKey] = KeyCache(
+    _load_private_key_from_b64, PRIVATE_KEY_CACHE_SIZE
+)
+
+
+def evict_private_key(key: X25519PrivateKey) -> None:
+    """
+    Private keys should not stay in the memory longer than
+    needed, call this when the key is not going to be used anymore
+    """
+    private_key_cache.evict(create_b64_from_private_key(key))
+
+
+def key_cache_stats() -> dict:
+    return {
+        "public": public_key_cache.stats,
+        "private": private_key_cache.stats,
+    }
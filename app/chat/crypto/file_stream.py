@@ -0,0 +1,150 @@
+"""
+Files are encrypted with the STREAM construction (Hoang, Reyhanitabar,
+Rogaway, Vizar): file is cut into chunks and every chunk is sealed
+separately with the nonce
+
+    nonce prefix (7 bytes) | chunk counter (4 bytes) | last chunk flag
+
+Counter stops reordering and dropping of the chunks, the flag stops
+cutting off the end of the file. Only one chunk at a time is in memory
+"""
+from .crypto_utils import aead_cipher, hkdf_hmac
+from app.config import (
+    CipherSuite,
+    DEFAULT_CIPHER_SUITE,
+    FILE_CHUNK_SIZE,
+    SHARED_KEY_LENGTH,
+)
+from cryptography.exceptions import InvalidTag
+from typing import BinaryIO, Iterable, Iterator, Optional, Tuple
+import os
+
+NONCE_PREFIX_SIZE = 7
+_MAX_CHUNKS = 2**32
+_FILE_KEY_INFO = b"file transfer"
+
+
+class FileStreamException(Exception):
+    ...
+
+
+def derive_file_key(message_key: bytes) -> bytes:
+    """Key of the single file made from the message key of the ratchet"""
+    return hkdf_hmac(message_key, SHARED_KEY_LENGTH, info=_FILE_KEY_INFO)
+
+
+def _stream_nonce(prefix: bytes, counter: int, last: bool) -> bytes:
+    if counter >= _MAX_CHUNKS:
+        raise FileStreamException("File has too many chunks")
+    return prefix + counter.to_bytes(4, "big") + (b"\x01" if last else b"\x00")
+
+
+class StreamEncryptor:
+    __slots__ = ("nonce_prefix", "additional_data", "_cipher", "_counter")
+
+    def __init__(
+        self,
+        key: bytes,
+        /,
+        nonce_prefix: Optional[bytes] = None,
+        additional_data: bytes = b"",
+        suite: CipherSuite = DEFAULT_CIPHER_SUITE,
+    ) -> None:
+        self.nonce_prefix = (
+            nonce_prefix
+            if nonce_prefix is not None
+            else os.urandom(NONCE_PREFIX_SIZE)
+        )
+        assert len(self.nonce_prefix) == NONCE_PREFIX_SIZE, "Bad prefix"
+        self.additional_data = additional_data
+        self._cipher = aead_cipher(key, suite)
+        # None after the last chunk, nothing can be added then
+        self._counter: Optional[int] = 0
+
+    def encrypt_chunk(self, chunk: bytes, last: bool) -> bytes:
+        if self._counter is None:
+            raise FileStreamException("Stream is already finished")
+        nonce = _stream_nonce(self.nonce_prefix, self._counter, last)
+        self._counter = None if last else self._counter + 1
+        return self._cipher.encrypt(nonce, chunk, self.additional_data)
+
+
+class StreamDecryptor:
+    __slots__ = ("nonce_prefix", "additional_data", "_cipher", "_counter")
+
+    def __init__(
+        self,
+        key: bytes,
+        nonce_prefix: bytes,
+        /,
+        additional_data: bytes = b"",
+        suite: CipherSuite = DEFAULT_CIPHER_SUITE,
+    ) -> None:
+        self.nonce_prefix = nonce_prefix
+        self.additional_data = additional_data
+        self._cipher = aead_cipher(key, suite)
+        self._counter: Optional[int] = 0
+
+    @property
+    def finished(self) -> bool:
+        """The last chunk was decrypted, the file is complete"""
+        return self._counter is None
+
+    def decrypt_chunk(
+        self, chunk: bytes, last: bool, /, index: Optional[int] = None
+    ) -> bytes:
+        """
+        index is the number of the chunk the sender claims, it only
+        gives the clear error, the nonce catches the reordering anyway
+        """
+        if self._counter is None:
+            raise FileStreamException("Got chunk after the last one!")
+        if index is not None and index != self._counter:
+            raise FileStreamException(
+                f"Got chunk {index}, expected chunk {self._counter}"
+            )
+        nonce = _stream_nonce(self.nonce_prefix, self._counter, last)
+        try:
+            plain = self._cipher.decrypt(nonce, chunk, self.additional_data)
+        except InvalidTag:
+            raise FileStreamException(
+                f"Chunk {self._counter} is corrupted, missing or reordered"
+            )
+        self._counter = None if last else self._counter + 1
+        return plain
+
+
+def encrypt_file(
+    encryptor: StreamEncryptor,
+    source: BinaryIO,
+    /,
+    chunk_size: int = FILE_CHUNK_SIZE,
+) -> Iterator[Tuple[bytes, bool]]:
+    """
+    Yields encrypted chunks of the file with the last chunk flag.
+    One chunk is read ahead to know which one is the last, empty
+    file is a single empty last chunk
+    """
+    chunk = source.read(chunk_size)
+    while True:
+        next_chunk = source.read(chunk_size)
+        last = not next_chunk
+        yield encryptor.encrypt_chunk(chunk, last), last
+        if last:
+            return
+        chunk = next_chunk
+
+
+def decrypt_file(
+    decryptor: StreamDecryptor,
+    chunks: Iterable[Tuple[bytes, bool]],
+    sink: BinaryIO,
+    /,
+) -> int:
+    """Write decrypted chunks to the sink, returns the number of bytes"""
+    written = 0
+    for chunk, last in chunks:
+        written += sink.write(decryptor.decrypt_chunk(chunk, last))
+    if not decryptor.finished:
+        raise FileStreamException("File was cut off before its end")
+    return written
@@ -1,25 +1,83 @@
-from .crypto_utils import hkdf
-from app.config import RATCHET_STATE_KEY_LENGTH
-from typing import Tuple
+from .crypto_utils import KdfFunction, get_kdf
+from app.config import RATCHET_STATE_KEY_LENGTH, MESSAGE_KEY_WINDOW
+from collections import deque
+from typing import Deque, Optional, Tuple
 import binascii
 
 
+# shared by every ratchet unless other kdf is passed to the constructor
+_DEFAULT_KDF: KdfFunction = get_kdf()
+
+
 class InnerRatchet:
-    def __init__(self, initial_state: bytes) -> None:
+    # there can be a lot of ratchets in memory (3 for every contact)
+    __slots__ = ("state", "kdf", "window_size", "_window")
+
+    def __init__(
+        self,
+        initial_state: bytes,
+        /,
+        kdf: Optional[KdfFunction] = None,
+        window_size: int = MESSAGE_KEY_WINDOW,
+    ) -> None:
         """
         Args:
             initial_state (bytes): According to signal
             documentation this key is the shared secret
             of two sides of the conversation.
+            kdf (KdfFunction): optional key derivation function,
+            defaults to the one chosen by KDF_BACKEND
+            window_size (int): how many next outputs of the ratchet
+            can be computed ahead by refill_window
         """
         self.state = initial_state
+        self.kdf = kdf if kdf is not None else _DEFAULT_KDF
+        self.window_size = window_size
+        # outputs of the next turns (without input) computed in advance.
+        # self.state is NOT moved by them, so the snapshot stays the same.
+        # Created on the first refill, empty deque is not that small
+        self._window: Optional[Deque[Tuple[bytes, bytes]]] = None
 
     def turn(self, inp: bytes = b"") -> Tuple[bytes, bytes]:
-        output = hkdf(self.state + inp, RATCHET_STATE_KEY_LENGTH)
-        new_root, chain_key = output[:32], output[32:]
+        if not inp and self._window:
+            new_root, chain_key = self._window.popleft()
+            self.state = new_root
+            return new_root, chain_key
+
+        # input changes the whole chain, precomputed keys are worthless
+        self.wipe_window()
+        new_root, chain_key = self._derive(self.state, inp)
         self.state = new_root
         return new_root, chain_key
 
+    def _derive(self, state: bytes, inp: bytes = b"") -> Tuple[bytes, bytes]:
+        output = self.kdf(state + inp, RATCHET_STATE_KEY_LENGTH)
+        return output[:32], output[32:]
+
+    def refill_window(self) -> int:
+        """
+        Compute ahead the outputs of the next turns, up to the
+        window size. Meant to be run in the idle time so that the
+        next turns are only a lookup. Returns number of new entries
+        """
+        if self._window is None:
+            self._window = deque()
+        added = 0
+        tail = self._window[-1][0] if self._window else self.state
+        while len(self._window) < self.window_size:
+            keys = self._derive(tail)
+            self._window.append(keys)
+            tail = keys[0]
+            added += 1
+        return added
+
+    def wipe_window(self) -> None:
+        self._window = None
+
+    @property
+    def window_length(self) -> int:
+        return len(self._window) if self._window is not None else 0
+
     def get_snapshot(self) -> bytes:
         """
         THE ONLY THING THAT DEFINES THE
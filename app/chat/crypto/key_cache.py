@@ -0,0 +1,60 @@
+from collections import OrderedDict
+from typing import Callable, Dict, Generic, TypeVar, Union
+import threading
+
+KeyType = TypeVar("KeyType")
+
+
+class KeyCache(Generic[KeyType]):
+    """
+    Bounded LRU cache of the key objects decoded from their
+    encoded (base64) form. Key objects are immutable so the same
+    object can be safely shared by every caller
+    """
+
+    def __init__(
+        self, loader: Callable[[bytes], KeyType], max_size: int
+    ) -> None:
+        self.loader = loader
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._keys: "OrderedDict[bytes, KeyType]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    @staticmethod
+    def _normalize(encoded: Union[bytes, str]) -> bytes:
+        return encoded.encode("ascii") if isinstance(encoded, str) else encoded
+
+    def get(self, encoded: Union[bytes, str]) -> KeyType:
+        encoded = self._normalize(encoded)
+        with self._lock:
+            key = self._keys.get(encoded)
+            if key is not None:
+                self._keys.move_to_end(encoded)
+                self.hits += 1
+                return key
+            self.misses += 1
+
+        key = self.loader(encoded)
+        if self.max_size > 0:
+            with self._lock:
+                self._keys[encoded] = key
+                while len(self._keys) > self.max_size:
+                    self._keys.popitem(last=False)
+        return key
+
+    def evict(self, encoded: Union[bytes, str]) -> None:
+        with self._lock:
+            self._keys.pop(self._normalize(encoded), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._keys.clear()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
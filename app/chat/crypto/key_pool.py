@@ -0,0 +1,110 @@
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from .crypto_utils import generate_DH
+from app.config import KEY_POOL_HIGH_WATER, KEY_POOL_LOW_WATER
+from collections import deque
+from typing import Callable, Deque, Dict, Optional
+import threading
+
+
+class KeyPairPool:
+    """
+    Diffie-Hellman key pairs generated ahead of time by a background
+    thread. Taking a key from the pool is only a pop from the deque,
+    so the key generation does not happen on the message path.
+    When the pool is empty the key is generated in place (a miss)
+    """
+
+    def __init__(
+        self,
+        high_water: int = KEY_POOL_HIGH_WATER,
+        low_water: int = KEY_POOL_LOW_WATER,
+        generator: Callable[[], X25519PrivateKey] = generate_DH,
+        autostart: bool = True,
+    ) -> None:
+        assert 0 <= low_water <= high_water, "Wrong pool water marks"
+        self.high_water = high_water
+        self.low_water = low_water
+        self.generator = generator
+        # start refilling thread on the first get
+        self.autostart = autostart
+        self.hits = 0
+        self.misses = 0
+
+        self._keys: Deque[X25519PrivateKey] = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def start(self) -> None:
+        """Start the refilling thread, if it is not running yet"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._refill_worker, name="key-pool", daemon=True
+            )
+            self._thread.start()
+        self._wakeup.set()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def get(self) -> X25519PrivateKey:
+        if self.autostart:
+            self.start()
+        with self._lock:
+            key = self._keys.popleft() if self._keys else None
+            if key is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            remaining = len(self._keys)
+
+        if remaining < self.low_water:
+            self._wakeup.set()
+
+        return key if key is not None else self.generator()
+
+    def fill(self) -> None:
+        """Fill the pool up to the high water mark in this thread"""
+        while len(self._keys) < self.high_water:
+            key = self.generator()
+            with self._lock:
+                self._keys.append(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._keys.clear()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+    def _refill_worker(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while (
+                len(self._keys) < self.high_water
+                and not self._stopped.is_set()
+            ):
+                key = self.generator()
+                with self._lock:
+                    self._keys.append(key)
+
+
+key_pool = KeyPairPool()
+
+
+def pooled_DH() -> X25519PrivateKey:
+    """Take Diffie-Hellman key pair from the shared pool"""
+    return key_pool.get()
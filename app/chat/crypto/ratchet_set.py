@@ -3,20 +3,49 @@ from .inner_ratchet import InnerRatchet
 from .crypto_utils import (
     create_b64_from_private_key,
     create_private_key_from_b64,
+    private_key_to_bytes,
 )
-from typing import Optional
+from app.config import CipherSuite
+from typing import List, Optional, Tuple
+import struct
 
 
 class RatchetSetException(Exception):
     ...
 
 
+# version 1 of the binary snapshot: version, flags, dh private key,
+# three chain states (length byte + state padded to 32 bytes),
+# send / previous send / recieve message counters, contact dh key
+SNAPSHOT_VERSION = 1
+_SNAPSHOT_FORMAT = struct.Struct("<BB32s" + "B32s" * 3 + "III32s")
+SNAPSHOT_SIZE = _SNAPSHOT_FORMAT.size
+_CHAIN_STATE_MAX = 32
+
+FLAG_MY_TURN = 1
+FLAG_PENDING_ROTATION = 2
+FLAG_REMOTE_DH_KEY = 4
+# upper bits of the flags: value of the agreed cipher suite and of
+# the one the contact can still use (0 when not known yet)
+_SUITE_SHIFT = 3
+_CONTACT_SUITE_SHIFT = 5
+_SUITE_MASK = 3
+assert max(suite.value for suite in CipherSuite) <= _SUITE_MASK
+
+
 class RatchetSet:
     __slots__ = (
         "_dh_ratchet",
         "_send_ratchet",
         "_recv_ratchet",
         "_root_ratchet",
+        "send_count",
+        "prev_send_count",
+        "recv_count",
+        "remote_dh_key",
+        "pending_rotation",
+        "cipher_suite",
+        "contact_suite",
     )
 
     def __init__(self) -> None:
@@ -24,6 +53,19 @@ class RatchetSet:
         self._dh_ratchet: Optional[X25519PrivateKey] = None
         self._send_ratchet: Optional[InnerRatchet] = None
         self._recv_ratchet: Optional[InnerRatchet] = None
+        # message numbers (N, PN from the signal docs) of the chains
+        self.send_count: int = 0
+        self.prev_send_count: int = 0
+        self.recv_count: int = 0
+        # raw public key of the contact which recieving chain belongs to
+        self.remote_dh_key: Optional[bytes] = None
+        # new key of the contact is not answered with our new key yet
+        self.pending_rotation: bool = False
+        # suite agreed for the session, None till the first message
+        # of the contact (see CryptoController._agree_cipher_suite)
+        self.cipher_suite: Optional[CipherSuite] = None
+        # suite of the contact's messages send before it agreed too
+        self.contact_suite: Optional[CipherSuite] = None
 
     @property
     def dh_ratchet(self) -> X25519PrivateKey:
@@ -71,6 +113,43 @@ class RatchetSet:
     def root_ratchet(self, ratchet: InnerRatchet) -> None:
         self._root_ratchet = ratchet
 
+    def chain_ratchets(self) -> List[InnerRatchet]:
+        """Sending and recieving ratchets, those which are present"""
+        return [
+            ratchet
+            for ratchet in (self._send_ratchet, self._recv_ratchet)
+            if ratchet is not None
+        ]
+
+    def copy(self) -> "RatchetSet":
+        """
+        Independent copy, turning its ratchets does not change ours.
+        Keys computed ahead (windows) are not copied. The dh key is
+        shared, it is only ever replaced
+        """
+        r_set = RatchetSet()
+        r_set._dh_ratchet = self._dh_ratchet
+        for name in ("_send_ratchet", "_recv_ratchet", "_root_ratchet"):
+            ratchet = getattr(self, name)
+            if ratchet is not None:
+                setattr(
+                    r_set,
+                    name,
+                    InnerRatchet(
+                        ratchet.state,
+                        kdf=ratchet.kdf,
+                        window_size=ratchet.window_size,
+                    ),
+                )
+        r_set.send_count = self.send_count
+        r_set.prev_send_count = self.prev_send_count
+        r_set.recv_count = self.recv_count
+        r_set.remote_dh_key = self.remote_dh_key
+        r_set.pending_rotation = self.pending_rotation
+        r_set.cipher_suite = self.cipher_suite
+        r_set.contact_suite = self.contact_suite
+        return r_set
+
     def get_tuple(self):
         return (
             create_b64_from_private_key(self.dh_ratchet),
@@ -86,3 +165,90 @@ class RatchetSet:
         self._send_ratchet = InnerRatchet(InnerRatchet.from_snapshot(send_r))
         self._recv_ratchet = InnerRatchet(InnerRatchet.from_snapshot(recv_r))
         self._root_ratchet = InnerRatchet(InnerRatchet.from_snapshot(root_r))
+
+    def to_bytes(self, my_turn: bool) -> bytes:
+        """
+        Whole session in one fixed size record (SNAPSHOT_SIZE bytes).
+        Nothing is base64 encoded, so it is cheap to build and to save
+        """
+        chains = []
+        for ratchet in (
+            self.send_ratchet,
+            self.recv_ratchet,
+            self.root_ratchet,
+        ):
+            if len(ratchet.state) > _CHAIN_STATE_MAX:
+                raise RatchetSetException(
+                    f"Ratchet state longer than {_CHAIN_STATE_MAX} bytes"
+                )
+            chains += [len(ratchet.state), ratchet.state]
+
+        flags = (
+            (FLAG_MY_TURN if my_turn else 0)
+            | (FLAG_PENDING_ROTATION if self.pending_rotation else 0)
+            | (FLAG_REMOTE_DH_KEY if self.remote_dh_key is not None else 0)
+            | _suite_bits(self.cipher_suite) << _SUITE_SHIFT
+            | _suite_bits(self.contact_suite) << _CONTACT_SUITE_SHIFT
+        )
+        return _SNAPSHOT_FORMAT.pack(
+            SNAPSHOT_VERSION,
+            flags,
+            private_key_to_bytes(self.dh_ratchet),
+            *chains,
+            self.send_count,
+            self.prev_send_count,
+            self.recv_count,
+            self.remote_dh_key or b"",
+        )
+
+    @classmethod
+    def from_bytes(cls, record: bytes) -> Tuple["RatchetSet", bool]:
+        """Returns ratchet set and my_turn flag saved by to_bytes"""
+        if len(record) != SNAPSHOT_SIZE or record[0] != SNAPSHOT_VERSION:
+            raise RatchetSetException(
+                "Unknown ratchet snapshot format! Aborting..."
+            )
+        (
+            _,
+            flags,
+            dh_key,
+            send_len,
+            send_state,
+            recv_len,
+            recv_state,
+            root_len,
+            root_state,
+            send_count,
+            prev_send_count,
+            recv_count,
+            remote_dh_key,
+        ) = _SNAPSHOT_FORMAT.unpack(record)
+
+        r_set = cls()
+        r_set._dh_ratchet = X25519PrivateKey.from_private_bytes(dh_key)
+        r_set._send_ratchet = InnerRatchet(send_state[:send_len])
+        r_set._recv_ratchet = InnerRatchet(recv_state[:recv_len])
+        r_set._root_ratchet = InnerRatchet(root_state[:root_len])
+        r_set.send_count = send_count
+        r_set.prev_send_count = prev_send_count
+        r_set.recv_count = recv_count
+        if flags & FLAG_REMOTE_DH_KEY:
+            r_set.remote_dh_key = remote_dh_key
+        r_set.pending_rotation = bool(flags & FLAG_PENDING_ROTATION)
+        r_set.cipher_suite = _suite_from_bits(flags >> _SUITE_SHIFT)
+        r_set.contact_suite = _suite_from_bits(flags >> _CONTACT_SUITE_SHIFT)
+        return r_set, bool(flags & FLAG_MY_TURN)
+
+
+def _suite_bits(suite: Optional[CipherSuite]) -> int:
+    return suite.value if suite is not None else 0
+
+
+def _suite_from_bits(bits: int) -> Optional[CipherSuite]:
+    value = bits & _SUITE_MASK
+    if not value:
+        return None
+    try:
+        return CipherSuite(value)
+    except ValueError:
+        raise RatchetSetException(f"Unknown cipher suite {value} in snapshot")
@@ -0,0 +1,64 @@
+from app.config import ROTATION_EVERY_MESSAGES, ROTATION_MIN_INTERVAL
+
+
+class RotationPolicy:
+    """
+    Decides when we answer the new dh key of the contact with our own
+    new dh key (the sending half of the dh ratchet turn: key pair
+    generation, exchange and root ratchet turn).
+
+    The recieving half is always done right away, because contact
+    already encrypts with the new key. The sending half can wait until
+    enough messages were send on the current chain or enough time has
+    passed. Until then we keep sending with the old key.
+
+    Contact does not need to know our policy: the new public key
+    in the message header (together with PN) is the signal of the
+    rotation, so both sides can even use diffrent policies.
+    """
+
+    __slots__ = ("every_messages", "min_interval")
+
+    def __init__(
+        self,
+        every_messages: int = ROTATION_EVERY_MESSAGES,
+        min_interval: float = ROTATION_MIN_INTERVAL,
+    ) -> None:
+        """
+        Args:
+            every_messages (int): rotate only when at least that many
+            messages were send on the current sending chain
+            min_interval (float): rotate at most every that many seconds
+        """
+        self.every_messages = every_messages
+        self.min_interval = min_interval
+
+    @classmethod
+    def every_turn(cls) -> "RotationPolicy":
+        """Rotate on every reply, as the double ratchet does"""
+        return cls(0, 0.0)
+
+    @classmethod
+    def every_n_messages(cls, n: int) -> "RotationPolicy":
+        return cls(n, 0.0)
+
+    @classmethod
+    def at_most_every(cls, seconds: float) -> "RotationPolicy":
+        return cls(0, seconds)
+
+    def should_rotate(self, sent_messages: int, elapsed: float) -> bool:
+        """
+        Args:
+            sent_messages (int): messages send on current sending chain
+            elapsed (float): seconds since our last rotation
+        """
+        if sent_messages < self.every_messages:
+            return False
+        # without the interval even the clock going back cannot stop us
+        return self.min_interval <= 0 or elapsed >= self.min_interval
+
+    def __repr__(self) -> str:
+        return (
+            f"RotationPolicy(every_messages={self.every_messages}, "
+            f"min_interval={self.min_interval})"
+        )
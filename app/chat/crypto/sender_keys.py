@@ -0,0 +1,200 @@
+from cryptography.hazmat.primitives.asymmetric.ed25519 import (
+    Ed25519PrivateKey,
+    Ed25519PublicKey,
+)
+from cryptography.hazmat.primitives import serialization
+from cryptography.exceptions import InvalidSignature
+from app.config import MAX_SKIP, PREFFERED_ENCODING, SHARED_KEY_LENGTH
+from typing import Dict, Optional, Tuple
+import binascii
+import hmac
+import os
+import struct
+
+# chain key, iteration, public signing key, private signing key
+# (zeros for the sender keys of the other members), followed by
+# the iteration and key of every skipped message
+_SENDER_KEY_FORMAT = struct.Struct("<32sI32s?32s")
+_SKIPPED_KEY_FORMAT = struct.Struct("<I32s")
+_MESSAGE_KEY_SEED = b"\x01"
+_CHAIN_KEY_SEED = b"\x02"
+
+
+class SenderKeyException(Exception):
+    ...
+
+
+def _raw_public(key: Ed25519PublicKey) -> bytes:
+    return key.public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw,
+    )
+
+
+class SenderKeyState:
+    """
+    Sender key of one member of the group (from the signal docs).
+    It is a symmetric chain: every message is encrypted with the next
+    message key, so the member encrypts the message once for the
+    whole group. Everyone in the group has the chain, so the messages
+    are also signed with the key only the owner of the chain has
+    """
+
+    __slots__ = (
+        "chain_key",
+        "iteration",
+        "signing_key",
+        "verify_key",
+        "_skipped",
+    )
+
+    def __init__(
+        self,
+        chain_key: bytes,
+        iteration: int,
+        verify_key: Ed25519PublicKey,
+        /,
+        signing_key: Optional[Ed25519PrivateKey] = None,
+    ) -> None:
+        self.chain_key = chain_key
+        self.iteration = iteration
+        self.verify_key = verify_key
+        self.signing_key = signing_key
+        # keys of the messages which did not arrive yet
+        self._skipped: Dict[int, bytes] = {}
+
+    @classmethod
+    def generate(cls) -> "SenderKeyState":
+        """Our own fresh sender key"""
+        signing_key = Ed25519PrivateKey.generate()
+        return cls(
+            os.urandom(SHARED_KEY_LENGTH),
+            0,
+            signing_key.public_key(),
+            signing_key=signing_key,
+        )
+
+    def _turn(self) -> bytes:
+        message_key = hmac.digest(self.chain_key, _MESSAGE_KEY_SEED, "sha256")
+        self.chain_key = hmac.digest(
+            self.chain_key, _CHAIN_KEY_SEED, "sha256"
+        )
+        self.iteration += 1
+        return message_key
+
+    def sending_key(self) -> Tuple[int, bytes]:
+        """Iteration and key of our next group message"""
+        if self.signing_key is None:
+            raise SenderKeyException("Only the owner can send with the key")
+        iteration = self.iteration
+        return iteration, self._turn()
+
+    def message_key(self, iteration: int) -> bytes:
+        """Key of the recieved message, in any order"""
+        if iteration < self.iteration:
+            key = self._skipped.pop(iteration, None)
+            if key is None:
+                raise SenderKeyException(
+                    f"Group message {iteration} was already decrypted"
+                )
+            return key
+
+        if iteration - self.iteration > MAX_SKIP:
+            raise SenderKeyException(
+                f"Refusing to skip {iteration - self.iteration} messages"
+            )
+        while self.iteration < iteration:
+            skipped = self.iteration
+            self._skipped[skipped] = self._turn()
+        while len(self._skipped) > MAX_SKIP:
+            del self._skipped[min(self._skipped)]
+        return self._turn()
+
+    def sign(self, data: bytes) -> bytes:
+        if self.signing_key is None:
+            raise SenderKeyException("Only the owner can sign with the key")
+        return self.signing_key.sign(data)
+
+    def verify(self, signature: bytes, data: bytes) -> None:
+        try:
+            self.verify_key.verify(signature, data)
+        except InvalidSignature:
+            raise SenderKeyException("Bad signature of the group message!")
+
+    def distribution(self) -> dict:
+        """
+        What the other members need to decrypt our messages.
+        Must be send ONLY over the pairwise ratchets
+        """
+        return {
+            "chain_key": binascii.b2a_base64(
+                self.chain_key, newline=False
+            ).decode(PREFFERED_ENCODING),
+            "iteration": self.iteration,
+            "verify_key": binascii.b2a_base64(
+                _raw_public(self.verify_key), newline=False
+            ).decode(PREFFERED_ENCODING),
+        }
+
+    @classmethod
+    def from_distribution(cls, distribution: dict) -> "SenderKeyState":
+        return cls(
+            binascii.a2b_base64(distribution["chain_key"]),
+            distribution["iteration"],
+            Ed25519PublicKey.from_public_bytes(
+                binascii.a2b_base64(distribution["verify_key"])
+            ),
+        )
+
+    def to_bytes(self) -> bytes:
+        """
+        Record for the database. Keys of the skipped messages are
+        saved too, messages which are late still decrypt after
+        the restart
+        """
+        signing = (
+            self.signing_key.private_bytes(
+                encoding=serialization.Encoding.Raw,
+                format=serialization.PrivateFormat.Raw,
+                encryption_algorithm=serialization.NoEncryption(),
+            )
+            if self.signing_key is not None
+            else bytes(32)
+        )
+        return _SENDER_KEY_FORMAT.pack(
+            self.chain_key,
+            self.iteration,
+            _raw_public(self.verify_key),
+            self.signing_key is not None,
+            signing,
+        ) + b"".join(
+            _SKIPPED_KEY_FORMAT.pack(iteration, key)
+            for iteration, key in sorted(self._skipped.items())
+        )
+
+    @classmethod
+    def from_bytes(cls, record: bytes) -> "SenderKeyState":
+        skipped = len(record) - _SENDER_KEY_FORMAT.size
+        if skipped < 0 or skipped % _SKIPPED_KEY_FORMAT.size:
+            raise SenderKeyException("Unknown sender key format!")
+        (
+            chain_key,
+            iteration,
+            verify_key,
+            has_signing_key,
+            signing_key,
+        ) = _SENDER_KEY_FORMAT.unpack_from(record)
+        state = cls(
+            chain_key,
+            iteration,
+            Ed25519PublicKey.from_public_bytes(verify_key),
+            signing_key=Ed25519PrivateKey.from_private_bytes(signing_key)
+            if has_signing_key
+            else None,
+        )
+        state._skipped = dict(
+            _SKIPPED_KEY_FORMAT.iter_unpack(
+                record[_SENDER_KEY_FORMAT.size:]
+            )
+        )
+        return state
@@ -0,0 +1,125 @@
+from .ratchet_set import (
+    FLAG_MY_TURN,
+    RatchetSet,
+    SNAPSHOT_SIZE,
+    SNAPSHOT_VERSION,
+)
+from app.config import SESSION_STORE_CAPACITY
+from typing import Dict, Hashable, List, Tuple
+
+# fields of the ratchet snapshot (see RatchetSet.to_bytes) after
+# the version byte, every one of them is kept in its own column
+_COLUMNS = (
+    ("flags", 1),
+    ("dh_key", 32),
+    ("send_chain", 33),
+    ("recv_chain", 33),
+    ("root_chain", 33),
+    ("counters", 12),
+    ("remote_dh_key", 32),
+)
+assert sum(width for _, width in _COLUMNS) == SNAPSHOT_SIZE - 1
+
+
+class SessionStoreException(Exception):
+    ...
+
+
+class SessionStore:
+    """
+    Ratchets of many contacts kept in preallocated bytearrays,
+    one column per field of the ratchet snapshot and one slot per
+    session. A session costs its 176 bytes of state and an entry
+    in the slot index. RatchetSet with its ratchets and key object
+    is created only when the session is actually used (get) and
+    written back with put
+    """
+
+    __slots__ = ("capacity", "_index", "_free", "_used", "_columns")
+
+    def __init__(self, capacity: int = SESSION_STORE_CAPACITY) -> None:
+        self.capacity = capacity
+        self._index: Dict[Hashable, int] = {}
+        # slots of removed sessions, reused before the new ones
+        self._free: List[int] = []
+        self._used = 0
+        self._columns: List[Tuple[bytearray, int]] = [
+            (bytearray(width * capacity), width) for _, width in _COLUMNS
+        ]
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, session: Hashable) -> bool:
+        return session in self._index
+
+    @property
+    def nbytes(self) -> int:
+        """Memory taken by the columns, without the slot index"""
+        return sum(len(column) for column, _ in self._columns)
+
+    def put(
+        self, session: Hashable, ratchet_set: RatchetSet, my_turn: bool
+    ) -> None:
+        self.put_record(session, ratchet_set.to_bytes(my_turn))
+
+    def get(self, session: Hashable) -> Tuple[RatchetSet, bool]:
+        """Build ratchet set of the session, returns it with my_turn"""
+        return RatchetSet.from_bytes(self.get_record(session))
+
+    def put_record(self, session: Hashable, record: bytes) -> None:
+        """Save snapshot made by RatchetSet.to_bytes"""
+        if len(record) != SNAPSHOT_SIZE or record[0] != SNAPSHOT_VERSION:
+            raise SessionStoreException("Unknown ratchet snapshot format!")
+
+        slot = self._index.get(session)
+        if slot is None:
+            slot = self._allocate()
+            self._index[session] = slot
+
+        view = memoryview(record)
+        offset = 1
+        for column, width in self._columns:
+            start, end = slot * width, (slot + 1) * width
+            column[start:end] = view[offset:offset + width]
+            offset += width
+
+    def get_record(self, session: Hashable) -> bytes:
+        slot = self._slot(session)
+        return bytes([SNAPSHOT_VERSION]) + b"".join(
+            column[slot * width:(slot + 1) * width]
+            for column, width in self._columns
+        )
+
+    def my_turn(self, session: Hashable) -> bool:
+        """Read the turn flag without building the ratchets"""
+        flags, _ = self._columns[0]
+        return bool(flags[self._slot(session)] & FLAG_MY_TURN)
+
+    def remove(self, session: Hashable) -> None:
+        slot = self._index.pop(session, None)
+        if slot is None:
+            return
+        # keys must not stay in memory after the session is gone
+        for column, width in self._columns:
+            column[slot * width:(slot + 1) * width] = bytes(width)
+        self._free.append(slot)
+
+    def _slot(self, session: Hashable) -> int:
+        slot = self._index.get(session)
+        if slot is None:
+            raise SessionStoreException(f"No session {session} in store")
+        return slot
+
+    def _allocate(self) -> int:
+        if self._free:
+            return self._free.pop()
+        if self._used == self.capacity:
+            self._grow(max(1, self.capacity * 2))
+        self._used += 1
+        return self._used - 1
+
+    def _grow(self, capacity: int) -> None:
+        for column, width in self._columns:
+            column.extend(bytes(width * (capacity - self.capacity)))
+        self.capacity = capacity
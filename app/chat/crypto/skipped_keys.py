@@ -0,0 +1,131 @@
+from app.config import MAX_SKIPPED_KEYS, SKIPPED_KEY_TTL
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+from time import time
+
+
+class SkippedKeyStore:
+    """
+    Message keys of the messages which did not arrive yet.
+    When the message with number N arrives before the messages
+    with smaller numbers, the recieving chain is turned up to N and
+    the keys for the missing messages are kept here.
+
+    Store is bounded: the oldest keys are dropped when there
+    are more than max_keys of them or when they are older than ttl.
+
+    Keys added and dropped since the last save are tracked, so only
+    they are written to the database (see take_changes)
+    """
+
+    __slots__ = ("max_keys", "ttl", "_keys", "_added", "_removed")
+
+    def __init__(
+        self, max_keys: int = MAX_SKIPPED_KEYS, ttl: float = SKIPPED_KEY_TTL
+    ) -> None:
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self._keys: "OrderedDict[Tuple[bytes, int], Tuple[bytes, float]]"
+        self._keys = OrderedDict()
+        # changes since the last save to the database
+        self._added: Dict[Tuple[bytes, int], Tuple[bytes, float]] = {}
+        self._removed: Set[Tuple[bytes, int]] = set()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    @property
+    def dirty(self) -> bool:
+        """Content changed since the last save to the database"""
+        return bool(self._added or self._removed)
+
+    def put(
+        self,
+        dh_key: bytes,
+        number: int,
+        message_key: bytes,
+        /,
+        created: Optional[float] = None,
+    ) -> None:
+        key = (dh_key, number)
+        entry = (message_key, time() if created is None else created)
+        if key in self._keys and key not in self._added:
+            # the saved key is replaced
+            self._removed.add(key)
+        self._keys[key] = entry
+        self._keys.move_to_end(key)
+        self._added[key] = entry
+
+        while len(self._keys) > self.max_keys:
+            oldest, _ = self._keys.popitem(last=False)
+            self._drop(oldest)
+
+    def peek(self, dh_key: bytes, number: int) -> Optional[bytes]:
+        """The key without taking it out, see pop"""
+        entry = self._keys.get((dh_key, number))
+        if entry is None or time() - entry[1] > self.ttl:
+            return None
+        return entry[0]
+
+    def pop(self, dh_key: bytes, number: int) -> Optional[bytes]:
+        """Take out the key, every message key can be used only once"""
+        entry = self._keys.pop((dh_key, number), None)
+        if entry is None:
+            return None
+
+        self._drop((dh_key, number))
+        message_key, created = entry
+        if time() - created > self.ttl:
+            return None
+        return message_key
+
+    def evict_expired(self, now: Optional[float] = None) -> int:
+        """
+        Drop the keys older than ttl. Keys are kept in the order
+        they were added so only the front of the store is checked
+        """
+        now = time() if now is None else now
+        evicted = 0
+        while self._keys:
+            key, (_, created) = next(iter(self._keys.items()))
+            if now - created <= self.ttl:
+                break
+            del self._keys[key]
+            self._drop(key)
+            evicted += 1
+        return evicted
+
+    def items(self) -> List[Tuple[bytes, int, bytes, float]]:
+        return [
+            (dh_key, number, message_key, created)
+            for (dh_key, number), (message_key, created) in self._keys.items()
+        ]
+
+    def take_changes(
+        self,
+    ) -> Tuple[List[Tuple[bytes, int, bytes, float]], List[Tuple[bytes, int]]]:
+        """
+        Keys added (as in items) and keys dropped since the last call,
+        they are treated as saved from now on
+        """
+        added = [
+            (dh_key, number, message_key, created)
+            for (dh_key, number), (message_key, created) in self._added.items()
+        ]
+        removed = list(self._removed)
+        self._added.clear()
+        self._removed.clear()
+        return added, removed
+
+    def load(self, items: List[Tuple[bytes, int, bytes, float]]) -> None:
+        self._keys.clear()
+        for dh_key, number, message_key, created in items:
+            self.put(dh_key, number, message_key, created=created)
+        self.evict_expired()
+        # the same as in the database
+        self.take_changes()
+
+    def _drop(self, key: Tuple[bytes, int]) -> None:
+        # the key which was not saved yet is not in the database either
+        if self._added.pop(key, None) is None:
+            self._removed.add(key)
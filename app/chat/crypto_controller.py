@@ -1,15 +1,50 @@
-from typing import Optional
+from typing import (
+    BinaryIO,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 from .crypto.inner_ratchet import InnerRatchet
 from .crypto.ratchet_set import RatchetSet, RatchetSetException
 from .crypto.crypto_utils import (
     aead_decrypt,
     aead_encrypt,
+    agree_cipher_suite,
     create_b64_from_public_key,
     create_public_key_from_b64,
-    generate_DH,
+    preferred_cipher_suite,
+    public_key_to_bytes,
+    evict_private_key,
+)
+from .crypto.skipped_keys import SkippedKeyStore
+from .crypto.key_pool import pooled_DH
+from .crypto.rotation_policy import RotationPolicy
+from .crypto.crypto_executor import run_in_crypto_executor
+from .crypto.file_stream import (
+    FileStreamException,
+    StreamDecryptor,
+    StreamEncryptor,
+    derive_file_key,
+    encrypt_file,
+)
+from .crypto.compression import (
+    CompressionException,
+    MessageCompressor,
+    default_compressor,
 )
 from app.user.user_state import UserState
-from app.config import DEFAULT_DB_PATH, PREFFERED_ENCODING
+from app.config import (
+    CipherSuite,
+    COMPRESSION_ENABLED,
+    DEFAULT_DB_PATH,
+    FILE_CHUNK_SIZE,
+    MAX_SKIP,
+    PREFFERED_ENCODING,
+    SHARED_KEY_LENGTH,
+)
 from cryptography.hazmat.primitives.asymmetric.x25519 import (
     X25519PrivateKey,
     X25519PublicKey,
@@ -17,10 +52,19 @@ from cryptography.hazmat.primitives.asymmetric.x25519 import (
 from cryptography.exceptions import InvalidTag
 from app.database.db_controller import DatabaseController
 from app.api.response_type import ResponseType
+import asyncio
 import binascii
+import hashlib
+import hmac
+import json
+import os
 from time import time
 
 
+# ratchet messages with json content, not shown to the user
+CONTROL_MESSAGE_TYPES = (ResponseType.SENDER_KEY_DISTRIBUTION,)
+
+
 class CryptoControllerException(Exception):
     ...
 
@@ -38,6 +82,9 @@ class CryptoController:
         /,
         my_turn: Optional[bool] = None,
         DB_PATH=DEFAULT_DB_PATH,
+        cipher_suite: Optional[CipherSuite] = None,
+        rotation_policy: Optional[RotationPolicy] = None,
+        compressor: Optional[MessageCompressor] = None,
     ) -> None:
         self.user_state = user_state
         """
@@ -49,6 +96,39 @@ class CryptoController:
         self.contact = contact
         self.db_path = DB_PATH
         self.db_controller = None
+        # WriteBehindStore, set by the session manager. Without it
+        # every save_state goes to the database right away
+        self.write_behind = None
+        self.ratchet_set: Optional[RatchetSet] = None
+        self.skipped_keys = SkippedKeyStore()
+        self.rotation_policy = (
+            rotation_policy
+            if rotation_policy is not None
+            else RotationPolicy()
+        )
+        # time of our last dh rotation, it is not saved. After restart
+        # the first rotation is allowed right away
+        self.last_rotation = 0.0
+        # created on first use, it has to belong to the running loop
+        self._session_lock: Optional[asyncio.Lock] = None
+        """
+        Suite we send with till the suite of the session is agreed.
+        Every message carries its suite in the header, the first
+        message of the contact decides (see _agree_cipher_suite)
+        """
+        self.preferred_suite = (
+            cipher_suite
+            if cipher_suite is not None
+            else preferred_cipher_suite()
+        )
+        # used also for the decompression, so it is always present.
+        # COMPRESSION_ENABLED decides only about the messages we send,
+        # compressed message of the contact turns it on (see
+        # decrypt_json_message)
+        self.compressor = (
+            compressor if compressor is not None else default_compressor()
+        )
+        self.compress_messages = COMPRESSION_ENABLED
 
     def init_ratchets(
         self,
@@ -74,6 +154,11 @@ class CryptoController:
             _, self.my_turn = self.db_controller.load_chat_init_variables(
                 self.user_state, self.contact
             )
+            self.skipped_keys.load(
+                self.db_controller.load_skipped_keys(
+                    self.user_state, self.contact
+                )
+            )
         else:
             # this will run for the first time the users are connected
             shared_key, my_turn = self.db_controller.load_chat_init_variables(
@@ -96,10 +181,41 @@ class CryptoController:
                 self.my_turn,
             )
 
+    def restore_ratchets(
+        self,
+        ratchet_set: RatchetSet,
+        my_turn: bool,
+        /,
+        skipped_keys: Optional[SkippedKeyStore] = None,
+    ) -> None:
+        """
+        init_ratchets with the ratchets already known (the same as in
+        the database, see SessionManager). Without the skipped_keys
+        they are loaded from the database
+        """
+        self.db_controller = DatabaseController(DB_PATH=self.db_path)
+        self.ratchet_set = ratchet_set
+        self.my_turn = my_turn
+        if skipped_keys is not None:
+            self.skipped_keys = skipped_keys
+            return
+        self.skipped_keys.load(
+            self.db_controller.load_skipped_keys(self.user_state, self.contact)
+        )
+
     def get_ratchet_set(self) -> RatchetSet:
         assert self.ratchet_set is not None, "This must be initialized!"
         return self.ratchet_set
 
+    @property
+    def cipher_suite(self) -> CipherSuite:
+        """Suite of the messages we send, it is saved with the ratchets"""
+        if self.ratchet_set is not None and (
+            self.ratchet_set.cipher_suite is not None
+        ):
+            return self.ratchet_set.cipher_suite
+        return self.preferred_suite
+
     def initialize_symmertic_ratchets(
         self,
         shared_key: bytes,
@@ -142,12 +258,17 @@ class CryptoController:
             if opt_private_key is not None:
                 r_set.dh_ratchet = opt_private_key
             else:
-                r_set.dh_ratchet = generate_DH()
+                r_set.dh_ratchet = pooled_DH()
             assert opt_public_key is None, "Bad initialization!!"
 
         self.ratchet_set = r_set
 
     def rotate_dh_ratchet(self, public_key: X25519PublicKey) -> None:
+        self._take_turn()
+        self._turn_recieving_dh_ratchet(public_key)
+        self._turn_sending_dh_ratchet(public_key)
+
+    def _take_turn(self) -> None:
         if not self.my_turn:
             raise CryptoControllerException(
                 "SYNCHORNIZATION ERROR!! Detected double "
@@ -155,45 +276,261 @@ class CryptoController:
             )
         self.my_turn = False
 
+    def _turn_recieving_dh_ratchet(self, public_key: X25519PublicKey) -> None:
+        """Start recieving chain for the new dh key of the contact"""
+        # keys computed ahead for the old chains must not outlive them
+        self.wipe_key_windows()
+
         try:
             recieving_secret = self.ratchet_set.dh_ratchet.exchange(public_key)
             shared_recv_secret = self.ratchet_set.root_ratchet.turn(
                 recieving_secret
             )[0]
             self.ratchet_set.recv_ratchet = InnerRatchet(shared_recv_secret)
+            self.ratchet_set.recv_count = 0
         except RatchetSetException:
             ...
+        self.ratchet_set.remote_dh_key = public_key_to_bytes(public_key)
 
-        self.ratchet_set.dh_ratchet = X25519PrivateKey.generate()
+    def _turn_sending_dh_ratchet(self, public_key: X25519PublicKey) -> None:
+        """Start sending chain with our new dh key"""
+        self.wipe_key_windows()
+
+        try:
+            evict_private_key(self.ratchet_set.dh_ratchet)
+        except RatchetSetException:
+            ...
+        self.ratchet_set.dh_ratchet = pooled_DH()
         sending_secret = self.ratchet_set.dh_ratchet.exchange(public_key)
         shared_send_secret = self.ratchet_set.root_ratchet.turn(
             sending_secret
         )[0]
         self.ratchet_set.send_ratchet = InnerRatchet(shared_send_secret)
+        self.ratchet_set.prev_send_count = self.ratchet_set.send_count
+        self.ratchet_set.send_count = 0
+        self.ratchet_set.pending_rotation = False
+        self.last_rotation = time()
+
+    def _rotation_due(self) -> bool:
+        return self.rotation_policy.should_rotate(
+            self.get_ratchet_set().send_count, time() - self.last_rotation
+        )
+
+    def refill_key_windows(self) -> None:
+        """
+        Precompute the next message keys of the sending and recieving
+        chains. Should be called when nothing else is happening, so
+        that the next encrypt / decrypt is only the AEAD operation
+        """
+        if self.ratchet_set is not None:
+            for ratchet in self.ratchet_set.chain_ratchets():
+                ratchet.refill_window()
+
+    def wipe_key_windows(self) -> None:
+        if self.ratchet_set is not None:
+            for ratchet in self.ratchet_set.chain_ratchets():
+                ratchet.wipe_window()
+
+    def _apply_pending_rotation(self) -> None:
+        r_set = self.get_ratchet_set()
+        if r_set.pending_rotation and self._rotation_due():
+            assert r_set.remote_dh_key is not None, "Nothing to rotate with"
+            self._turn_sending_dh_ratchet(
+                X25519PublicKey.from_public_bytes(r_set.remote_dh_key)
+            )
 
     def encrypt(self, message: bytes) -> bytes:
-        self.my_turn = True
-        root_key, chain_key = self.ratchet_set.send_ratchet.turn()
-        ecrypted_plaintext = aead_encrypt(root_key, message, chain_key)
+        root_key, chain_key = self._sending_keys()
+        ecrypted_plaintext = aead_encrypt(
+            root_key, message, chain_key, suite=self.cipher_suite
+        )
         return ecrypted_plaintext
 
+    def _sending_keys(self) -> Tuple[bytes, bytes]:
+        """Keys of the next message we send"""
+        self._apply_pending_rotation()
+        self.my_turn = True
+        keys = self.ratchet_set.send_ratchet.turn()
+        self.ratchet_set.send_count += 1
+        return keys
+
     def decrypt(
         self,
         message: bytes,
         /,
         public_key: Optional[X25519PublicKey] = None,
+        suite: Optional[CipherSuite] = None,
     ) -> bytes:
-        if public_key is not None:
-            self.rotate_dh_ratchet(public_key)
-        else:
-            assert (
-                public_key is None
-            ), "Passed the public key without any reason"
+        rollback = self._rollback_point(public_key is None)
+        try:
+            if public_key is not None:
+                self.rotate_dh_ratchet(public_key)
+
+            root_key, chain_key = self.ratchet_set.recv_ratchet.turn()
+            self.ratchet_set.recv_count += 1
+            return self._open(root_key, chain_key, message, suite)
+        except Exception:
+            rollback()
+            raise
+
+    def decrypt_numbered(
+        self,
+        message: bytes,
+        public_key: bytes,
+        number: int,
+        prev_number: int,
+        /,
+        suite: Optional[CipherSuite] = None,
+    ) -> bytes:
+        """
+        Decrypt message which can come in any order. The sender
+        puts into the header its raw dh public key, the number of the
+        message in its sending chain (N) and the length of its
+        previous sending chain (PN). Keys of the messages we skipped
+        over are kept in the skipped_keys store
+        """
+        return self._open_numbered(
+            message, public_key, number, prev_number, suite
+        )[0]
+
+    def _open_numbered(
+        self,
+        message: bytes,
+        public_key: bytes,
+        number: int,
+        prev_number: int,
+        suite: Optional[CipherSuite] = None,
+    ) -> Tuple[bytes, bytes, bytes]:
+        """
+        Decrypted message with its keys. The session is changed only
+        when the message is authentic, forged or broken message must
+        not move the ratchets nor use up the skipped keys
+        """
+        self.skipped_keys.evict_expired()
+        message_key = self.skipped_keys.peek(public_key, number)
+        if message_key is not None:
+            root_key, chain_key = message_key[:32], message_key[32:]
+            decrypted = self._open(root_key, chain_key, message, suite)
+            self.skipped_keys.pop(public_key, number)
+            return decrypted, root_key, chain_key
+
+        rollback = self._rollback_point(
+            public_key == self.get_ratchet_set().remote_dh_key
+        )
+        staged: List[Tuple[bytes, int, bytes]] = []
+        try:
+            root_key, chain_key = self._recieving_keys(
+                public_key, number, prev_number, staged
+            )
+            decrypted = self._open(root_key, chain_key, message, suite)
+        except Exception:
+            rollback()
+            raise
+        for dh_key, skipped_number, skipped_key in staged:
+            self.skipped_keys.put(dh_key, skipped_number, skipped_key)
+        return decrypted, root_key, chain_key
+
+    def _recieving_keys(
+        self,
+        public_key: bytes,
+        number: int,
+        prev_number: int,
+        staged: List[Tuple[bytes, int, bytes]],
+    ) -> Tuple[bytes, bytes]:
+        """
+        Keys of the message number N send with given dh key. Keys
+        of the skipped messages go to staged, not to the store
+        """
+        r_set = self.get_ratchet_set()
+        if public_key != r_set.remote_dh_key:
+            # contact has turned his dh ratchet. The rest of the
+            # current chain could still be on its way
+            if r_set.remote_dh_key is not None:
+                self._skip_message_keys(prev_number, staged)
+
+            contact_key = X25519PublicKey.from_public_bytes(public_key)
+            if self._rotation_due():
+                self.rotate_dh_ratchet(contact_key)
+            else:
+                # we answer with our new key later, see RotationPolicy
+                self._take_turn()
+                self._turn_recieving_dh_ratchet(contact_key)
+                r_set.pending_rotation = True
+        elif number < r_set.recv_count:
+            raise CryptoControllerException(
+                f"Message number {number} was already decrypted "
+                "or its key has expired"
+            )
+
+        self._skip_message_keys(number, staged)
+        keys = r_set.recv_ratchet.turn()
+        r_set.recv_count += 1
+        return keys
+
+    def _skip_message_keys(
+        self, until: int, staged: List[Tuple[bytes, int, bytes]]
+    ) -> None:
+        r_set = self.get_ratchet_set()
+        if until - r_set.recv_count > MAX_SKIP:
+            raise CryptoControllerException(
+                f"Refusing to skip {until - r_set.recv_count} messages"
+            )
+
+        assert r_set.remote_dh_key is not None, "Unknown recieving chain"
+        while r_set.recv_count < until:
+            root_key, chain_key = r_set.recv_ratchet.turn()
+            staged.append(
+                (r_set.remote_dh_key, r_set.recv_count, root_key + chain_key)
+            )
+            r_set.recv_count += 1
+
+    def _rollback_point(self, same_chain: bool) -> Callable[[], None]:
+        """
+        Undo of the message about to be decrypted, it brings the
+        session back to its state before the message. Message of the
+        current recieving chain only turns that chain, the whole set
+        is copied only when the dh ratchet steps
+        """
+        r_set = self.get_ratchet_set()
+        if same_chain:
+            recv_ratchet = r_set.recv_ratchet
+            state, recv_count = recv_ratchet.state, r_set.recv_count
+
+            def rollback_chain() -> None:
+                recv_ratchet.state = state
+                # keys computed ahead start after the turns undone here
+                recv_ratchet.wipe_window()
+                r_set.recv_count = recv_count
+
+            return rollback_chain
 
-        root_key, chain_key = self.ratchet_set.recv_ratchet.turn()
+        copy, my_turn, last_rotation = (
+            r_set.copy(),
+            self.my_turn,
+            self.last_rotation,
+        )
 
+        def rollback_set() -> None:
+            self.ratchet_set = copy
+            self.my_turn = my_turn
+            self.last_rotation = last_rotation
+
+        return rollback_set
+
+    def _open(
+        self,
+        root_key: bytes,
+        chain_key: bytes,
+        message: bytes,
+        suite: Optional[CipherSuite] = None,
+    ) -> bytes:
         try:
-            decrypted_message = aead_decrypt(root_key, message, chain_key)
+            decrypted_message = aead_decrypt(
+                root_key,
+                message,
+                chain_key,
+                suite=suite if suite is not None else self.cipher_suite,
+            )
         except InvalidTag:
             raise CryptoControllerException(
                 "You passed bad key for decryption! ",
@@ -213,6 +550,10 @@ class CryptoController:
             "message_type" : TEXT_MESSAGE
             "sender" : "user123"
             "posix_time_send" : 321321
+            "cipher_suite" : 1
+            "n" : 3  # number of the message in the sending chain
+            "pn" : 5  # number of messages in previous sending chain
+            "compressed" : false  # content is zlib compressed
         },
         "body" : {
             "content" : "dsakjndksak"
@@ -221,13 +562,35 @@ class CryptoController:
     }
     """
 
-    def encrypt_to_json_message(self, plaintext: str) -> dict:
-        encrypted = self.encrypt(plaintext.encode(PREFFERED_ENCODING))
+    def _message_head(self, message_type: ResponseType, number: int) -> dict:
+        return {
+            "message_type": message_type,
+            "sender": self.user_state.login,
+            "posix_time_send": int(time()),
+            "cipher_suite": self.cipher_suite.value,
+            "n": number,
+            "pn": self.get_ratchet_set().prev_send_count,
+        }
+
+    def encrypt_to_json_message(
+        self, plaintext: str, /, persist: bool = True
+    ) -> dict:
+        # rotation changes the message numbers, so it goes first
+        self._apply_pending_rotation()
+        number = self.get_ratchet_set().send_count
+        payload = plaintext.encode(PREFFERED_ENCODING)
+        compressed = (
+            self.compressor.compress(payload)
+            if self.compress_messages
+            else None
+        )
+        encrypted = self.encrypt(
+            compressed if compressed is not None else payload
+        )
         msg_to_send = {
             "head": {
-                "message_type": ResponseType.TEXT_MESSAGE,
-                "sender": self.user_state.login,
-                "posix_time_send": int(time()),
+                **self._message_head(ResponseType.TEXT_MESSAGE, number),
+                "compressed": compressed is not None,
             },
             "body": {
                 "content": binascii.b2a_base64(encrypted),
@@ -237,48 +600,522 @@ class CryptoController:
             },
         }
 
+        if persist:
+            self.save_state()
+        return msg_to_send
+
+    def encrypt_session_start(
+        self, plaintext: str, x3dh: dict, /, persist: bool = True
+    ) -> dict:
+        """
+        First message to the new contact, it carries our part of the
+        X3DH (public id key, public ephemeral key and index of the
+        one time key). Contact does the X3DH and decrypts the message
+        in one step, without waiting for the invite
+        """
+        message = self.encrypt_to_json_message(plaintext, persist=persist)
+        message["head"]["message_type"] = ResponseType.X3DH_SESSION_START
+        message["head"]["x3dh"] = x3dh
+        message["head"]["reciever"] = self.contact
+        return message
+
+    """
+    File transfer:
+
+    First message is the offer, an ordinary ratchet message (with
+    n and pn) with encrypted file metadata. The key of the file
+    is derived from its message key. Next messages carry the file
+    chunks encrypted with the file key (see file_stream):
+
+    {
+        "head" : {
+            "message_type" : FILE_TRANSFER
+            "sender" : "user123"
+            "transfer_id" : "9f3a..."
+            "chunk" : 0
+            "last" : false
+        },
+        "body" : {
+            "content" : b64 encrypted chunk
+        }
+    }
+    """
+
+    def encrypt_file_to_json_messages(
+        self,
+        source: BinaryIO,
+        file_name: str,
+        /,
+        chunk_size: int = FILE_CHUNK_SIZE,
+        persist: bool = True,
+    ) -> Iterator[dict]:
+        """
+        Offer message followed by the messages with the chunks.
+        It is a generator: the file is read one chunk at a time,
+        while the messages are being send. The ratchets are turned
+        when the offer is taken
+        """
+        self._apply_pending_rotation()
+        number = self.get_ratchet_set().send_count
+        root_key, chain_key = self._sending_keys()
+        transfer_id = os.urandom(16).hex()
+        encryptor = StreamEncryptor(
+            derive_file_key(root_key + chain_key),
+            additional_data=transfer_id.encode(PREFFERED_ENCODING),
+            suite=self.cipher_suite,
+        )
+        metadata = {
+            "name": file_name,
+            "chunk_size": chunk_size,
+            "nonce_prefix": binascii.b2a_base64(
+                encryptor.nonce_prefix, newline=False
+            ).decode(PREFFERED_ENCODING),
+        }
+        offer = aead_encrypt(
+            root_key,
+            json.dumps(metadata).encode(PREFFERED_ENCODING),
+            chain_key,
+            suite=self.cipher_suite,
+        )
+        if persist:
+            self.save_state()
+
+        yield {
+            "head": {
+                **self._message_head(ResponseType.FILE_TRANSFER, number),
+                "transfer_id": transfer_id,
+            },
+            "body": {
+                "content": binascii.b2a_base64(offer),
+                "public_key": create_b64_from_public_key(
+                    self.get_dh_public_key()
+                ),
+            },
+        }
+
+        for index, (chunk, last) in enumerate(
+            encrypt_file(encryptor, source, chunk_size)
+        ):
+            yield {
+                "head": {
+                    "message_type": ResponseType.FILE_TRANSFER,
+                    "sender": self.user_state.login,
+                    "transfer_id": transfer_id,
+                    "chunk": index,
+                    "last": last,
+                },
+                "body": {"content": binascii.b2a_base64(chunk)},
+            }
+
+    def open_file_transfer(
+        self, message: dict, /, persist: bool = True
+    ) -> Tuple[dict, StreamDecryptor]:
+        """
+        Decrypt the offer of the file. Returns file metadata and the
+        decryptor for its chunks, see decrypt_file_chunk
+        """
+        header = message["head"]
+        body = message["body"]
+        self._check_sender(header)
+
+        if header["message_type"] != ResponseType.FILE_TRANSFER:
+            raise CryptoControllerException("It is not a file transfer!")
+
+        suite = self._cipher_suite(header["cipher_suite"])
+        self._check_cipher_suite(suite)
+        decrypted, root_key, chain_key = self._open_numbered(
+            binascii.a2b_base64(body["content"]),
+            binascii.a2b_base64(body["public_key"]),
+            header["n"],
+            header["pn"],
+            suite,
+        )
+        self._agree_cipher_suite(suite)
+        metadata = json.loads(decrypted)
+        decryptor = StreamDecryptor(
+            derive_file_key(root_key + chain_key),
+            binascii.a2b_base64(metadata["nonce_prefix"]),
+            additional_data=header["transfer_id"].encode(PREFFERED_ENCODING),
+            suite=suite,
+        )
+        if persist:
+            self.save_state()
+        return metadata, decryptor
+
+    @staticmethod
+    def decrypt_file_chunk(message: dict, decryptor: StreamDecryptor) -> bytes:
+        try:
+            return decryptor.decrypt_chunk(
+                binascii.a2b_base64(message["body"]["content"]),
+                message["head"]["last"],
+                index=message["head"]["chunk"],
+            )
+        except FileStreamException as e:
+            raise CryptoControllerException(str(e))
+
+    def encrypt_many(self, plaintexts: Iterable[str]) -> List[dict]:
+        """
+        Encrypt a batch of messages for the contact. Ratchets are
+        saved once after the whole batch rather than per message
+        """
+        messages = self._encrypt_batch(plaintexts)
+        if messages:
+            self.save_state()
+        return messages
+
+    def decrypt_many(self, messages: Iterable[dict]) -> List[str]:
+        """
+        Decrypt a batch of messages from the contact, in any order.
+        Ratchets are saved once. When one of the messages fails to
+        decrypt the session is as it was before it (see decrypt),
+        what the previous messages did is saved and the exception
+        is raised. Nothing is saved when nothing was decrypted
+        """
+        decrypted: List[str] = []
+        try:
+            self._decrypt_batch(messages, decrypted)
+        finally:
+            if decrypted:
+                self.save_state()
+        return decrypted
+
+    def _encrypt_batch(self, plaintexts: Iterable[str]) -> List[dict]:
+        return [
+            self.encrypt_to_json_message(plaintext, persist=False)
+            for plaintext in plaintexts
+        ]
+
+    def _decrypt_batch(
+        self, messages: Iterable[dict], decrypted: List[str]
+    ) -> None:
+        """Appends to decrypted, so the caller knows how far it got"""
+        for message in messages:
+            decrypted.append(
+                self.decrypt_json_message(message, persist=False)
+            )
+
+    """
+    Async versions of the operations above. The crypto runs on the
+    crypto thread pool and the database is touched only here, on the
+    event loop thread (sqlite connection cannot change its thread).
+    The session lock keeps the operations of this chat in the order
+    they were called, ratchets are never turned by two threads at once
+    """
+
+    @property
+    def session_lock(self) -> asyncio.Lock:
+        if self._session_lock is None:
+            self._session_lock = asyncio.Lock()
+        return self._session_lock
+
+    async def rotate_dh_ratchet_async(self, public_key: X25519PublicKey):
+        async with self.session_lock:
+            await run_in_crypto_executor(self.rotate_dh_ratchet, public_key)
+
+    async def refill_key_windows_async(self) -> None:
+        async with self.session_lock:
+            await run_in_crypto_executor(self.refill_key_windows)
+
+    async def encrypt_to_json_message_async(
+        self, plaintext: str, /, persist: bool = True
+    ) -> dict:
+        async with self.session_lock:
+            message = await run_in_crypto_executor(
+                self.encrypt_to_json_message, plaintext, persist=False
+            )
+            if persist:
+                self.save_state()
+        await self.settle_state()
+        return message
+
+    async def decrypt_json_message_async(
+        self, message: dict, /, persist: bool = True
+    ) -> str:
+        async with self.session_lock:
+            decrypted = await run_in_crypto_executor(
+                self.decrypt_json_message, message, persist=False
+            )
+            if persist:
+                self.save_state()
+        return decrypted
+
+    async def open_file_transfer_async(
+        self, message: dict, /, persist: bool = True
+    ) -> Tuple[dict, StreamDecryptor]:
+        async with self.session_lock:
+            result = await run_in_crypto_executor(
+                self.open_file_transfer, message, persist=False
+            )
+            if persist:
+                self.save_state()
+        return result
+
+    async def encrypt_many_async(
+        self, plaintexts: Iterable[str]
+    ) -> List[dict]:
+        async with self.session_lock:
+            messages = await run_in_crypto_executor(
+                self._encrypt_batch, list(plaintexts)
+            )
+            if messages:
+                self.save_state()
+        await self.settle_state()
+        return messages
+
+    async def decrypt_many_async(self, messages: Iterable[dict]) -> List[str]:
+        decrypted: List[str] = []
+        async with self.session_lock:
+            try:
+                await run_in_crypto_executor(
+                    self._decrypt_batch, list(messages), decrypted
+                )
+            finally:
+                if decrypted:
+                    self.save_state()
+        return decrypted
+
+    def save_state(self) -> None:
+        """Persist ratchets and the keys of skipped messages"""
         assert (
             self.my_turn is not None
         ), "You should crearly define who's turn is present"
-        if self.db_controller is not None:
-            self.db_controller.save_ratchets(
+        if self.db_controller is None:
+            return
+        if self.write_behind is not None:
+            self.write_behind.mark_dirty(self)
+            return
+        self.write_state()
+
+    async def settle_state(self) -> None:
+        """
+        Wait for the ratchets saved in the background. Encrypted
+        messages must not be send before their keys are on disk
+        """
+        if self.write_behind is not None:
+            await self.write_behind.settled()
+
+    def write_state(self) -> None:
+        """save_state which always goes to the database right away"""
+        assert (
+            self.my_turn is not None
+        ), "You should crearly define who's turn is present"
+        if self.db_controller is None:
+            return
+
+        self.db_controller.save_ratchets(
+            self.user_state,
+            self.contact,
+            self.get_ratchet_set(),
+            self.my_turn,
+        )
+        if self.skipped_keys.dirty:
+            self.db_controller.update_skipped_keys(
                 self.user_state,
                 self.contact,
-                self.get_ratchet_set(),
-                self.my_turn,
+                *self.skipped_keys.take_changes(),
             )
 
-        return msg_to_send
-
-    def decrypt_json_message(self, message: dict) -> str:
-        header = message["head"]
-        body = message["body"]
-
+    def _check_sender(self, header: dict) -> None:
         if header["sender"] != self.contact:
             raise CryptoControllerException(
                 f"Wrong contact! I thought that I was communicating "
                 f"with {self.contact} and not {header['sender']}"
             )
 
-        if header["message_type"] == ResponseType.TEXT_MESSAGE:
+    @staticmethod
+    def _cipher_suite(value: int) -> CipherSuite:
+        """Suite from the header, the contact can send anything there"""
+        try:
+            return CipherSuite(value)
+        except ValueError:
+            raise CryptoControllerException(f"Unknown cipher suite {value}")
+
+    def _check_cipher_suite(self, suite: CipherSuite) -> None:
+        """
+        Once agreed the suite does not change. Until the contact
+        answers with the agreed suite, its messages can still use
+        the suite they were send with before
+        """
+        r_set = self.get_ratchet_set()
+        if r_set.cipher_suite is not None and suite not in (
+            r_set.cipher_suite,
+            r_set.contact_suite,
+        ):
+            raise CryptoControllerException(
+                f"Cipher suite {suite.name} is not the one of the session "
+                f"({r_set.cipher_suite.name})"
+            )
+
+    def _agree_cipher_suite(self, suite: CipherSuite) -> None:
+        """Suite of the authentic message of the contact"""
+        r_set = self.get_ratchet_set()
+        if r_set.cipher_suite is None:
+            r_set.cipher_suite = agree_cipher_suite(
+                self.preferred_suite, suite
+            )
+            r_set.contact_suite = suite
+        elif suite is r_set.cipher_suite:
+            # the contact agreed too, it can not go back
+            r_set.contact_suite = suite
+
+    def decrypt_json_message(
+        self, message: dict, /, persist: bool = True
+    ) -> str:
+        header = message["head"]
+        body = message["body"]
+        self._check_sender(header)
+
+        if header["message_type"] not in (
+            ResponseType.TEXT_MESSAGE,
+            ResponseType.BROADCAST_MESSAGE,
+            ResponseType.X3DH_SESSION_START,
+        ):
+            raise NotImplementedError(
+                "I do not know what to do with this type of message"
+            )
+
+        decr_msg = self._decrypt_ratchet_message(header, body, persist)
+        if header["message_type"] == ResponseType.BROADCAST_MESSAGE:
+            decr_msg = self._open_broadcast_payload(decr_msg, header, body)
+        if header.get("compressed"):
+            try:
+                decr_msg = self.compressor.decompress(decr_msg)
+            except CompressionException as e:
+                raise CryptoControllerException(str(e))
+            # contact can read them too, with the same dictionary
+            self.compress_messages = True
+        return decr_msg.decode(PREFFERED_ENCODING)
+
+    def _decrypt_ratchet_message(
+        self, header: dict, body: dict, persist: bool
+    ) -> bytes:
+        # messages without the suite come from the older clients
+        suite = self._cipher_suite(
+            header.get("cipher_suite", CipherSuite.AES_GCM.value)
+        )
+        self._check_cipher_suite(suite)
+        content = binascii.a2b_base64(body["content"])
+        if "n" in header:
+            decr_msg = self.decrypt_numbered(
+                content,
+                binascii.a2b_base64(body["public_key"]),
+                header["n"],
+                header["pn"],
+                suite=suite,
+            )
+        else:
+            # older clients send only in order, without numbers
             decr_msg = self.decrypt(
-                binascii.a2b_base64(body["content"]),
+                content,
                 public_key=create_public_key_from_b64(body["public_key"])
                 if self.my_turn
                 else None,
+                suite=suite,
             )
-            assert (
-                self.my_turn is not None
-            ), "You should crearly define who's turn is present"
-            if self.db_controller is not None:
-                self.db_controller.save_ratchets(
-                    self.user_state,
-                    self.contact,
-                    self.get_ratchet_set(),
-                    self.my_turn,
-                )
-            return decr_msg.decode(PREFFERED_ENCODING)
-        else:
-            raise NotImplementedError(
-                "I do not know what to do with this type of message"
+        self._agree_cipher_suite(suite)
+        if persist:
+            self.save_state()
+        return decr_msg
+
+    """
+    Control messages are ratchet messages which are not shown to the
+    user, their content is encrypted json (like the sender keys of
+    the groups)
+    """
+
+    def encrypt_control_message(
+        self, message_type: ResponseType, data: dict, /, persist: bool = True
+    ) -> dict:
+        self._apply_pending_rotation()
+        number = self.get_ratchet_set().send_count
+        encrypted = self.encrypt(json.dumps(data).encode(PREFFERED_ENCODING))
+        msg_to_send = {
+            "head": self._message_head(message_type, number),
+            "body": {
+                "content": binascii.b2a_base64(encrypted),
+                "public_key": create_b64_from_public_key(
+                    self.get_dh_public_key()
+                ),
+            },
+        }
+        if persist:
+            self.save_state()
+        return msg_to_send
+
+    def decrypt_control_message(
+        self, message: dict, /, persist: bool = True
+    ) -> dict:
+        header = message["head"]
+        self._check_sender(header)
+        if header["message_type"] not in CONTROL_MESSAGE_TYPES:
+            raise CryptoControllerException(
+                f"{header['message_type']} is not a control message!"
             )
+        return json.loads(
+            self._decrypt_ratchet_message(header, message["body"], persist)
+        )
+
+    """
+    Broadcast message is the ratchet message like the text one but
+    its content is only the key of the payload and the hash of the
+    payload. The payload is encrypted once for all recievers:
+
+    {
+        "head" : {
+            "message_type" : BROADCAST_MESSAGE
+            ... the same as in the text message
+            "reciever" : "user321"
+            "payload_suite" : 1
+        },
+        "body" : {
+            "content" : b64 encrypted payload key + payload hash
+            "public_key" : b64 key
+            "payload" : b64 encrypted payload, the same for everyone
+        }
+    }
+    """
+
+    def wrap_broadcast_key(
+        self, key_material: bytes, /, persist: bool = True
+    ) -> dict:
+        """Ratchet message with the key of the broadcast, see broadcast"""
+        self._apply_pending_rotation()
+        number = self.get_ratchet_set().send_count
+        wrapped = self.encrypt(key_material)
+        msg_to_send = {
+            "head": {
+                **self._message_head(ResponseType.BROADCAST_MESSAGE, number),
+                "reciever": self.contact,
+            },
+            "body": {
+                "content": binascii.b2a_base64(wrapped),
+                "public_key": create_b64_from_public_key(
+                    self.get_dh_public_key()
+                ),
+            },
+        }
+        if persist:
+            self.save_state()
+        return msg_to_send
+
+    @staticmethod
+    def _open_broadcast_payload(
+        key_material: bytes, header: dict, body: dict
+    ) -> bytes:
+        content_key = key_material[:SHARED_KEY_LENGTH]
+        payload_hash = key_material[SHARED_KEY_LENGTH:]
+        payload = binascii.a2b_base64(body["payload"])
+
+        # every reciever knows the payload key, so without the hash
+        # one of them could swap the payload send to the others
+        if not hmac.compare_digest(
+            hashlib.sha256(payload).digest(), payload_hash
+        ):
+            raise CryptoControllerException(
+                "Broadcast payload was changed on its way!"
+            )
+        suite = CryptoController._cipher_suite(header["payload_suite"])
+        try:
+            return aead_decrypt(content_key, payload, suite=suite)
+        except InvalidTag:
+            raise CryptoControllerException("Broken broadcast payload!")
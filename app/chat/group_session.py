@@ -0,0 +1,369 @@
+from .crypto_controller import CryptoController
+from .session_manager import session_manager
+from .crypto.sender_keys import SenderKeyException, SenderKeyState
+from .crypto.crypto_utils import (
+    aead_decrypt,
+    aead_encrypt,
+    preferred_cipher_suite,
+)
+from .crypto.compression import (
+    CompressionException,
+    MessageCompressor,
+    default_compressor,
+)
+from cryptography.exceptions import InvalidTag
+from app.api.api_controller import ApiController
+from app.api.response_type import ResponseType
+from app.database.db_controller import DatabaseController
+from app.user.user_state import UserState
+from app.config import CipherSuite, COMPRESSION_ENABLED, PREFFERED_ENCODING
+from typing import Dict, Iterable, List, Optional, Sequence
+from time import time
+import binascii
+import os
+import struct
+
+
+class GroupSessionException(Exception):
+    ...
+
+
+def _signed_data(
+    group_id: str, sender: str, iteration: int, content: bytes
+) -> bytes:
+    # everything the reciever acts on is covered by the signature
+    return b"\x00".join(
+        (
+            group_id.encode(PREFFERED_ENCODING),
+            sender.encode(PREFFERED_ENCODING),
+            struct.pack(">I", iteration),
+            content,
+        )
+    )
+
+
+class GroupSession:
+    """
+    Group conversation with the Sender Keys (like in signal).
+    Every member has its own sender chain and sends it to the others
+    once, over the pairwise ratchets. Then every group message is
+    encrypted (and signed) only once with the next key of the chain
+    and the server gives the same message to every member, so sending
+    does not depend on the size of the group.
+
+    Removing a member changes our chain, the removed member still
+    knows the old one
+    """
+
+    def __init__(
+        self,
+        user_state: UserState,
+        group_id: str,
+        name: str,
+        sender_keys: Dict[str, Optional[SenderKeyState]],
+        db_controller: DatabaseController,
+        /,
+        compressor: Optional[MessageCompressor] = None,
+    ) -> None:
+        self.user_state = user_state
+        self.group_id = group_id
+        self.name = name
+        # member -> sender key, None until the member sends us its key
+        self.sender_keys = sender_keys
+        self.db_controller = db_controller
+        self.compressor = (
+            compressor if compressor is not None else default_compressor()
+        )
+
+    @classmethod
+    def create(
+        cls,
+        user_state: UserState,
+        name: str,
+        members: Iterable[str],
+        db_controller: DatabaseController,
+        /,
+        group_id: Optional[str] = None,
+    ) -> "GroupSession":
+        """New group with our fresh sender key"""
+        group_id = group_id if group_id is not None else os.urandom(16).hex()
+        members = [
+            member for member in members if member != user_state.login
+        ]
+        db_controller.create_group(user_state, group_id, name, members)
+
+        session = cls(
+            user_state,
+            group_id,
+            name,
+            dict.fromkeys(members),
+            db_controller,
+        )
+        session.sender_keys[user_state.login] = SenderKeyState.generate()
+        session.save_sender_key(user_state.login)
+        return session
+
+    @classmethod
+    def load(
+        cls,
+        user_state: UserState,
+        group_id: str,
+        db_controller: DatabaseController,
+    ) -> "GroupSession":
+        if not db_controller.group_exists(user_state, group_id):
+            raise GroupSessionException(f"Unknown group {group_id}")
+        name = db_controller.get_group_name(user_state, group_id)
+        sender_keys = {
+            member: SenderKeyState.from_bytes(record)
+            if record is not None
+            else None
+            for member, record in db_controller.load_sender_keys(
+                user_state, group_id
+            ).items()
+        }
+        return cls(user_state, group_id, name, sender_keys, db_controller)
+
+    @property
+    def members(self) -> List[str]:
+        """Other members of the group"""
+        return [
+            member
+            for member in self.sender_keys
+            if member != self.user_state.login
+        ]
+
+    @property
+    def my_sender_key(self) -> SenderKeyState:
+        sender_key = self.sender_keys.get(self.user_state.login)
+        if sender_key is None:
+            raise GroupSessionException(
+                f"No sender key of our own in the group {self.name}"
+            )
+        return sender_key
+
+    def save_sender_key(self, member: str) -> None:
+        sender_key = self.sender_keys[member]
+        self.db_controller.save_sender_key(
+            self.user_state,
+            self.group_id,
+            member,
+            sender_key.to_bytes() if sender_key is not None else None,
+        )
+
+    """
+    Sender keys are send as control messages over the pairwise ratchets
+    """
+
+    def sender_key_distribution(
+        self, sessions: Sequence[CryptoController], /, persist: bool = True
+    ) -> List[dict]:
+        """Our sender key for every given pairwise session"""
+        data = {
+            "group_id": self.group_id,
+            "name": self.name,
+            "members": [self.user_state.login, *self.members],
+            **self.my_sender_key.distribution(),
+        }
+        messages = []
+        for session in sessions:
+            if session.contact not in self.sender_keys:
+                raise GroupSessionException(
+                    f"{session.contact} is not in the group {self.name}"
+                )
+            message = session.encrypt_control_message(
+                ResponseType.SENDER_KEY_DISTRIBUTION, data, persist=persist
+            )
+            message["head"]["reciever"] = session.contact
+            messages.append(message)
+        return messages
+
+    def accept_sender_key(self, member: str, distribution: dict) -> None:
+        if distribution["group_id"] != self.group_id:
+            raise GroupSessionException("Sender key of another group!")
+        if member not in self.sender_keys or member == self.user_state.login:
+            raise GroupSessionException(
+                f"{member} is not in the group {self.name}"
+            )
+        self.sender_keys[member] = SenderKeyState.from_distribution(
+            distribution
+        )
+        self.save_sender_key(member)
+
+    @classmethod
+    def accept_distribution(
+        cls,
+        session: CryptoController,
+        message: dict,
+        db_controller: DatabaseController,
+    ) -> "GroupSession":
+        """
+        Decrypt the sender key send by the contact. Group we do not
+        know yet is created (with our own sender key, which still has
+        to be distributed)
+        """
+        distribution = session.decrypt_control_message(message)
+        group_id = distribution["group_id"]
+        if db_controller.group_exists(session.user_state, group_id):
+            group = cls.load(session.user_state, group_id, db_controller)
+        else:
+            group = cls.create(
+                session.user_state,
+                distribution["name"],
+                distribution["members"],
+                db_controller,
+                group_id=group_id,
+            )
+        group.accept_sender_key(session.contact, distribution)
+        return group
+
+    """
+    Group messages
+    """
+
+    def encrypt_group_message(self, plaintext: str) -> dict:
+        """One message for the whole group"""
+        sender_key = self.my_sender_key
+        payload = plaintext.encode(PREFFERED_ENCODING)
+        compressed = (
+            self.compressor.compress(payload) if COMPRESSION_ENABLED else None
+        )
+        suite = preferred_cipher_suite()
+
+        iteration, message_key = sender_key.sending_key()
+        encrypted = aead_encrypt(
+            message_key,
+            compressed if compressed is not None else payload,
+            suite=suite,
+        )
+        signature = sender_key.sign(
+            _signed_data(
+                self.group_id, self.user_state.login, iteration, encrypted
+            )
+        )
+        self.save_sender_key(self.user_state.login)
+
+        return {
+            "head": {
+                "message_type": ResponseType.GROUP_MESSAGE,
+                "sender": self.user_state.login,
+                "group_id": self.group_id,
+                "posix_time_send": int(time()),
+                "cipher_suite": suite.value,
+                "compressed": compressed is not None,
+                "iteration": iteration,
+            },
+            "body": {
+                "content": binascii.b2a_base64(encrypted),
+                "signature": binascii.b2a_base64(signature),
+            },
+        }
+
+    def decrypt_group_message(self, message: dict) -> str:
+        header, body = message["head"], message["body"]
+        if header["message_type"] != ResponseType.GROUP_MESSAGE:
+            raise GroupSessionException("It is not a group message!")
+        if header["group_id"] != self.group_id:
+            raise GroupSessionException("Message of another group!")
+
+        sender = header["sender"]
+        sender_key = self.sender_keys.get(sender)
+        if sender_key is None:
+            raise GroupSessionException(
+                f"We do not have the sender key of {sender}"
+            )
+
+        try:
+            suite = CipherSuite(header["cipher_suite"])
+        except ValueError:
+            raise GroupSessionException(
+                f"Unknown cipher suite {header['cipher_suite']}"
+            )
+
+        encrypted = binascii.a2b_base64(body["content"])
+        try:
+            # checked before the chain is turned, so the forged
+            # messages cannot use up the keys
+            sender_key.verify(
+                binascii.a2b_base64(body["signature"]),
+                _signed_data(
+                    self.group_id, sender, header["iteration"], encrypted
+                ),
+            )
+            message_key = sender_key.message_key(header["iteration"])
+        except SenderKeyException as e:
+            raise GroupSessionException(str(e))
+
+        try:
+            decrypted = aead_decrypt(message_key, encrypted, suite=suite)
+        except InvalidTag:
+            raise GroupSessionException("Broken group message!")
+        self.save_sender_key(sender)
+
+        if header.get("compressed"):
+            try:
+                decrypted = self.compressor.decompress(decrypted)
+            except CompressionException as e:
+                raise GroupSessionException(str(e))
+        return decrypted.decode(PREFFERED_ENCODING)
+
+    def remove_member(self, member: str) -> None:
+        """
+        Drop the member and start a new sender chain. The new chain
+        has to be distributed to the members who are left, see
+        remove_group_member
+        """
+        if member not in self.sender_keys or member == self.user_state.login:
+            raise GroupSessionException(
+                f"{member} is not in the group {self.name}"
+            )
+        del self.sender_keys[member]
+        self.db_controller.remove_group_member(
+            self.user_state, self.group_id, member
+        )
+        self.sender_keys[self.user_state.login] = SenderKeyState.generate()
+        self.save_sender_key(self.user_state.login)
+
+
+async def distribute_sender_key(
+    api_controller: ApiController,
+    group: GroupSession,
+    /,
+    members: Optional[Iterable[str]] = None,
+) -> None:
+    """Send our sender key to the members (all of them by default)"""
+    members = list(members if members is not None else group.members)
+    # the first ones are not evicted while the rest is loaded
+    sessions = [
+        session_manager.acquire(
+            api_controller.user_state,
+            member,
+            DB_PATH=api_controller.db_path,
+        )
+        for member in members
+    ]
+    messages = []
+    try:
+        for session in sessions:
+            async with session.session_lock:
+                messages += group.sender_key_distribution([session])
+        for session in sessions:
+            await session.settle_state()
+    finally:
+        for member in members:
+            session_manager.release(api_controller.user_state.login, member)
+    await api_controller.send_messages(messages)
+
+
+async def remove_group_member(
+    api_controller: ApiController, group: GroupSession, member: str
+) -> None:
+    """Remove the member and send our new sender key to the rest"""
+    group.remove_member(member)
+    await distribute_sender_key(api_controller, group)
+
+
+async def send_group_message(
+    api_controller: ApiController, group: GroupSession, plaintext: str
+) -> None:
+    message = group.encrypt_group_message(plaintext)
+    await api_controller.send_group_message(group.members, message)
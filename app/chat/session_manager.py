@@ -0,0 +1,279 @@
+from cryptography.hazmat.primitives.asymmetric.x25519 import (
+    X25519PrivateKey,
+    X25519PublicKey,
+)
+from .crypto_controller import CryptoController
+from .crypto.ratchet_set import RatchetSetException
+from .crypto.session_store import SessionStore
+from .crypto.skipped_keys import SkippedKeyStore
+from .write_behind import WriteBehindStore
+from app.database.async_db import database_thread
+from app.user.user_state import UserState
+from app.config import (
+    DEFAULT_DB_PATH,
+    SESSION_CACHE_SIZE,
+    WRITE_BEHIND_ENABLED,
+)
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import threading
+
+SessionKey = Tuple[str, str]
+
+
+class SessionManager:
+    """
+    Live crypto sessions shared by the whole app. Every chat view,
+    the invite approval and the background recievers get the same
+    CryptoController for the same (owner, contact), so the ratchets
+    are loaded from the database only once.
+
+    At most max_sessions are kept, the least recently used session
+    is saved to the database when there is no more room. Sessions
+    acquired by someone (the open chat for example) are never
+    evicted, till they are released. Ratchets of the evicted session
+    are parked in the SessionStore (a few hundred bytes instead of
+    the whole object graph) together with its skipped keys, so getting
+    it back later does not read them from the database again. The
+    database could be still behind then, its save can wait on the
+    database thread.
+
+    With the write_behind store the sessions save their ratchets in
+    batches (see WriteBehindStore), flush and clear write them out
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = SESSION_CACHE_SIZE,
+        write_behind: Optional[WriteBehindStore] = None,
+    ) -> None:
+        self.max_sessions = max_sessions
+        self.write_behind = write_behind
+        self.hits = 0
+        self.misses = 0
+        self._sessions: "OrderedDict[SessionKey, CryptoController]"
+        self._sessions = OrderedDict()
+        # evicted sessions, the same as saved in their database (once
+        # the release is written), with the path and skipped keys
+        self._parked = SessionStore()
+        self._parked_paths: Dict[SessionKey, Tuple[str, SkippedKeyStore]]
+        self._parked_paths = {}
+        # number of acquire calls not released yet
+        self._holders: Dict[SessionKey, int] = {}
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, key: SessionKey) -> bool:
+        return key in self._sessions
+
+    def get(
+        self,
+        user_state: UserState,
+        contact: str,
+        /,
+        DB_PATH: str = DEFAULT_DB_PATH,
+    ) -> CryptoController:
+        """Session with ratchets loaded from the database on the miss"""
+        key = (user_state.login, contact)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None:
+                self._sessions.move_to_end(key)
+                self.hits += 1
+                return session
+
+            self.misses += 1
+            session = CryptoController(user_state, contact, DB_PATH=DB_PATH)
+            session.write_behind = self.write_behind
+            db_path, skipped_keys = self._parked_paths.pop(
+                key, (None, None)
+            )
+            if db_path == DB_PATH:
+                session.restore_ratchets(
+                    *self._parked.get(key), skipped_keys=skipped_keys
+                )
+            else:
+                session.init_ratchets()
+            self._parked.remove(key)
+            self._insert(key, session)
+            return session
+
+    async def get_async(
+        self,
+        user_state: UserState,
+        contact: str,
+        /,
+        DB_PATH: str = DEFAULT_DB_PATH,
+    ) -> CryptoController:
+        """get with the ratchets loaded on the database thread"""
+        with self._lock:
+            session = self._sessions.get((user_state.login, contact))
+        if session is not None:
+            return self.get(user_state, contact, DB_PATH=DB_PATH)
+        return await database_thread.run(
+            self.get, user_state, contact, DB_PATH=DB_PATH
+        )
+
+    def acquire(
+        self,
+        user_state: UserState,
+        contact: str,
+        /,
+        DB_PATH: str = DEFAULT_DB_PATH,
+    ) -> CryptoController:
+        """
+        get, and the session is not evicted till the release. Used by
+        everyone who keeps the session for longer than one call. The
+        evicted session comes back as a new object, and two objects
+        would advance the same chains
+        """
+        key = (user_state.login, contact)
+        with self._lock:
+            session = self.get(user_state, contact, DB_PATH=DB_PATH)
+            self._holders[key] = self._holders.get(key, 0) + 1
+            return session
+
+    async def acquire_async(
+        self,
+        user_state: UserState,
+        contact: str,
+        /,
+        DB_PATH: str = DEFAULT_DB_PATH,
+    ) -> CryptoController:
+        """acquire with the ratchets loaded on the database thread"""
+        with self._lock:
+            session = self._sessions.get((user_state.login, contact))
+        if session is not None:
+            return self.acquire(user_state, contact, DB_PATH=DB_PATH)
+        return await database_thread.run(
+            self.acquire, user_state, contact, DB_PATH=DB_PATH
+        )
+
+    def release(self, owner: str, contact: str) -> None:
+        """The session got from acquire is not used anymore"""
+        key = (owner, contact)
+        with self._lock:
+            holders = self._holders.get(key, 0) - 1
+            if holders > 0:
+                self._holders[key] = holders
+                return
+            self._holders.pop(key, None)
+            self._evict()
+
+    def init_session(
+        self,
+        user_state: UserState,
+        contact: str,
+        /,
+        DB_PATH: str = DEFAULT_DB_PATH,
+        opt_public_key: Optional[X25519PublicKey] = None,
+        opt_private_key: Optional[X25519PrivateKey] = None,
+    ) -> CryptoController:
+        """
+        Create ratchets of the freshly added contact. Session left
+        from the previous contact with the same login is replaced
+        """
+        key = (user_state.login, contact)
+        with self._lock:
+            self._drop(key)
+            session = CryptoController(user_state, contact, DB_PATH=DB_PATH)
+            session.write_behind = self.write_behind
+            session.init_ratchets(
+                opt_public_key=opt_public_key,
+                opt_private_key=opt_private_key,
+            )
+            self._insert(key, session)
+            return session
+
+    def invalidate(self, owner: str, contact: str) -> None:
+        """
+        Drop the session WITHOUT saving it, for example when the
+        contact was removed or its ratchets were changed elsewhere
+        """
+        with self._lock:
+            self._drop((owner, contact))
+
+    def flush(self, owner: Optional[str] = None) -> None:
+        """Save the sessions (of the given owner or all of them)"""
+        if self.write_behind is not None:
+            self.write_behind.flush(owner=owner, final=True)
+            return
+        with self._lock:
+            sessions: List[CryptoController] = [
+                session
+                for (session_owner, _), session in self._sessions.items()
+                if owner is None or session_owner == owner
+            ]
+        for session in sessions:
+            session.save_state()
+
+    def clear(self) -> None:
+        """Save and drop every session"""
+        self.flush()
+        with self._lock:
+            self._sessions.clear()
+            for key in self._parked_paths:
+                self._parked.remove(key)
+            self._parked_paths.clear()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+    def _drop(self, key: SessionKey) -> None:
+        self._parked_paths.pop(key, None)
+        self._parked.remove(key)
+        session = self._sessions.pop(key, None)
+        if session is not None and self.write_behind is not None:
+            self.write_behind.forget(session)
+
+    def _insert(self, key: SessionKey, session: CryptoController) -> None:
+        self._sessions[key] = session
+        self._evict(keep=key)
+
+    def _evict(self, keep: Optional[SessionKey] = None) -> None:
+        excess = len(self._sessions) - self.max_sessions
+        if excess <= 0:
+            return
+        # acquired session or the one in the middle of the operation
+        # is not saved nor dropped, there can be more of them for a while
+        evicted = []
+        for evicted_key, candidate in self._sessions.items():
+            if len(evicted) == excess:
+                break
+            if evicted_key != keep and not self._in_use(
+                evicted_key, candidate
+            ):
+                evicted.append((evicted_key, candidate))
+        for evicted_key, candidate in evicted:
+            del self._sessions[evicted_key]
+            if self.write_behind is not None:
+                self.write_behind.release(candidate)
+            else:
+                candidate.save_state()
+            self._park(evicted_key, candidate)
+
+    def _in_use(self, key: SessionKey, session: CryptoController) -> bool:
+        if key in self._holders:
+            return True
+        lock = session._session_lock
+        return lock is not None and lock.locked()
+
+    def _park(self, key: SessionKey, session: CryptoController) -> None:
+        try:
+            self._parked.put(key, session.get_ratchet_set(), session.my_turn)
+        except RatchetSetException:
+            # not complete yet, it is loaded from the database again
+            return
+        self._parked_paths[key] = (session.db_path, session.skipped_keys)
+
+
+session_manager = SessionManager(
+    write_behind=(
+        WriteBehindStore(database_thread=database_thread)
+        if WRITE_BEHIND_ENABLED
+        else None
+    )
+)
@@ -0,0 +1,286 @@
+from .crypto_controller import CryptoController
+from app.chat.crypto.ratchet_set import RatchetSet, RatchetSetException
+from app.database.async_db import DatabaseThread
+from app.config import (
+    WRITE_BEHIND_INTERVAL,
+    WRITE_BEHIND_MAX_UPDATES,
+)
+from collections import defaultdict
+from concurrent.futures import Future
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+import asyncio
+import threading
+import time
+
+SessionKey = Tuple[str, str, str]
+
+
+def reserved_snapshot(
+    ratchet_set: RatchetSet, my_turn: bool, reserve: int
+) -> Tuple[bytes, int]:
+    """
+    Snapshot with the sending chain moved reserve keys ahead, with
+    the message number it was moved to. Session restored from it
+    after the crash never sends with the keys used since the last
+    flush, contact sees only a gap in the numbers
+    """
+    reserved, _ = RatchetSet.from_bytes(ratchet_set.to_bytes(my_turn))
+    try:
+        send_ratchet = reserved.send_ratchet
+    except RatchetSetException:
+        # nothing was send yet, nothing to protect
+        return reserved.to_bytes(my_turn), reserved.send_count
+    for _ in range(reserve):
+        send_ratchet.turn()
+    reserved.send_count += reserve
+    return reserved.to_bytes(my_turn), reserved.send_count
+
+
+class FlushedState:
+    """What the database holds for the session since its last flush"""
+
+    __slots__ = ("session", "dh_ratchet", "remote_dh_key", "send_limit")
+
+    def __init__(
+        self,
+        session: CryptoController,
+        ratchet_set: RatchetSet,
+        send_limit: int,
+    ) -> None:
+        self.session = session
+        # key objects are replaced (never changed) by the dh step
+        self.dh_ratchet = ratchet_set.dh_ratchet
+        self.remote_dh_key = ratchet_set.remote_dh_key
+        # first message number which key is not reserved
+        self.send_limit = send_limit
+
+    def is_behind(self, ratchet_set: RatchetSet) -> bool:
+        """Session can not be restored from the database anymore"""
+        return (
+            self.dh_ratchet is not ratchet_set.dh_ratchet
+            or self.remote_dh_key != ratchet_set.remote_dh_key
+            or ratchet_set.send_count > self.send_limit
+        )
+
+    def is_ahead(self) -> bool:
+        """Sending chain in the database has keys reserved ahead"""
+        return self.send_limit > self.session.get_ratchet_set().send_count
+
+
+class WriteBehindStore:
+    """
+    Sessions changed since the last flush. They are saved together,
+    in a single transaction per database, when max_updates changes
+    were made or interval seconds passed since the first of them.
+    Sessions are also flushed on the app exit (see SessionManager).
+
+    After the crash the changes since the last flush are lost:
+        * recieving chains go back, the messages recieved meantime
+          could be decrypted again if they are delivered again
+        * sending chains are saved max_updates keys ahead, so no key
+          is ever used twice (see reserved_snapshot). Session which
+          used up its reserved keys is flushed right away
+        * dh ratchet steps are flushed right away, without them the
+          contact would not be able to talk to us anymore
+
+    With the database_thread the batches are written there and the
+    event loop does not wait for them. Messages must not leave before
+    the keys they use are reserved on disk, so the async encryption
+    awaits settled before it returns
+    """
+
+    def __init__(
+        self,
+        interval: float = WRITE_BEHIND_INTERVAL,
+        max_updates: int = WRITE_BEHIND_MAX_UPDATES,
+        /,
+        clock: Callable[[], float] = time.monotonic,
+        database_thread: Optional[DatabaseThread] = None,
+    ) -> None:
+        self.interval = interval
+        self.max_updates = max_updates
+        self.clock = clock
+        self.database_thread = database_thread
+        # sessions are evicted on the database thread too
+        self._lock = threading.RLock()
+        self._pending: List[Future] = []
+        self.flushes = 0
+        self._dirty: Dict[SessionKey, CryptoController] = {}
+        self._updates = 0
+        self._first_update: Optional[float] = None
+        self._flushed: Dict[SessionKey, FlushedState] = {}
+
+    def __len__(self) -> int:
+        return len(self._dirty)
+
+    @staticmethod
+    def _key(session: CryptoController) -> SessionKey:
+        return (session.db_path, session.user_state.login, session.contact)
+
+    def mark_dirty(self, session: CryptoController) -> None:
+        """
+        Called by save_state, at the end of the operation on the
+        session (its lock can still be held, the work is done)
+        """
+        key = self._key(session)
+        with self._lock:
+            self._dirty[key] = session
+            self._updates += 1
+            if self._first_update is None:
+                self._first_update = self.clock()
+
+            flushed = self._flushed.get(key)
+            if (
+                flushed is None
+                or flushed.is_behind(session.get_ratchet_set())
+                or self._updates >= self.max_updates
+                or self.clock() - self._first_update >= self.interval
+            ):
+                self._flush(current=key)
+
+    def flush(
+        self,
+        /,
+        owner: Optional[str] = None,
+        sessions: Optional[Iterable[CryptoController]] = None,
+        final: bool = False,
+    ) -> int:
+        """
+        Save the dirty sessions (of the owner / only the given ones).
+        final is for the sessions which will not be used anymore, they
+        are saved as they are, without any keys reserved ahead. Clean
+        sessions saved with the reserved keys are written again then,
+        otherwise after the restart they would skip the reserved keys.
+        Returns number of the saved sessions
+        """
+        wanted = (
+            None
+            if sessions is None
+            else {self._key(session) for session in sessions}
+        )
+        return self._flush(owner=owner, wanted=wanted, final=final)
+
+    def forget(self, session: CryptoController) -> None:
+        """Drop the session without saving it"""
+        key = self._key(session)
+        with self._lock:
+            self._dirty.pop(key, None)
+            self._flushed.pop(key, None)
+
+    def release(self, session: CryptoController) -> None:
+        """Save the session which will not be used anymore"""
+        key = self._key(session)
+        with self._lock:
+            self._flush(wanted={key}, final=True)
+            if key not in self._dirty:
+                self._flushed.pop(key, None)
+
+    def _flush(
+        self,
+        owner: Optional[str] = None,
+        wanted: Optional[Set[SessionKey]] = None,
+        final: bool = False,
+        current: Optional[SessionKey] = None,
+    ) -> int:
+        with self._lock:
+            return self._flush_locked(owner, wanted, final, current)
+
+    def _flush_locked(
+        self,
+        owner: Optional[str],
+        wanted: Optional[Set[SessionKey]],
+        final: bool,
+        current: Optional[SessionKey],
+    ) -> int:
+        candidates = list(self._dirty.items())
+        if final:
+            candidates += [
+                (key, flushed.session)
+                for key, flushed in self._flushed.items()
+                if key not in self._dirty and flushed.is_ahead()
+            ]
+        by_database: Dict[str, List[CryptoController]] = defaultdict(list)
+        for key, session in candidates:
+            if owner is not None and key[1] != owner:
+                continue
+            if wanted is not None and key not in wanted:
+                continue
+            lock = session._session_lock
+            if key != current and lock is not None and lock.locked():
+                # in the middle of the operation on the crypto thread,
+                # it will be marked again when the operation ends
+                continue
+            self._dirty.pop(key, None)
+            by_database[session.db_path].append(session)
+
+        for sessions_to_save in by_database.values():
+            self._save(sessions_to_save, final)
+            self.flushes += 1
+
+        if not self._dirty:
+            self._updates = 0
+            self._first_update = None
+        return sum(len(saved) for saved in by_database.values())
+
+    def _save(self, sessions: List[CryptoController], final: bool) -> None:
+        rows = []
+        for session in sessions:
+            r_set = session.get_ratchet_set()
+            if final:
+                snapshot = r_set.to_bytes(session.my_turn)
+                send_limit = r_set.send_count
+            else:
+                snapshot, send_limit = reserved_snapshot(
+                    r_set, session.my_turn, self.max_updates
+                )
+            skipped = None
+            if session.skipped_keys.dirty:
+                skipped = session.skipped_keys.take_changes()
+            rows.append(
+                (
+                    session.user_state,
+                    session.contact,
+                    snapshot,
+                    session.my_turn,
+                    skipped,
+                )
+            )
+            self._flushed[self._key(session)] = FlushedState(
+                session, r_set, send_limit
+            )
+        # sessions of the same database share the connection
+        db_controller = sessions[0].db_controller
+        if self.database_thread is None:
+            db_controller.save_sessions(rows)
+            return
+        self._pending = [f for f in self._pending if not f.done()]
+        self._pending.append(
+            self.database_thread.submit(db_controller.save_sessions, rows)
+        )
+
+    async def settled(self) -> None:
+        """Wait until the batches submitted so far are on disk"""
+        with self._lock:
+            # other waiters need the same futures, they are dropped
+            # only once done (see _save)
+            pending = [f for f in self._pending if not f.done()]
+        for future in pending:
+            await asyncio.wrap_future(future)
+
+    async def run(self) -> None:
+        """Flush what is waiting longer than the interval"""
+        while True:
+            await asyncio.sleep(self.interval)
+            if (
+                self._first_update is not None
+                and self.clock() - self._first_update >= self.interval
+            ):
+                self.flush()
@@ -1,6 +1,7 @@
 from app.config import MainMenuOptions
 from simple_term_menu import TerminalMenu
 from datetime import datetime
+from typing import Optional
 import aioconsole
 
 
@@ -32,10 +33,20 @@ def get_menu_option() -> MainMenuOptions:
     return MainMenuOptions(index_chosen)
 
 
-def get_timestamp() -> str:
-    now = datetime.now()
+def get_timestamp(timestamp: Optional[float] = None) -> str:
+    """Time to show, now or of the given unix timestamp"""
+    now = (
+        datetime.now()
+        if timestamp is None
+        else datetime.fromtimestamp(timestamp)
+    )
     return now.strftime("%H:%M:%S")
 
 
 async def get_contact_name():
     return await aioconsole.ainput("Contact Name:")
+
+
+async def get_first_message() -> Optional[str]:
+    message = await aioconsole.ainput("First message (optional):")
+    return message or None
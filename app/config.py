@@ -1,5 +1,6 @@
 from enum import Enum
 from pathlib import Path
+from typing import Optional
 
 
 # server constants
@@ -17,11 +18,106 @@ MAX_ONE_TIME_KEYS = 15
 # length of the keyes is derived from the signal documentation
 SHARED_KEY_LENGTH = 32
 RATCHET_STATE_KEY_LENGTH = 64
+# key derivation used by the ratchets: "hmac" or "cryptography"
+# both produce exactly the same keys, "hmac" is just faster
+KDF_BACKEND = "hmac"
+# number of message keys every chain can compute ahead in the idle time
+MESSAGE_KEY_WINDOW = 8
+# maximal number of messages which can be skipped in a single chain
+MAX_SKIP = 1000
+# bounds of the store of keys for the messages which did not arrive yet
+MAX_SKIPPED_KEYS = 2000
+SKIPPED_KEY_TTL = 7 * 24 * 60 * 60  # seconds
+# number of Diffie-Hellman key pairs kept generated in the background.
+# Refilling starts when the pool drops below the low water mark
+KEY_POOL_HIGH_WATER = 32
+KEY_POOL_LOW_WATER = 8
+# number of decoded key objects kept in memory
+PUBLIC_KEY_CACHE_SIZE = 1024
+PRIVATE_KEY_CACHE_SIZE = 64
+# default dh ratchet rotation policy. Zeros mean rotation on every reply
+ROTATION_EVERY_MESSAGES = 0
+ROTATION_MIN_INTERVAL = 0.0  # seconds
+# threads doing the cpu heavy crypto away from the event loop
+CRYPTO_EXECUTOR_WORKERS = 2
+# smaller payloads are encrypted directly on the event loop
+AEAD_OFFLOAD_THRESHOLD = 64 * 1024  # bytes
+# number of sessions the in-memory session store has room for at start
+SESSION_STORE_CAPACITY = 1024
+# number of live chat sessions (with loaded ratchets) kept by the app
+SESSION_CACHE_SIZE = 256
+# messages are compressed before encryption when it makes them smaller.
+# Off by default, older clients cannot read compressed messages. The
+# chat turns it on by itself once the contact sends a compressed
+# message we could decompress
+COMPRESSION_ENABLED = False
+COMPRESSION_MIN_SIZE = 256  # bytes, smaller messages are not compressed
+COMPRESSION_LEVEL = 6
+# preset dictionary made by compression.train_dictionary, from a file
+# of sample messages (one per line):
+#   python -m app.chat.crypto.compression samples.txt dictionary.bin
+# Both sides of the chat must use the same one. None means no dictionary
+COMPRESSION_DICTIONARY_PATH: Optional[str] = None
+COMPRESSION_DICTIONARY_SIZE = 32 * 1024  # zlib window, more is useless
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+# files are encrypted and send in chunks of that size
+FILE_CHUNK_SIZE = 64 * 1024
+# recieved files, stored once no matter how many times they came
+BLOB_STORE_DIR = "blobs"
+# messages of the chat history loaded at once, the chat opens with
+# the newest page and the older ones are loaded on demand (:more)
+HISTORY_PAGE_SIZE = 50
+# ratchets of the live sessions are saved in batches: at most every
+# WRITE_BEHIND_INTERVAL seconds or after WRITE_BEHIND_MAX_UPDATES
+# updates, whichever comes first. That is what can be lost on crash.
+# Sending chains are saved that many keys ahead, so after the crash
+# no message key is used twice. It must stay well below MAX_SKIP
+WRITE_BEHIND_ENABLED = True
+WRITE_BEHIND_INTERVAL = 1.0  # seconds
+WRITE_BEHIND_MAX_UPDATES = 32
+# sqlite settings of the local database, see DurabilityProfile
+DB_BUSY_TIMEOUT = 5000  # ms, waiting for the lock held by another thread
 # according to crypto library docs nonce should have 96 bits
 AEAD_NONCE = "SEG0PPiuHAFm".encode(PREFFERED_ENCODING)
 BLOCK_SIZE = 128
 
 
+class CipherSuite(Enum):
+    """
+    AEAD used for the messages. Value of the enum is send
+    inside of the message header so it must never change
+    """
+
+    AES_GCM = 1
+    CHACHA20_POLY1305 = 2
+
+
+DEFAULT_CIPHER_SUITE = CipherSuite.AES_GCM
+# if set, the fastest cipher suite on this cpu is chosen on startup
+CIPHER_SUITE_BENCHMARK = False
+
+
+class DurabilityProfile(Enum):
+    """
+    How much the local database trades durability for speed
+    (pragmas of every profile are in database/durability.py).
+
+    STRICT - rollback journal, fsync of every commit (sqlite default)
+    DURABLE - WAL, every commit is still synced
+    BALANCED - WAL, synced at checkpoints. After the power loss the
+        last commits can be lost but the database is never broken
+    FAST - nothing is synced, only for the tests and benchmarks
+    """
+
+    STRICT = "strict"
+    DURABLE = "durable"
+    BALANCED = "balanced"
+    FAST = "fast"
+
+
+DB_DURABILITY_PROFILE = DurabilityProfile.BALANCED
+
+
 class MainMenuOptions(Enum):
     MESSAGE = 0
     ADD_FRIEND = 1
@@ -0,0 +1,177 @@
+from concurrent.futures import Future
+from typing import Any, Callable, Iterable, List, Optional, Tuple, TypeVar
+import asyncio
+import functools
+import queue
+import threading
+
+ResultType = TypeVar("ResultType")
+
+# calls of the request, its future and whether it wants every result
+Request = Tuple[List[Callable[[], Any]], Future, bool]
+
+
+class DatabaseThread:
+    """
+    Single thread which does the disk I/O of the local database, so
+    the commits do not block the event loop serving the websocket
+    and the user input.
+
+    Requests are done one by one in the order of submission, so a
+    write submitted before a read is always seen by it. The thread
+    takes everything queued at once, a burst of requests costs one
+    wakeup. submit_many runs many calls as one request, with a single
+    hop from and back to the event loop.
+
+    Connections are per thread (see ConnectionRegistry), so the
+    controllers used here get their own connection
+    """
+
+    def __init__(self, name: str = "database") -> None:
+        self.name = name
+        self.wakeups = 0
+        self.requests = 0
+        # every thread gets its own queue, see shutdown
+        self._queue: "queue.SimpleQueue[Optional[Request]]"
+        self._queue = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def in_thread(self) -> bool:
+        thread = self._thread
+        return thread is not None and thread.ident == threading.get_ident()
+
+    def submit(
+        self, func: Callable[..., ResultType], /, *args: Any, **kwargs: Any
+    ) -> "Future[ResultType]":
+        """func(*args, **kwargs) done on the database thread"""
+        return self._put(
+            [functools.partial(func, *args, **kwargs)], many=False
+        )
+
+    def submit_many(
+        self, calls: Iterable[Callable[[], Any]]
+    ) -> "Future[List[Any]]":
+        """
+        Calls done back to back as one request, the future gets the
+        list of their results. The first exception stops the rest
+        """
+        return self._put(list(calls), many=True)
+
+    async def run(
+        self, func: Callable[..., ResultType], /, *args: Any, **kwargs: Any
+    ) -> ResultType:
+        if self.in_thread():
+            # waiting for the queue from inside would never end
+            return func(*args, **kwargs)
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    async def run_many(self, calls: Iterable[Callable[[], Any]]) -> List[Any]:
+        if self.in_thread():
+            return [call() for call in calls]
+        return await asyncio.wrap_future(self.submit_many(calls))
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Stop the thread once the requests queued so far are done.
+        The next submit starts a fresh one
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._queue.put(None)
+        if wait:
+            thread.join()
+
+    def _put(self, calls: List[Callable[[], Any]], many: bool) -> Future:
+        future: Future = Future()
+        with self._lock:
+            if self._thread is None:
+                self._queue = queue.SimpleQueue()
+                self._thread = threading.Thread(
+                    target=self._work,
+                    args=(self._queue,),
+                    name=self.name,
+                    daemon=True,
+                )
+                self._thread.start()
+            self._queue.put((calls, future, many))
+        return future
+
+    def _work(self, requests: "queue.SimpleQueue[Optional[Request]]") -> None:
+        while True:
+            batch = [requests.get()]
+            # everything queued meanwhile is done in the same wakeup
+            while True:
+                try:
+                    batch.append(requests.get_nowait())
+                except queue.Empty:
+                    break
+            self.wakeups += 1
+
+            for request in batch:
+                if request is None:
+                    # nothing is put after the stop, next thread has
+                    # a new queue
+                    return
+                self.requests += 1
+                calls, future, many = request
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    results = [call() for call in calls]
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(results if many else results[0])
+
+
+class AsyncDatabase:
+    """
+    Awaitable version of the database object (DatabaseController or
+    OwnerDAO). Every method of the wrapped object is done on the
+    database thread:
+
+        await AsyncDatabase(owner_dao).contact_exists("bob")
+    """
+
+    def __init__(
+        self, target: Any, /, thread: Optional[DatabaseThread] = None
+    ) -> None:
+        self.target = target
+        self.thread = thread if thread is not None else database_thread
+
+    def __getattr__(self, name: str) -> Callable[..., Any]:
+        method = getattr(self.target, name)
+        if not callable(method):
+            raise AttributeError(f"{name} is not a database operation")
+
+        async def operation(*args: Any, **kwargs: Any) -> Any:
+            return await self.thread.run(method, *args, **kwargs)
+
+        operation.__name__ = name
+        return operation
+
+    async def batch(
+        self, operations: Iterable[Tuple[str, tuple, dict]]
+    ) -> List[Any]:
+        """(method name, args, kwargs) of many operations as one request"""
+        return await self.thread.run_many(
+            functools.partial(getattr(self.target, name), *args, **kwargs)
+            for name, args, kwargs in operations
+        )
+
+
+database_thread = DatabaseThread()
+
+
+async def run_in_database_thread(
+    func: Callable[..., ResultType], /, *args: Any, **kwargs: Any
+) -> ResultType:
+    """Await func(*args, **kwargs) done on the database thread"""
+    return await database_thread.run(func, *args, **kwargs)
+
+
+def shutdown_database_thread(wait: bool = True) -> None:
+    database_thread.shutdown(wait=wait)
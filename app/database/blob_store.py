@@ -0,0 +1,191 @@
+from .db_controller import DatabaseController
+from app.user.user_state import UserState
+from app.config import BLOB_STORE_DIR, FILE_CHUNK_SIZE
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, Optional, Union
+import hashlib
+import io
+import mmap
+import os
+import tempfile
+
+
+class BlobStoreException(Exception):
+    ...
+
+
+class BlobWriter:
+    """
+    File being written into the store. Content is hashed while it
+    is written, so it does not have to be read again to find its name
+    """
+
+    def __init__(self, store: "BlobStore") -> None:
+        self._store = store
+        self._hash = hashlib.sha256()
+        self.size = 0
+        fd, self._tmp_path = tempfile.mkstemp(dir=store.tmp_dir)
+        self._file: Optional[BinaryIO] = os.fdopen(fd, "wb")
+
+    def write(self, data: bytes) -> int:
+        if self._file is None:
+            raise BlobStoreException("Blob is already closed")
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def commit(
+        self,
+        /,
+        user_state: Optional[UserState] = None,
+        contact: Optional[str] = None,
+        name: str = "",
+    ) -> str:
+        """
+        Put the content into the store, returns its digest. With the
+        contact the reference belongs to the file recieved from it
+        and is released when the contact is deleted
+        """
+        if self._file is None:
+            raise BlobStoreException("Blob is already closed")
+        self._file.close()
+        self._file = None
+
+        digest = self._hash.hexdigest()
+        path = self._store.path(digest)
+        if os.path.exists(path):
+            # we already have the same content
+            os.remove(self._tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self._tmp_path, path)
+        if user_state is not None and contact is not None:
+            self._store.db_controller.add_file(
+                user_state, contact, digest, self.size, name
+            )
+        else:
+            self._store.db_controller.add_blob_reference(digest, self.size)
+        return digest
+
+    def abort(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self._tmp_path)
+
+
+class BlobStore:
+    """
+    Content addressed store of the recieved files. File is saved
+    under the sha256 of its content, so the same file recieved from
+    many contacts is kept once. Number of references to every
+    blob is kept in the database, blob is deleted with the last one.
+    Blobs of the deleted contacts are deleted by collect.
+
+    The store is next to the database file by default
+    """
+
+    def __init__(
+        self, db_controller: DatabaseController, root: Optional[str] = None
+    ) -> None:
+        self.db_controller = db_controller
+        self.root = (
+            root
+            if root is not None
+            else os.path.join(
+                os.path.dirname(os.path.abspath(db_controller.DB_PATH)),
+                BLOB_STORE_DIR,
+            )
+        )
+        self.tmp_dir = os.path.join(self.root, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path(self, digest: str) -> str:
+        if len(digest) != 64 or not all(
+            c in "0123456789abcdef" for c in digest
+        ):
+            raise BlobStoreException(f"Bad blob digest {digest}")
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def writer(self) -> BlobWriter:
+        return BlobWriter(self)
+
+    def put(self, source: Union[bytes, BinaryIO]) -> str:
+        """Store bytes or the content of the file, returns the digest"""
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+        writer = self.writer()
+        try:
+            for chunk in iter(lambda: source.read(FILE_CHUNK_SIZE), b""):
+                writer.write(chunk)
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.commit()
+
+    def add_reference(self, digest: str) -> int:
+        if not self.exists(digest):
+            raise BlobStoreException(f"No blob {digest} in store")
+        return self.db_controller.add_blob_reference(
+            digest, os.path.getsize(self.path(digest))
+        )
+
+    def release(self, digest: str) -> int:
+        """Drop one reference, the last one deletes the blob"""
+        left = self.db_controller.release_blob_reference(digest)
+        if left == 0 and self.exists(digest):
+            os.remove(self.path(digest))
+        return left
+
+    def collect(self) -> int:
+        """
+        Delete the blobs without references (their files were
+        deleted with the contact). Only the blobs left with the zero
+        refcount are looked at, the store is not walked. Returns
+        number of deleted blobs
+        """
+        deleted = 0
+        for digest in self.db_controller.get_unreferenced_blobs():
+            if self.db_controller.drop_blob(digest) and self.exists(digest):
+                os.remove(self.path(digest))
+                deleted += 1
+        return deleted
+
+    def delete_contact(self, user_state: UserState, contact: str) -> int:
+        """
+        DatabaseController.delete_contact with the blobs which lost
+        their last reference. Returns number of deleted blobs
+        """
+        self.db_controller.delete_contact(user_state, contact)
+        return self.collect()
+
+    def digest_of(self, path: str) -> Optional[str]:
+        """Digest of the blob at the path, None for other files"""
+        digest = os.path.basename(path)
+        try:
+            if os.path.samefile(path, self.path(digest)):
+                return digest
+        except (BlobStoreException, OSError):
+            pass
+        return None
+
+    @contextmanager
+    def open(self, digest: str) -> Iterator[Union[mmap.mmap, io.BytesIO]]:
+        """
+        Read only view of the blob. It is mapped into memory, so
+        reading it (also whole) does not copy it into python memory.
+        The view has read() and can be passed as a file
+        """
+        with open(self.path(digest), "rb") as blob_file:
+            if os.fstat(blob_file.fileno()).st_size == 0:
+                # empty file cannot be mapped
+                yield io.BytesIO()
+                return
+            view = mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield view
+            finally:
+                view.close()
@@ -0,0 +1,127 @@
+from .durability import apply_profile
+from app.config import DB_DURABILITY_PROFILE, DurabilityProfile
+from typing import Dict, Optional, Set, Tuple
+import os
+import sqlite3
+import threading
+
+ConnectionKey = Tuple[str, int]
+
+
+class ConnectionRegistry:
+    """
+    SQLite connections shared by every DatabaseController of the
+    process. There is one connection per (database file, thread),
+    made on the first use and kept until close_all (app exit).
+
+    sqlite connections must not be used by two threads at once, so
+    every thread gets its own. They are opened with
+    check_same_thread=False only to let close_all close them from
+    the thread which shuts the app down. Every new connection gets
+    the pragmas of the durability profile.
+
+    The registry also remembers which files had their schema checked,
+    so the next controllers do not scan sqlite_master again. Deleted
+    or replaced file is noticed (by its inode) and connected again.
+
+    Controllers keep the connection of their thread and ask for it
+    again only when generation changed, that is after some
+    connections were closed (discard, close_all)
+    """
+
+    def __init__(
+        self, profile: DurabilityProfile = DB_DURABILITY_PROFILE
+    ) -> None:
+        self.profile = profile
+        self._lock = threading.Lock()
+        self._connections: Dict[ConnectionKey, sqlite3.Connection] = {}
+        # path -> (device, inode) of the file the connections point to
+        self._files: Dict[str, Tuple[int, int]] = {}
+        self._ready: Set[str] = set()
+        self.generation = 0
+
+    def __len__(self) -> int:
+        return len(self._connections)
+
+    @staticmethod
+    def _file_id(path: str) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_dev, stat.st_ino
+
+    def connect(self, path: str) -> sqlite3.Connection:
+        """Connection to the database for the calling thread"""
+        path = os.path.abspath(path)
+        key = (path, threading.get_ident())
+        with self._lock:
+            if self._files.get(path) != self._file_id(path):
+                # file was removed or replaced under our connections
+                self._discard(path)
+
+            connection = self._connections.get(key)
+            if connection is None:
+                try:
+                    connection = sqlite3.connect(
+                        path, check_same_thread=False
+                    )
+                except sqlite3.OperationalError:
+                    raise sqlite3.OperationalError(
+                        "Could not find the database path! \
+                        Make sure you passed the right path to the controller"
+                    )
+                apply_profile(connection, self.profile)
+                self._connections[key] = connection
+                self._files[path] = self._file_id(path)
+            return connection
+
+    def is_ready(self, path: str) -> bool:
+        """Schema of the database was already checked"""
+        path = os.path.abspath(path)
+        with self._lock:
+            return (
+                path in self._ready
+                and self._files.get(path) == self._file_id(path)
+            )
+
+    def mark_ready(self, path: str) -> None:
+        with self._lock:
+            self._ready.add(os.path.abspath(path))
+
+    def discard(self, path: str) -> None:
+        """
+        Close the connections of every thread to the database,
+        before the file is deleted
+        """
+        with self._lock:
+            self._discard(os.path.abspath(path))
+
+    def remove_database(self, path: str) -> None:
+        """
+        Delete the database file with its WAL files. WAL left after
+        the deleted database would be replayed into the new one
+        """
+        self.discard(path)
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    def close_all(self) -> None:
+        with self._lock:
+            for connection in self._connections.values():
+                connection.close()
+            self._connections.clear()
+            self._files.clear()
+            self._ready.clear()
+            self.generation += 1
+
+    def _discard(self, path: str) -> None:
+        for key in [key for key in self._connections if key[0] == path]:
+            self._connections.pop(key).close()
+        self._files.pop(path, None)
+        self._ready.discard(path)
+        self.generation += 1
+
+
+connection_registry = ConnectionRegistry()
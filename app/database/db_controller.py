@@ -1,16 +1,74 @@
 from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
 from app.chat.crypto.ratchet_set import RatchetSet
-from typing import List, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 from app.user.user_state import UserState
-from app.config import TABLE_SCHEMA_PATH, DEFAULT_DB_PATH, MAX_ONE_TIME_KEYS
+from app.config import (
+    DEFAULT_DB_PATH,
+    HISTORY_PAGE_SIZE,
+    MAX_ONE_TIME_KEYS,
+    TABLE_SCHEMA_PATH,
+)
 from app.chat.crypto.crypto_utils import (
     create_b64_from_private_key,
     create_private_key_from_b64,
-    generate_DH,
+    evict_private_key,
 )
+from app.chat.crypto.key_pool import pooled_DH
+from .connection_registry import connection_registry
 import sqlite3
-import os
 import binascii
+import threading
+
+
+# tables of the first version of the database
+LEGACY_TABLES = {"USERS", "CONTACTS", "ONE_TIME_KEYS"}
+SCHEMA_TABLES = LEGACY_TABLES | {
+    "SKIPPED_MESSAGE_KEYS",
+    "BLOBS",
+    "FILES",
+    "GROUPS",
+    "GROUP_MEMBERS",
+    "MESSAGES",
+}
+
+# columns added after the first version: table -> (column, definition)
+SCHEMA_COLUMNS = {
+    "CONTACTS": [("ratchet_state", "BLOB")],
+}
+
+# ratchets were saved as base64 text columns before the binary snapshot
+LEGACY_RATCHET_COLUMNS = (
+    "dh_ratchet",
+    "send_ratchet",
+    "recv_ratchet",
+    "root_ratchet",
+)
+# counters were added to the text layout later, they may be missing
+LEGACY_COUNTER_COLUMNS = (
+    "send_count",
+    "prev_send_count",
+    "recv_count",
+    "contact_dh_key",
+    "pending_rotation",
+)
+
+
+# message of the chat history: (sender, timestamp, body)
+HistoryMessage = Tuple[str, float, str]
+# position in the history: (timestamp, id) of the oldest message
+# of the page, see load_messages
+HistoryCursor = Tuple[float, int]
+
+# columns of the contact returned by get_contact_info
+CONTACT_INFO_COLUMNS = (
+    "public_id_key",
+    "public_signed_pre_key",
+    "shared_x3dh_key",
+    "my_ephemeral_key",
+    "contact_ephemeral_key",
+    "my_otk_key",
+    "contact_otk_key",
+)
 
 
 class DatabaseControllerException(Exception):
@@ -21,27 +79,147 @@ class ContactParametersError(Exception):
     ...
 
 
+def initial_turn(
+    contact_signed_pre_key: Optional[str],
+    contact_ephemeral_key: Optional[str],
+    my_ephemeral_key: Optional[str],
+    contact_otk_key: Optional[str],
+    my_otk_key: Optional[str],
+) -> bool:
+    """
+    The additional parameters can
+    be added in only two ways:
+
+        * Adding the establisher (aka this
+        will be added if YOU send friend request to
+        someone)
+        {
+            contact_signed_pre_key (public)
+            my_emphemeral_key (private),
+            contact_otk_key (public)
+        }
+
+        * Adding the guest (aka YOU opened app
+        and you got pending friend request,
+        this set of data will be then
+        added)
+        {
+            contact_ephemeral_key (public),
+            my_otk_key (private)
+        }
+    Returns if it is our turn to send the first message
+    """
+    # now checking if params are following above
+    # specs
+    if all(
+        [
+            contact_signed_pre_key is not None,
+            my_ephemeral_key is not None,
+            contact_otk_key is not None,
+            # not set
+            contact_ephemeral_key is None,
+            my_otk_key is None,
+        ]
+    ):
+        return True
+    elif all(
+        [
+            contact_ephemeral_key is not None,
+            my_otk_key is not None,
+            # not set
+            contact_signed_pre_key is None,
+            my_ephemeral_key is None,
+            contact_otk_key is None,
+        ]
+    ):
+        return False
+    else:
+        raise ContactParametersError(
+            "passed wrong combination of optional parameters!!"
+        )
+
+
+def release_files(cur: sqlite3.Cursor, owner: str, contact: str) -> None:
+    """
+    Drop the references of the files recieved from the contact, part
+    of deleting it. Blobs left without references keep their row
+    (with refcount 0) till BlobStore.collect deletes them with their
+    files
+    """
+    cur.execute(
+        "UPDATE BLOBS SET refcount=refcount - ("
+        "SELECT COUNT(*) FROM FILES "
+        "WHERE owner=? AND contact=? AND FILES.digest=BLOBS.digest) "
+        "WHERE digest IN ("
+        "SELECT digest FROM FILES WHERE owner=? AND contact=?)",
+        (owner, contact) * 2,
+    )
+    cur.execute(
+        "DELETE FROM FILES WHERE owner=? AND contact=?", (owner, contact)
+    )
+
+
+def update_skipped_keys(
+    cur: sqlite3.Cursor,
+    owner: str,
+    contact: str,
+    added: List[Tuple[bytes, int, bytes, float]],
+    removed: List[Tuple[bytes, int]],
+) -> None:
+    """
+    Keys of skipped messages changed since the last save (see
+    SkippedKeyStore.take_changes), the rest of them is not touched
+    """
+    cur.executemany(
+        "DELETE FROM SKIPPED_MESSAGE_KEYS "
+        "WHERE owner=? AND contact=? AND dh_key=? AND message_number=?",
+        [(owner, contact, *key) for key in removed],
+    )
+    cur.executemany(
+        "INSERT INTO SKIPPED_MESSAGE_KEYS "
+        "(owner, contact, dh_key, message_number, message_key, created) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [(owner, contact, *skipped) for skipped in added],
+    )
+
+
+def contact_info(contact: str, row: tuple) -> dict:
+    """Row of CONTACT_INFO_COLUMNS as a dict"""
+    return {"login": contact, **dict(zip(CONTACT_INFO_COLUMNS, row))}
+
+
 class DatabaseController:
     def __init__(self, DB_PATH: str = DEFAULT_DB_PATH):
+        """
+        Controllers are cheap, the connections come from the shared
+        registry and the schema is checked only by the first
+        controller of the database file
+        """
         self.DB_PATH = DB_PATH
-        try:
-            self.connection = sqlite3.connect(DB_PATH)
-        except sqlite3.OperationalError:
-            raise sqlite3.OperationalError(
-                "Could not find the database path! \
-                Make sure you passed the right path to the controller"
-            )
-
-        if not self.tables_exist():
-            self.create_tables()
-
-    def __del__(self):
-        self.connection.close()
+        # connection of every thread, with the registry generation
+        self._local = threading.local()
+        if not connection_registry.is_ready(DB_PATH):
+            if not self.tables_exist():
+                self.create_tables()
+            connection_registry.mark_ready(DB_PATH)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        Connection of the calling thread. The registry (its lock and
+        the file check) is asked only the first time and after some
+        connections were closed
+        """
+        local = self._local
+        generation = connection_registry.generation
+        if getattr(local, "generation", None) != generation:
+            local.connection = connection_registry.connect(self.DB_PATH)
+            local.generation = generation
+        return local.connection
 
     def _reinstall(self):
         """delete and create an empty database"""
-        if os.path.exists(self.DB_PATH):
-            os.remove(self.DB_PATH)
+        connection_registry.remove_database(self.DB_PATH)
 
         # running constructor to create the database file from scratch
         self.__init__(DB_PATH=self.DB_PATH)
@@ -57,12 +235,13 @@ class DatabaseController:
             return False
 
         tables = set(map(lambda x: x[0], tables))
-        res = {"USERS", "CONTACTS", "ONE_TIME_KEYS"} == tables
+        res = LEGACY_TABLES <= tables <= SCHEMA_TABLES
 
-        if not res:
-            os.remove(self.DB_PATH)
-            self.connection.close()
-            self.connection = sqlite3.connect(self.DB_PATH)
+        if res:
+            # database could be created by the older version of the app
+            self.migrate_tables()
+        else:
+            connection_registry.remove_database(self.DB_PATH)
 
         return res
 
@@ -74,12 +253,70 @@ class DatabaseController:
         self.connection.commit()
         cur.close()
 
+    def migrate_tables(self):
+        """
+        Bring database made by the older version of the app up to date
+        without losing any data. Missing tables are created,
+        missing columns are added and ratchets saved as text are
+        converted into binary snapshots
+        """
+        self.create_tables()
+        cur = self.connection.cursor()
+
+        for table, columns in SCHEMA_COLUMNS.items():
+            cur.execute(f"PRAGMA table_info({table})")
+            present = {row[1] for row in cur.fetchall()}
+            for column, definition in columns:
+                if column not in present:
+                    cur.execute(
+                        f"ALTER TABLE {table} ADD COLUMN {column} {definition}"
+                    )
+
+        self.migrate_text_ratchets(cur)
+        self.connection.commit()
+        cur.close()
+
+    def migrate_text_ratchets(self, cur: sqlite3.Cursor) -> None:
+        cur.execute("PRAGMA table_info(CONTACTS)")
+        present = {row[1] for row in cur.fetchall()}
+        if not set(LEGACY_RATCHET_COLUMNS) <= present:
+            return
+
+        counters = [c for c in LEGACY_COUNTER_COLUMNS if c in present]
+        legacy_columns = (*LEGACY_RATCHET_COLUMNS, *counters)
+        cur.execute(
+            f"SELECT owner, login, my_turn, {', '.join(legacy_columns)} "
+            "FROM CONTACTS WHERE ratchet_state IS NULL AND "
+            + " AND ".join(f"{c} IS NOT NULL" for c in LEGACY_RATCHET_COLUMNS)
+        )
+        rows = cur.fetchall()
+
+        for owner, login, my_turn, *values in rows:
+            ratchet_set = RatchetSet()
+            ratchet_set.from_snapshot(*values[:4])
+            saved = dict(zip(counters, values[4:]))
+            ratchet_set.send_count = saved.get("send_count") or 0
+            ratchet_set.prev_send_count = saved.get("prev_send_count") or 0
+            ratchet_set.recv_count = saved.get("recv_count") or 0
+            if saved.get("contact_dh_key") is not None:
+                ratchet_set.remote_dh_key = binascii.a2b_base64(
+                    saved["contact_dh_key"]
+                )
+            ratchet_set.pending_rotation = bool(saved.get("pending_rotation"))
+
+            cur.execute(
+                "UPDATE CONTACTS SET ratchet_state=?, "
+                + ", ".join(f"{c}=NULL" for c in legacy_columns)
+                + " WHERE owner=? AND login=?",
+                (ratchet_set.to_bytes(bool(my_turn)), owner, login),
+            )
+
     # User crud operations
 
     def create_user(self, user_state: UserState):
         cur = self.connection.cursor()
-        user_state.id_key = generate_DH()
-        user_state.signed_pre_key = generate_DH()
+        user_state.id_key = pooled_DH()
+        user_state.signed_pre_key = pooled_DH()
 
         cur.execute(
             "INSERT INTO USERS (login, id_key, signed_pre_key) "
@@ -92,7 +329,7 @@ class DatabaseController:
         )
 
         for i in range(MAX_ONE_TIME_KEYS):
-            otk = generate_DH()
+            otk = pooled_DH()
             cur.execute(
                 "INSERT INTO ONE_TIME_KEYS (key_index, owner, key) "
                 "VALUES (?, ?, ?)",
@@ -156,60 +393,17 @@ class DatabaseController:
                 "Cannot add self to the contacts!!!"
             )
 
-        """
-        The additional parameters can
-        be added in only two ways:
-
-            * Adding the establisher (aka this
-            will be added if YOU send friend request to
-            someone)
-            {
-                contact_signed_pre_key (public)
-                my_emphemeral_key (private),
-                contact_otk_key (public)
-            }
-
-            * Adding the guest (aka YOU opened app
-            and you got pending friend request,
-            this set of data will be then
-            added)
-            {
-                contact_ephemeral_key (public),
-                my_otk_key (private)
-            }
-        """
-
         if self.get_contact_info(state, contactLogin) is not None:
             return False
 
-        # now checking if params are following above
-        # specs
-        if all(
-            [
-                contact_signed_pre_key is not None,
-                my_ephemeral_key is not None,
-                contact_otk_key is not None,
-                # not set
-                contact_ephemeral_key is None,
-                my_otk_key is None,
-            ]
-        ):
-            my_turn = True
-        elif all(
-            [
-                contact_ephemeral_key is not None,
-                my_otk_key is not None,
-                # not set
-                contact_signed_pre_key is None,
-                my_ephemeral_key is None,
-                contact_otk_key is None,
-            ]
-        ):
-            my_turn = False
-        else:
-            raise ContactParametersError(
-                "passed wrong combination of optional parameters!!"
-            )
+        # see initial_turn for the allowed combinations
+        my_turn = initial_turn(
+            contact_signed_pre_key,
+            contact_ephemeral_key,
+            my_ephemeral_key,
+            contact_otk_key,
+            my_otk_key,
+        )
 
         cur = self.connection.cursor()
 
@@ -249,12 +443,8 @@ class DatabaseController:
         cur = self.connection.cursor()
 
         cur.execute(
-            "SELECT "
-            "public_id_key, public_signed_pre_key, "
-            "shared_x3dh_key, my_ephemeral_key, contact_ephemeral_key, "
-            "my_otk_key, contact_otk_key "
-            "FROM CONTACTS WHERE "
-            "owner=? AND login=?",
+            f"SELECT {', '.join(CONTACT_INFO_COLUMNS)} FROM CONTACTS "
+            "WHERE owner=? AND login=?",
             (state.login, contact),
         )
 
@@ -263,18 +453,7 @@ class DatabaseController:
 
         if res_tuple is None:
             return None
-
-        result = {
-            "login": contact,
-            "public_id_key": res_tuple[0],
-            "public_signed_pre_key": res_tuple[0],
-            "shared_x3dh_key": res_tuple[1],
-            "my_ephemeral_key": res_tuple[2],
-            "contact_ephemeral_key": res_tuple[3],
-            "my_otk_key": res_tuple[4],
-            "contact_otk_key": res_tuple[5],
-        }
-        return result
+        return contact_info(contact, res_tuple)
 
     def delete_contact(self, user_state: UserState, contactLogin: str):
         if not self.contact_exists(user_state, contactLogin):
@@ -287,6 +466,15 @@ class DatabaseController:
             "DELETE FROM CONTACTS WHERE owner=? AND login=?",
             (user_state.login, contactLogin),
         )
+        cur.execute(
+            "DELETE FROM SKIPPED_MESSAGE_KEYS WHERE owner=? AND contact=?",
+            (user_state.login, contactLogin),
+        )
+        cur.execute(
+            "DELETE FROM MESSAGES WHERE owner=? AND contact=?",
+            (user_state.login, contactLogin),
+        )
+        release_files(cur, user_state.login, contactLogin)
         self.connection.commit()
         cur.close()
 
@@ -407,8 +595,7 @@ class DatabaseController:
         cur = self.connection.cursor()
 
         cur.execute(
-            "SELECT dh_ratchet, send_ratchet, recv_ratchet, root_ratchet "
-            "FROM CONTACTS WHERE owner=? AND login=?",
+            "SELECT ratchet_state FROM CONTACTS WHERE owner=? AND login=?",
             (user_state.login, contact),
         )
 
@@ -418,7 +605,7 @@ class DatabaseController:
                 f"User does not have the contact {contact}!!"
             )
 
-        return False if None in res else True
+        return res[0] is not None
 
     def load_ratchets(self, user_state: UserState, contact: str) -> RatchetSet:
         if not self.ratchets_present(user_state, contact):
@@ -427,16 +614,12 @@ class DatabaseController:
                 "Aborting immediately"
             )
 
-        ratchet_set = RatchetSet()
-
         cur = self.connection.cursor()
         cur.execute(
-            "SELECT dh_ratchet, send_ratchet, recv_ratchet, root_ratchet "
-            "FROM CONTACTS WHERE owner=? AND login=?",
+            "SELECT ratchet_state FROM CONTACTS WHERE owner=? AND login=?",
             (user_state.login, contact),
         )
-        result = cur.fetchone()
-        ratchet_set.from_snapshot(*result[0:4])
+        ratchet_set, _ = RatchetSet.from_bytes(cur.fetchone()[0])
 
         cur.close()
         return ratchet_set
@@ -450,13 +633,13 @@ class DatabaseController:
     ) -> None:
         cur = self.connection.cursor()
 
+        # my_turn is kept in its own column too, it is needed
+        # before the ratchets exist (see load_chat_init_variables)
         cur.execute(
-            "UPDATE CONTACTS "
-            "SET dh_ratchet=?, send_ratchet=?, recv_ratchet=?, "
-            "root_ratchet=?, my_turn=?"
+            "UPDATE CONTACTS SET ratchet_state=?, my_turn=? "
             "WHERE owner=? AND login=?",
             (
-                *ratchet_set.get_tuple(),
+                ratchet_set.to_bytes(my_turn),
                 int(my_turn),
                 user_state.login,
                 contact,
@@ -465,6 +648,119 @@ class DatabaseController:
         self.connection.commit()
         cur.close()
 
+    def save_ratchets_many(
+        self,
+        sessions: Iterable[Tuple[UserState, str, RatchetSet, bool]],
+    ) -> None:
+        """save_ratchets of many contacts in a single transaction"""
+        cur = self.connection.cursor()
+        cur.executemany(
+            "UPDATE CONTACTS SET ratchet_state=?, my_turn=? "
+            "WHERE owner=? AND login=?",
+            (
+                (
+                    ratchet_set.to_bytes(my_turn),
+                    int(my_turn),
+                    user_state.login,
+                    contact,
+                )
+                for user_state, contact, ratchet_set, my_turn in sessions
+            ),
+        )
+        self.connection.commit()
+        cur.close()
+
+    def save_sessions(
+        self,
+        sessions: Iterable[
+            Tuple[
+                UserState,
+                str,
+                bytes,
+                bool,
+                Optional[
+                    Tuple[
+                        List[Tuple[bytes, int, bytes, float]],
+                        List[Tuple[bytes, int]],
+                    ]
+                ],
+            ]
+        ],
+    ) -> None:
+        """
+        Ratchet snapshots (RatchetSet.to_bytes) of many contacts with
+        the changes of their keys of skipped messages (added and
+        removed ones, None when they did not change) in a single
+        transaction
+        """
+        cur = self.connection.cursor()
+        for user_state, contact, snapshot, my_turn, skipped_keys in sessions:
+            cur.execute(
+                "UPDATE CONTACTS SET ratchet_state=?, my_turn=? "
+                "WHERE owner=? AND login=?",
+                (snapshot, int(my_turn), user_state.login, contact),
+            )
+            if skipped_keys is not None:
+                update_skipped_keys(
+                    cur, user_state.login, contact, *skipped_keys
+                )
+        self.connection.commit()
+        cur.close()
+
+    def save_skipped_keys(
+        self,
+        user_state: UserState,
+        contact: str,
+        skipped_keys: List[Tuple[bytes, int, bytes, float]],
+    ) -> None:
+        """
+        Replace stored keys of skipped messages with the given ones.
+        Store is small and bounded so it is rewritten as a whole
+        """
+        cur = self.connection.cursor()
+        cur.execute(
+            "DELETE FROM SKIPPED_MESSAGE_KEYS WHERE owner=? AND contact=?",
+            (user_state.login, contact),
+        )
+        cur.executemany(
+            "INSERT INTO SKIPPED_MESSAGE_KEYS "
+            "(owner, contact, dh_key, message_number, message_key, created) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (user_state.login, contact, *skipped)
+                for skipped in skipped_keys
+            ],
+        )
+        self.connection.commit()
+        cur.close()
+
+    def update_skipped_keys(
+        self,
+        user_state: UserState,
+        contact: str,
+        added: List[Tuple[bytes, int, bytes, float]],
+        removed: List[Tuple[bytes, int]],
+    ) -> None:
+        """Save only the changed keys of skipped messages"""
+        cur = self.connection.cursor()
+        update_skipped_keys(cur, user_state.login, contact, added, removed)
+        self.connection.commit()
+        cur.close()
+
+    def load_skipped_keys(
+        self, user_state: UserState, contact: str
+    ) -> List[Tuple[bytes, int, bytes, float]]:
+        cur = self.connection.cursor()
+        cur.execute(
+            "SELECT dh_key, message_number, message_key, created "
+            "FROM SKIPPED_MESSAGE_KEYS WHERE owner=? AND contact=? "
+            "ORDER BY created",
+            (user_state.login, contact),
+        )
+        results = cur.fetchall()
+        cur.close()
+        return results
+
     def load_chat_init_variables(
         self, user_state: UserState, contact: str
     ) -> Tuple[bytes, bool]:
@@ -507,9 +803,272 @@ class DatabaseController:
         self.connection.commit()
         cur.close()
 
-    def replace_one_time_key(
+    # Blob store reference counts
+
+    def add_blob_reference(self, digest: str, size: int) -> int:
+        """Returns number of references to the blob after adding one"""
+        cur = self.connection.cursor()
+        cur.execute(
+            "INSERT INTO BLOBS (digest, size, refcount) VALUES (?, ?, 1) "
+            "ON CONFLICT(digest) DO UPDATE SET refcount=refcount + 1",
+            (digest, size),
+        )
+        self.connection.commit()
+        cur.close()
+        return self.get_blob_refcount(digest)
+
+    def release_blob_reference(self, digest: str) -> int:
+        """
+        Returns number of references left. The row of the blob
+        is deleted when there are no more references
+        """
+        cur = self.connection.cursor()
+        cur.execute(
+            "UPDATE BLOBS SET refcount=refcount - 1 "
+            "WHERE digest=? AND refcount > 0",
+            (digest,),
+        )
+        cur.execute(
+            "DELETE FROM BLOBS WHERE digest=? AND refcount=0", (digest,)
+        )
+        self.connection.commit()
+        cur.close()
+        return self.get_blob_refcount(digest)
+
+    def add_file(
+        self,
+        user_state: UserState,
+        contact: str,
+        digest: str,
+        size: int,
+        name: str,
+    ) -> int:
+        """
+        File recieved from the contact, it references the blob.
+        Returns number of references to the blob
+        """
+        cur = self.connection.cursor()
+        cur.execute(
+            "INSERT INTO BLOBS (digest, size, refcount) VALUES (?, ?, 1) "
+            "ON CONFLICT(digest) DO UPDATE SET refcount=refcount + 1",
+            (digest, size),
+        )
+        cur.execute(
+            "INSERT INTO FILES (owner, contact, digest, name) "
+            "VALUES (?, ?, ?, ?)",
+            (user_state.login, contact, digest, name),
+        )
+        self.connection.commit()
+        cur.close()
+        return self.get_blob_refcount(digest)
+
+    def get_blob_refcount(self, digest: str) -> int:
+        cur = self.connection.cursor()
+        cur.execute("SELECT refcount FROM BLOBS WHERE digest=?", (digest,))
+        result = cur.fetchone()
+        cur.close()
+        return result[0] if result is not None else 0
+
+    def get_unreferenced_blobs(self) -> List[str]:
+        """Blobs which lost their last reference with the contact"""
+        cur = self.connection.cursor()
+        cur.execute("SELECT digest FROM BLOBS WHERE refcount <= 0")
+        results = [digest for digest, in cur.fetchall()]
+        cur.close()
+        return results
+
+    def drop_blob(self, digest: str) -> bool:
+        """
+        Delete the row of the blob without references. False when
+        it got a new reference meanwhile
+        """
+        cur = self.connection.cursor()
+        cur.execute(
+            "DELETE FROM BLOBS WHERE digest=? AND refcount <= 0", (digest,)
+        )
+        dropped = cur.rowcount > 0
+        self.connection.commit()
+        cur.close()
+        return dropped
+
+    def get_file_name(
+        self, user_state: UserState, digest: str
+    ) -> Optional[str]:
+        """Name of the recieved file with the content of the blob"""
+        cur = self.connection.cursor()
+        cur.execute(
+            "SELECT name FROM FILES WHERE owner=? AND digest=? LIMIT 1",
+            (user_state.login, digest),
+        )
+        result = cur.fetchone()
+        cur.close()
+        return result[0] if result is not None else None
+
+    # Groups (see group_session)
+
+    def create_group(
+        self,
+        user_state: UserState,
+        group_id: str,
+        name: str,
+        members: Iterable[str],
+    ) -> None:
+        cur = self.connection.cursor()
+        cur.execute(
+            "INSERT INTO GROUPS (owner, group_id, name) VALUES (?, ?, ?)",
+            (user_state.login, group_id, name),
+        )
+        cur.executemany(
+            "INSERT OR IGNORE INTO GROUP_MEMBERS (owner, group_id, member) "
+            "VALUES (?, ?, ?)",
+            [(user_state.login, group_id, member) for member in members],
+        )
+        self.connection.commit()
+        cur.close()
+
+    def group_exists(self, user_state: UserState, group_id: str) -> bool:
+        cur = self.connection.cursor()
+        cur.execute(
+            "SELECT 1 FROM GROUPS WHERE owner=? AND group_id=?",
+            (user_state.login, group_id),
+        )
+        result = cur.fetchone()
+        cur.close()
+        return result is not None
+
+    def get_group_name(self, user_state: UserState, group_id: str) -> str:
+        cur = self.connection.cursor()
+        cur.execute(
+            "SELECT name FROM GROUPS WHERE owner=? AND group_id=?",
+            (user_state.login, group_id),
+        )
+        result = cur.fetchone()
+        cur.close()
+        if result is None:
+            raise DatabaseControllerException(
+                f"User does not have the group {group_id}!!"
+            )
+        return result[0]
+
+    def get_user_groups(self, user_state: UserState) -> List[str]:
+        cur = self.connection.cursor()
+        cur.execute(
+            "SELECT group_id FROM GROUPS WHERE owner=? ORDER BY created",
+            (user_state.login,),
+        )
+        results = [group_id for group_id, in cur.fetchall()]
+        cur.close()
+        return results
+
+    def load_sender_keys(
+        self, user_state: UserState, group_id: str
+    ) -> Dict[str, Optional[bytes]]:
+        """Members of the group with their sender keys (if we have them)"""
+        cur = self.connection.cursor()
+        cur.execute(
+            "SELECT member, sender_key FROM GROUP_MEMBERS "
+            "WHERE owner=? AND group_id=?",
+            (user_state.login, group_id),
+        )
+        results = dict(cur.fetchall())
+        cur.close()
+        return results
+
+    def save_sender_key(
+        self,
+        user_state: UserState,
+        group_id: str,
+        member: str,
+        sender_key: Optional[bytes],
+    ) -> None:
+        cur = self.connection.cursor()
+        cur.execute(
+            "INSERT INTO GROUP_MEMBERS (owner, group_id, member, sender_key) "
+            "VALUES (?, ?, ?, ?) ON CONFLICT(owner, group_id, member) "
+            "DO UPDATE SET sender_key=excluded.sender_key",
+            (user_state.login, group_id, member, sender_key),
+        )
+        self.connection.commit()
+        cur.close()
+
+    def remove_group_member(
+        self, user_state: UserState, group_id: str, member: str
+    ) -> None:
+        cur = self.connection.cursor()
+        cur.execute(
+            "DELETE FROM GROUP_MEMBERS "
+            "WHERE owner=? AND group_id=? AND member=?",
+            (user_state.login, group_id, member),
+        )
+        self.connection.commit()
+        cur.close()
+
+    # Message history
+
+    def append_messages(
+        self,
+        user_state: UserState,
+        contact: str,
+        messages: Iterable[HistoryMessage],
+    ) -> None:
+        """Many messages of the chat in a single transaction"""
+        if not self.contact_exists(user_state, contact):
+            raise DatabaseControllerException(
+                f"User does not have the contact {contact}!!"
+            )
+        cur = self.connection.cursor()
+        cur.executemany(
+            "INSERT INTO MESSAGES (owner, contact, sender, timestamp, body) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [
+                (user_state.login, contact, sender, timestamp, body)
+                for sender, timestamp, body in messages
+            ],
+        )
+        self.connection.commit()
+        cur.close()
+
+    def load_messages(
+        self,
+        user_state: UserState,
+        contact: str,
+        /,
+        before: Optional[HistoryCursor] = None,
+        limit: int = HISTORY_PAGE_SIZE,
+    ) -> Tuple[List[HistoryMessage], Optional[HistoryCursor]]:
+        """
+        Page of the history, the newest one without before. Messages
+        are from the oldest, the cursor is for the page before them
+        (None when there is nothing older). The page is found by the
+        index (keyset pagination), it costs the same no matter how
+        long the history is
+        """
+        cur = self.connection.cursor()
+        if before is None:
+            cur.execute(
+                "SELECT id, sender, timestamp, body FROM MESSAGES "
+                "WHERE owner=? AND contact=? "
+                "ORDER BY timestamp DESC, id DESC LIMIT ?",
+                (user_state.login, contact, limit),
+            )
+        else:
+            cur.execute(
+                "SELECT id, sender, timestamp, body FROM MESSAGES "
+                "WHERE owner=? AND contact=? AND (timestamp, id) < (?, ?) "
+                "ORDER BY timestamp DESC, id DESC LIMIT ?",
+                (user_state.login, contact, *before, limit),
+            )
+        rows = cur.fetchall()
+        cur.close()
+
+        rows.reverse()
+        cursor = (rows[0][2], rows[0][0]) if len(rows) == limit else None
+        return [(sender, ts, body) for _, sender, ts, body in rows], cursor
+
+    def get_one_time_key(
         self, user_state: UserState, index: int
-    ) -> Tuple[X25519PrivateKey, X25519PrivateKey]:
+    ) -> X25519PrivateKey:
+        """The key stays in place, see replace_one_time_key"""
         cur = self.connection.cursor()
 
         cur.execute(
@@ -518,6 +1077,7 @@ class DatabaseController:
         )
 
         result = cur.fetchone()
+        cur.close()
 
         if result is None:
             raise DatabaseControllerException(
@@ -525,10 +1085,16 @@ class DatabaseController:
             )
 
         assert len(result) == 1, "There should be an unique key at given index"
-        result = result[0]
+        return create_private_key_from_b64(result[0])
 
-        current_key = create_private_key_from_b64(result)
-        new_one_time_key = generate_DH()
+    def replace_one_time_key(
+        self, user_state: UserState, index: int
+    ) -> Tuple[X25519PrivateKey, X25519PrivateKey]:
+        current_key = self.get_one_time_key(user_state, index)
+        cur = self.connection.cursor()
+        # the key is used only once, no reason to keep it decoded
+        evict_private_key(current_key)
+        new_one_time_key = pooled_DH()
 
         cur.execute(
             "UPDATE ONE_TIME_KEYS SET key=? WHERE key_index=? AND owner=?",
@@ -0,0 +1,47 @@
+from app.config import DB_BUSY_TIMEOUT, DurabilityProfile
+from typing import Dict, Tuple, Union
+import sqlite3
+
+PragmaValue = Union[int, str]
+
+# applied in that order, journal_mode must go before synchronous
+# because NORMAL is safe only in the WAL mode
+PROFILE_PRAGMAS: Dict[DurabilityProfile, Tuple[Tuple[str, PragmaValue], ...]]
+PROFILE_PRAGMAS = {
+    DurabilityProfile.STRICT: (
+        ("journal_mode", "DELETE"),
+        ("synchronous", "FULL"),
+        ("mmap_size", 0),
+        ("cache_size", -2000),  # negative is in KiB, sqlite default
+    ),
+    DurabilityProfile.DURABLE: (
+        ("journal_mode", "WAL"),
+        ("synchronous", "FULL"),
+        ("mmap_size", 64 * 1024 * 1024),
+        ("cache_size", -8 * 1024),
+    ),
+    DurabilityProfile.BALANCED: (
+        ("journal_mode", "WAL"),
+        ("synchronous", "NORMAL"),
+        ("mmap_size", 64 * 1024 * 1024),
+        ("cache_size", -8 * 1024),
+    ),
+    DurabilityProfile.FAST: (
+        ("journal_mode", "WAL"),
+        ("synchronous", "OFF"),
+        ("mmap_size", 256 * 1024 * 1024),
+        ("cache_size", -32 * 1024),
+    ),
+}
+
+
+def apply_profile(
+    connection: sqlite3.Connection,
+    profile: DurabilityProfile,
+    busy_timeout: int = DB_BUSY_TIMEOUT,
+) -> None:
+    """Set the pragmas of the profile on the fresh connection"""
+    pragmas = (*PROFILE_PRAGMAS[profile], ("busy_timeout", busy_timeout))
+    for name, value in pragmas:
+        # pragmas do not take parameters, values come only from above
+        connection.execute(f"PRAGMA {name}={value}").fetchall()
@@ -0,0 +1,173 @@
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from .db_controller import (
+    CONTACT_INFO_COLUMNS,
+    DatabaseController,
+    DatabaseControllerException,
+    contact_info,
+    initial_turn,
+    release_files,
+)
+from app.chat.crypto.crypto_utils import create_private_key_from_b64
+from app.user.user_state import UserState
+from typing import List, Optional, Tuple
+
+
+class OwnerDAO:
+    """
+    Database operations of the logged in user. The owner is checked
+    once, when the object is made (at login), so the operations do
+    not ask USERS about it again and every one of them is a single
+    statement. DatabaseController checks the owner on every call.
+
+    Owner must not be deleted while the object is used
+    """
+
+    def __init__(
+        self, db_controller: DatabaseController, user_state: UserState
+    ) -> None:
+        if not db_controller.user_exists(user_state):
+            raise DatabaseControllerException(
+                f"User {user_state.login} does not exist!!"
+            )
+        self.db_controller = db_controller
+        self.user_state = user_state
+        self.owner = user_state.login
+
+    @property
+    def connection(self):
+        return self.db_controller.connection
+
+    # Contacts
+
+    def add_contact(
+        self,
+        contact: str,
+        b64_id_key: str,
+        shared_key: str,
+        /,
+        contact_signed_pre_key: Optional[str] = None,
+        contact_ephemeral_key: Optional[str] = None,
+        my_ephemeral_key: Optional[str] = None,
+        contact_otk_key: Optional[str] = None,
+        my_otk_key: Optional[str] = None,
+    ) -> bool:
+        """False when the contact already exists (it is not changed)"""
+        if contact == self.owner:
+            raise DatabaseControllerException(
+                "Cannot add self to the contacts!!!"
+            )
+        my_turn = initial_turn(
+            contact_signed_pre_key,
+            contact_ephemeral_key,
+            my_ephemeral_key,
+            contact_otk_key,
+            my_otk_key,
+        )
+
+        cur = self.connection.cursor()
+        cur.execute(
+            "INSERT INTO CONTACTS "
+            "(owner, login, public_id_key, public_signed_pre_key, "
+            "shared_x3dh_key, my_ephemeral_key, contact_ephemeral_key, "
+            "my_otk_key, contact_otk_key, my_turn) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(owner, login) DO NOTHING RETURNING login",
+            (
+                self.owner,
+                contact,
+                b64_id_key,
+                contact_signed_pre_key,
+                shared_key,
+                my_ephemeral_key,
+                contact_ephemeral_key,
+                my_otk_key,
+                contact_otk_key,
+                int(my_turn),
+            ),
+        )
+        added = cur.fetchone() is not None
+        self.connection.commit()
+        cur.close()
+        return added
+
+    def get_contact_info(self, contact: str) -> Optional[dict]:
+        cur = self.connection.cursor()
+        cur.execute(
+            f"SELECT {', '.join(CONTACT_INFO_COLUMNS)} FROM CONTACTS "
+            "WHERE owner=? AND login=?",
+            (self.owner, contact),
+        )
+        row = cur.fetchone()
+        cur.close()
+        return contact_info(contact, row) if row is not None else None
+
+    def contact_exists(self, contact: str) -> bool:
+        cur = self.connection.cursor()
+        cur.execute(
+            "SELECT 1 FROM CONTACTS WHERE owner=? AND login=?",
+            (self.owner, contact),
+        )
+        result = cur.fetchone()
+        cur.close()
+        return result is not None
+
+    def delete_contact(self, contact: str) -> None:
+        cur = self.connection.cursor()
+        cur.execute(
+            "DELETE FROM CONTACTS WHERE owner=? AND login=? RETURNING login",
+            (self.owner, contact),
+        )
+        if cur.fetchone() is None:
+            cur.close()
+            self.connection.rollback()
+            raise DatabaseControllerException(
+                "Cannot delete not existing contact"
+            )
+        cur.execute(
+            "DELETE FROM SKIPPED_MESSAGE_KEYS WHERE owner=? AND contact=?",
+            (self.owner, contact),
+        )
+        cur.execute(
+            "DELETE FROM MESSAGES WHERE owner=? AND contact=?",
+            (self.owner, contact),
+        )
+        release_files(cur, self.owner, contact)
+        self.connection.commit()
+        cur.close()
+
+    def get_contacts(self) -> List[str]:
+        cur = self.connection.cursor()
+        cur.execute("SELECT login FROM CONTACTS WHERE owner=?", (self.owner,))
+        results = [login for login, in cur.fetchall()]
+        cur.close()
+        return results
+
+    # Keys
+
+    def get_otk(self) -> List[bytes]:
+        cur = self.connection.cursor()
+        cur.execute(
+            "SELECT key FROM ONE_TIME_KEYS WHERE owner=? ORDER BY key_index",
+            (self.owner,),
+        )
+        results = [key for key, in cur.fetchall()]
+        cur.close()
+        return results
+
+    def get_keys(self) -> Tuple[X25519PrivateKey, X25519PrivateKey]:
+        cur = self.connection.cursor()
+        cur.execute(
+            "SELECT id_key, signed_pre_key FROM USERS WHERE login=?",
+            (self.owner,),
+        )
+        result = cur.fetchone()
+        cur.close()
+
+        if result is None or None in result:
+            raise DatabaseControllerException(
+                "One of the keys is not present in the database"
+            )
+        return (
+            create_private_key_from_b64(result[0]),
+            create_private_key_from_b64(result[1]),
+        )
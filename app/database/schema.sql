@@ -1,20 +1,18 @@
 
-CREATE TABLE USERS(
+CREATE TABLE IF NOT EXISTS USERS(
     login VARCHAR(255) PRIMARY KEY,
     created DATETIME DEFAULT CURRENT_TIMESTAMP,
     id_key TEXT NOT NULL,
     signed_pre_key TEXT NOT NULL
 );
 
-CREATE TABLE CONTACTS(
+CREATE TABLE IF NOT EXISTS CONTACTS(
     owner VARCHAR(255) NOT NULL,
     login VARCHAR(255) NOT NULL,
 
     shared_x3dh_key TEXT NOT NULL,
-    dh_ratchet TEXT,
-    send_ratchet TEXT,
-    recv_ratchet TEXT,
-    root_ratchet TEXT,
+    -- binary snapshot of the ratchets, see RatchetSet.to_bytes
+    ratchet_state BLOB,
 
     public_id_key TEXT NOT NULL,
     public_signed_pre_key TEXT,
@@ -29,10 +27,74 @@ CREATE TABLE CONTACTS(
     PRIMARY KEY (owner, login)
 );
 
-CREATE TABLE ONE_TIME_KEYS(
+CREATE TABLE IF NOT EXISTS ONE_TIME_KEYS(
     key_index INTEGER NOT NULL,
     owner VARCHAR(255) NOT NULL,
     key TEXT,
     FOREIGN KEY(owner) REFERENCES USERS(login),
     PRIMARY KEY (key_index, owner)
-);
\ No newline at end of file
+);
+
+CREATE TABLE IF NOT EXISTS SKIPPED_MESSAGE_KEYS(
+    owner VARCHAR(255) NOT NULL,
+    contact VARCHAR(255) NOT NULL,
+    dh_key BLOB NOT NULL,
+    message_number INTEGER NOT NULL,
+    message_key BLOB NOT NULL,
+    created REAL NOT NULL,
+    FOREIGN KEY(owner, contact) REFERENCES CONTACTS(owner, login),
+    PRIMARY KEY (owner, contact, dh_key, message_number)
+);
+CREATE TABLE IF NOT EXISTS BLOBS(
+    -- sha256 of the content, the file name inside of the blob store
+    digest CHAR(64) PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refcount INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS FILES(
+    -- every file recieved from the contact is one reference of its blob
+    owner VARCHAR(255) NOT NULL,
+    contact VARCHAR(255) NOT NULL,
+    digest CHAR(64) NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    FOREIGN KEY(owner, contact) REFERENCES CONTACTS(owner, login),
+    FOREIGN KEY(digest) REFERENCES BLOBS(digest)
+);
+CREATE INDEX IF NOT EXISTS FILES_CONTACT ON FILES(owner, contact);
+
+CREATE TABLE IF NOT EXISTS GROUPS(
+    owner VARCHAR(255) NOT NULL,
+    -- random id, the same for every member of the group
+    group_id CHAR(32) NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    created DATETIME DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY(owner) REFERENCES USERS(login),
+    PRIMARY KEY (owner, group_id)
+);
+
+CREATE TABLE IF NOT EXISTS GROUP_MEMBERS(
+    owner VARCHAR(255) NOT NULL,
+    group_id CHAR(32) NOT NULL,
+    member VARCHAR(255) NOT NULL,
+    -- SenderKeyState.to_bytes, null until the member sends us its key
+    sender_key BLOB,
+    FOREIGN KEY(owner, group_id) REFERENCES GROUPS(owner, group_id),
+    PRIMARY KEY (owner, group_id, member)
+);
+
+CREATE TABLE IF NOT EXISTS MESSAGES(
+    -- rowid, orders the messages with the same timestamp
+    id INTEGER PRIMARY KEY,
+    owner VARCHAR(255) NOT NULL,
+    contact VARCHAR(255) NOT NULL,
+    sender VARCHAR(255) NOT NULL,
+    -- unix time in seconds
+    timestamp REAL NOT NULL,
+    body TEXT NOT NULL,
+    FOREIGN KEY(owner, contact) REFERENCES CONTACTS(owner, login)
+);
+-- pages of the history are read backwards by this index, sqlite
+-- keeps the rowid in every index entry so (timestamp, id) is in it
+CREATE INDEX IF NOT EXISTS MESSAGES_HISTORY
+    ON MESSAGES(owner, contact, timestamp);
@@ -5,3 +5,4 @@ class ApiRoutes:
     ONE_TIME_KEY = "/crypto/one-time-key"
     ONE_TIME_KEY_LIST = "/crypto/one-time-key-list"
     CHAT_OPER = "/chat"
+    GROUP_OPER = "/chat/group"
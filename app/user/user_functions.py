@@ -1,4 +1,4 @@
-from app.chat.crypto.crypto_utils import generate_DH
+from app.chat.crypto.key_pool import pooled_DH
 from .user_state import UserState
 from app.database.db_controller import DatabaseController
 
@@ -11,8 +11,8 @@ def resolve_user_state(user_state: UserState, db_path: str) -> bool:
     id_key, signed_pre_key = db_controller.get_user_keys(user_state)
 
     if id_key is None or signed_pre_key is None:
-        user_state.id_key = generate_DH()
-        user_state.signed_pre_key = generate_DH()
+        user_state.id_key = pooled_DH()
+        user_state.signed_pre_key = pooled_DH()
         db_controller.set_user_keys(user_state)
     else:
         user_state.id_key = id_key
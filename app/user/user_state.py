@@ -1,4 +1,7 @@
-from app.chat.crypto.crypto_utils import create_b64_from_private_key
+from app.chat.crypto.crypto_utils import (
+    create_b64_from_private_key,
+    create_b64_from_public_key,
+)
 from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
 from typing import Optional
 import binascii
@@ -15,14 +18,27 @@ class UserState:
     Using slots because atributes in this class will be accessed
     quite frequently. Data in this class is not declared on the
     startup.
+    Values derived from the keys (signature, encoded public keys)
+    are computed once and dropped when the keys change.
     """
 
-    __slots__ = ("_login", "_password", "_id_key", "_signed_pre_key")
+    __slots__ = (
+        "_login",
+        "_password",
+        "_id_key",
+        "_signed_pre_key",
+        "_signature",
+        "_public_id_key_b64",
+        "_public_signed_pre_key_b64",
+    )
 
     def __init__(self, login: str):
         self._login: str = login
         self._id_key: Optional[X25519PrivateKey] = None
         self._signed_pre_key: Optional[X25519PrivateKey] = None
+        self._signature: Optional[bytes] = None
+        self._public_id_key_b64: Optional[bytes] = None
+        self._public_signed_pre_key_b64: Optional[bytes] = None
 
     @property
     def login(self) -> str:
@@ -38,14 +54,38 @@ class UserState:
 
     @property
     def signature(self) -> bytes:
+        if self._signature is not None:
+            return self._signature
+
         if self.id_key is None or self.signed_pre_key is None:
             raise UserStateException(
                 "Cannot set the signature without both keys "
                 "(id_key and pre_singed)"
             )
-        return binascii.b2a_base64(
+        self._signature = binascii.b2a_base64(
             self.id_key.exchange(self.signed_pre_key.public_key())
         )
+        return self._signature
+
+    @property
+    def public_id_key_b64(self) -> bytes:
+        if self._public_id_key_b64 is None:
+            if self.id_key is None:
+                raise UserStateException("Id key is not set")
+            self._public_id_key_b64 = create_b64_from_public_key(
+                self.id_key.public_key()
+            )
+        return self._public_id_key_b64
+
+    @property
+    def public_signed_pre_key_b64(self) -> bytes:
+        if self._public_signed_pre_key_b64 is None:
+            if self.signed_pre_key is None:
+                raise UserStateException("Signed pre key is not set")
+            self._public_signed_pre_key_b64 = create_b64_from_public_key(
+                self.signed_pre_key.public_key()
+            )
+        return self._public_signed_pre_key_b64
 
     # Setters - had to invoke those methods for debugging purposes
 
@@ -63,10 +103,14 @@ class UserState:
             new_id (str): encoded private keyin base64
         """
         self._id_key = new_id
+        self._signature = None
+        self._public_id_key_b64 = None
 
     @signed_pre_key.setter
     def signed_pre_key(self, spk_key: X25519PrivateKey):
         self._signed_pre_key = spk_key
+        self._signature = None
+        self._public_signed_pre_key_b64 = None
 
     @staticmethod
     def repr_private_key(key: Optional[X25519PrivateKey]):
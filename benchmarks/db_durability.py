@@ -0,0 +1,82 @@
+"""
+Latency of a single save_ratchets (UPDATE + commit, what every
+message costs) under every durability profile. Run from the repo root:
+
+    python -m benchmarks.db_durability [number of saves] [directory]
+
+The directory should be on the disk the app uses, fsync on tmpfs
+costs nothing and all the profiles look the same there.
+"""
+from app.chat.crypto.crypto_utils import generate_DH
+from app.chat.crypto.inner_ratchet import InnerRatchet
+from app.chat.crypto.ratchet_set import RatchetSet
+from app.config import DurabilityProfile
+from app.database.connection_registry import connection_registry
+from app.database.db_controller import DatabaseController
+from app.user.user_state import UserState
+from secrets import token_bytes
+from time import perf_counter
+import os
+import statistics
+import sys
+import tempfile
+
+DEFAULT_SAVES = 500
+
+
+def make_ratchet_set() -> RatchetSet:
+    r_set = RatchetSet()
+    r_set.dh_ratchet = generate_DH()
+    r_set.send_ratchet = InnerRatchet(token_bytes(32))
+    r_set.recv_ratchet = InnerRatchet(token_bytes(32))
+    r_set.root_ratchet = InnerRatchet(token_bytes(32))
+    return r_set
+
+
+def run_profile(
+    profile: DurabilityProfile, saves: int, directory: str
+) -> None:
+    db_path = os.path.join(directory, f"durability_{profile.value}.db")
+    connection_registry.remove_database(db_path)
+    connection_registry.profile = profile
+
+    db_controller = DatabaseController(DB_PATH=db_path)
+    owner = UserState("owner")
+    db_controller.create_user(owner)
+    db_controller.add_contact(
+        owner,
+        "contact",
+        "3+IWTHCIArgvY+WLWXSk6w==",
+        "LiF1F733QbLg1fMBjCmerQ==",
+        contact_ephemeral_key="cWpmLwqk5+/5ZPiD7FOnjw==",
+        my_otk_key="11CYXDhP3n3ND9S1nLk",
+    )
+    r_set = make_ratchet_set()
+
+    latencies = []
+    for i in range(saves):
+        r_set.send_count = i
+        start = perf_counter()
+        db_controller.save_ratchets(owner, "contact", r_set, i % 2 == 0)
+        latencies.append((perf_counter() - start) * 1e6)
+
+    latencies.sort()
+    print(
+        f"{profile.value:>8}: "
+        f"mean {statistics.mean(latencies):8.1f} us, "
+        f"p50 {latencies[len(latencies) // 2]:8.1f} us, "
+        f"p99 {latencies[int(len(latencies) * 0.99)]:8.1f} us"
+    )
+    connection_registry.remove_database(db_path)
+
+
+def main() -> None:
+    saves = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SAVES
+    directory = sys.argv[2] if len(sys.argv) > 2 else tempfile.gettempdir()
+    print(f"{saves} saves of the ratchets in {directory}")
+    for profile in DurabilityProfile:
+        run_profile(profile, saves, directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Resident memory per session: RatchetSet object graph vs SessionStore.
+
+Every variant runs in a fresh interpreter so that the memory of one
+does not hide in the allocator of the other. Run from the repo root:
+
+    python -m benchmarks.session_memory [number of sessions]
+"""
+from app.chat.crypto.crypto_utils import generate_DH
+from app.chat.crypto.inner_ratchet import InnerRatchet
+from app.chat.crypto.ratchet_set import RatchetSet
+from app.chat.crypto.session_store import SessionStore
+from secrets import token_bytes
+import subprocess
+import sys
+import tracemalloc
+
+DEFAULT_SESSIONS = 100_000
+
+
+def rss_bytes() -> int:
+    with open("/proc/self/statm") as statm:
+        resident_pages = int(statm.read().split()[1])
+    return resident_pages * 4096
+
+
+def make_ratchet_set() -> RatchetSet:
+    r_set = RatchetSet()
+    r_set.dh_ratchet = generate_DH()
+    r_set.send_ratchet = InnerRatchet(token_bytes(32))
+    r_set.recv_ratchet = InnerRatchet(token_bytes(32))
+    r_set.root_ratchet = InnerRatchet(token_bytes(32))
+    r_set.remote_dh_key = token_bytes(32)
+    return r_set
+
+
+def run_variant(variant: str, sessions: int) -> None:
+    # prepared ahead, the same for both variants
+    keys = [("owner", f"contact{i}") for i in range(sessions)]
+    template = make_ratchet_set()
+
+    tracemalloc.start()
+    rss_before = rss_bytes()
+
+    if variant == "objects":
+        kept = {key: make_ratchet_set() for key in keys}
+    else:
+        kept = SessionStore(capacity=sessions)
+        record = template.to_bytes(True)
+        for key in keys:
+            kept.put_record(key, record)
+
+    heap, _ = tracemalloc.get_traced_memory()
+    rss = rss_bytes() - rss_before
+    print(
+        f"{variant:>8}: {rss / sessions:8.1f} B/session resident, "
+        f"{heap / sessions:8.1f} B/session python heap"
+    )
+
+
+def main() -> None:
+    if len(sys.argv) > 2:
+        run_variant(sys.argv[2], int(sys.argv[1]))
+        return
+
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SESSIONS
+    print(f"{sessions} sessions")
+    for variant in ("objects", "store"):
+        subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.session_memory",
+                str(sessions),
+                variant,
+            ],
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
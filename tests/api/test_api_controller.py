@@ -0,0 +1,157 @@
+from app.api.api_controller import ApiController, ApiControllerException
+from app.chat.crypto_controller import (
+    CryptoController,
+    CryptoControllerException,
+)
+from app.chat.session_manager import session_manager
+from app.chat.crypto.crypto_utils import (
+    create_b64_from_private_key,
+    create_b64_from_public_key,
+    create_private_key_from_b64,
+    create_shared_key_X3DH_guest,
+    generate_DH,
+)
+from app.database.db_controller import DatabaseController
+from app.user.user_state import UserState
+from app.config import PREFFERED_ENCODING
+import asyncio
+import binascii
+import pytest
+
+
+def start_session(db_controller, db_path, alice, bob, otk_index):
+    """alice adds bob and prepares her part of the X3DH"""
+    ephemeral_key = generate_DH()
+    bob_otk = create_private_key_from_b64(
+        db_controller.get_user_otk(bob)[otk_index]
+    )
+    shared_key = create_shared_key_X3DH_guest(
+        alice.id_key,
+        ephemeral_key,
+        bob.id_key.public_key(),
+        bob.signed_pre_key.public_key(),
+        bob_otk.public_key(),
+    )
+    db_controller.add_contact(
+        alice,
+        "bob",
+        create_b64_from_public_key(bob.id_key.public_key()).decode(
+            PREFFERED_ENCODING
+        ),
+        binascii.b2a_base64(shared_key).decode(PREFFERED_ENCODING),
+        contact_signed_pre_key=create_b64_from_public_key(
+            bob.signed_pre_key.public_key()
+        ).decode(PREFFERED_ENCODING),
+        my_ephemeral_key=create_b64_from_private_key(ephemeral_key).decode(
+            PREFFERED_ENCODING
+        ),
+        contact_otk_key=create_b64_from_public_key(
+            bob_otk.public_key()
+        ).decode(PREFFERED_ENCODING),
+    )
+    session = CryptoController(alice, "bob", DB_PATH=db_path)
+    session.init_ratchets(opt_public_key=bob.signed_pre_key.public_key())
+    x3dh = {
+        "public_id_key": alice.public_id_key_b64.decode(PREFFERED_ENCODING),
+        "public_ephemeral_key": create_b64_from_public_key(
+            ephemeral_key.public_key()
+        ).decode(PREFFERED_ENCODING),
+        "otk_index": otk_index,
+    }
+    return session, x3dh
+
+
+@pytest.fixture
+def users(tmp_path):
+    db_path = str(tmp_path / "users.db")
+    db_controller = DatabaseController(DB_PATH=db_path)
+    alice, bob = UserState("alice"), UserState("bob")
+    db_controller.create_user(alice)
+    db_controller.create_user(bob)
+    yield db_controller, db_path, alice, bob
+    session_manager.invalidate("bob", "alice")
+
+
+@pytest.mark.asyncio
+async def test_accept_session_start(mocker, users):
+    db_controller, db_path, alice, bob = users
+    api_controller = ApiController(
+        bob, db_controller, init_session=False, db_path=db_path
+    )
+    publish = mocker.patch.object(api_controller, "publish_one_time_key")
+
+    alice_session, x3dh = start_session(db_controller, db_path, alice, bob, 3)
+    message = alice_session.encrypt_session_start("hi bob", x3dh)
+    assert message["head"]["reciever"] == "bob"
+
+    # bob reads the first message without approving any invite
+    assert await api_controller.accept_session_start(message) == "hi bob"
+    assert db_controller.contact_exists(bob, "alice")
+    publish.assert_called_once()
+    assert publish.call_args[0][1] == 3
+
+    # the session goes on as usual
+    bob_session = session_manager.get(bob, "alice", DB_PATH=db_path)
+    assert alice_session.decrypt_json_message(
+        bob_session.encrypt_to_json_message("hi alice")
+    ) == "hi alice"
+
+
+@pytest.mark.asyncio
+async def test_reject_bad_session_start(mocker, users):
+    db_controller, db_path, alice, bob = users
+    api_controller = ApiController(
+        bob, db_controller, init_session=False, db_path=db_path
+    )
+    publish = mocker.patch.object(api_controller, "publish_one_time_key")
+    one_time_keys = db_controller.get_user_otk(bob)
+
+    alice_session, x3dh = start_session(db_controller, db_path, alice, bob, 3)
+    message = alice_session.encrypt_session_start("hi bob", x3dh)
+    # keys which do not match the ciphertext
+    message["head"]["x3dh"]["public_ephemeral_key"] = (
+        create_b64_from_public_key(generate_DH().public_key()).decode(
+            PREFFERED_ENCODING
+        )
+    )
+
+    with pytest.raises(CryptoControllerException):
+        await api_controller.accept_session_start(message)
+    assert not db_controller.contact_exists(bob, "alice")
+    # forged message does not use up the one time key
+    assert db_controller.get_user_otk(bob) == one_time_keys
+    publish.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_contact_is_approved_once(mocker, users):
+    db_controller, db_path, alice, bob = users
+    api_controller = ApiController(
+        bob, db_controller, init_session=False, db_path=db_path
+    )
+    publish = mocker.patch.object(api_controller, "publish_one_time_key")
+
+    alice_session, x3dh = start_session(db_controller, db_path, alice, bob, 3)
+    first = alice_session.encrypt_session_start("hi bob", x3dh)
+    second = alice_session.encrypt_session_start("are you there?", x3dh)
+
+    # both first messages come at once, only one of them approves
+    assert await asyncio.gather(
+        api_controller.accept_session_start(first),
+        api_controller.accept_session_start(second),
+    ) == ["hi bob", "are you there?"]
+    publish.assert_called_once()
+
+    # the same invite again does not touch the one time key
+    one_time_keys = db_controller.get_user_otk(bob)
+    invite = {"my_login": "alice", **x3dh}
+    with pytest.raises(ApiControllerException):
+        api_controller.approve_new_contact(invite)
+    with pytest.raises(ApiControllerException):
+        await api_controller.approve_new_contact_async(invite)
+    assert db_controller.get_user_otk(bob) == one_time_keys
+
+    bob_session = session_manager.get(bob, "alice", DB_PATH=db_path)
+    assert alice_session.decrypt_json_message(
+        bob_session.encrypt_to_json_message("hi alice")
+    ) == "hi alice"
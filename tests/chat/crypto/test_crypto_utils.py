@@ -11,15 +11,55 @@ from app.chat.crypto.crypto_utils import (
     private_key_to_bytes,
     aead_encrypt,
     aead_decrypt,
+    hkdf,
+    hkdf_hmac,
+    get_kdf,
+    benchmark_cipher_suites,
+    evict_private_key,
+    private_key_cache,
+)
+from app.chat.crypto.key_cache import KeyCache
+from app.chat.crypto.inner_ratchet import InnerRatchet
+from app.chat.crypto.key_pool import KeyPairPool
+from app.chat.crypto.file_stream import (
+    FileStreamException,
+    StreamDecryptor,
+    StreamEncryptor,
+    decrypt_file,
+    encrypt_file,
+)
+from app.chat.crypto.compression import (
+    CompressionException,
+    MessageCompressor,
+    main as build_dictionary,
+    train_dictionary,
+)
+from app.chat.crypto.crypto_executor import (
+    aead_decrypt_async,
+    aead_encrypt_async,
+    create_shared_key_X3DH_establisher_async,
+    create_shared_key_X3DH_guest_async,
+    run_in_crypto_executor,
 )
 from cryptography.hazmat.primitives.asymmetric.x25519 import (
     X25519PrivateKey,
     X25519PublicKey,
 )
 from app.user.user_state import UserState
-from app.config import MAX_ONE_TIME_KEYS, PREFFERED_ENCODING
+from app.config import (
+    MAX_ONE_TIME_KEYS,
+    PREFFERED_ENCODING,
+    RATCHET_STATE_KEY_LENGTH,
+    SHARED_KEY_LENGTH,
+    CipherSuite,
+)
+from cryptography.exceptions import InvalidTag
+from secrets import token_bytes
+import io
 import os
 import pytest
+import threading
+import time
 
 TEST_DB_PATH = "test_user.db"
 
@@ -47,6 +87,78 @@ def test_aead_encryption():
     assert test_text == decrypted
 
 
+@pytest.mark.parametrize("suite", list(CipherSuite))
+def test_aead_cipher_suites(suite):
+    test_text = "mn,XCZCXZ ąćźśęŁÓŃ↑↑↑↑".encode("utf-8")
+    key = token_bytes(SHARED_KEY_LENGTH)
+
+    enc = aead_encrypt(key, test_text, b"ad", suite=suite)
+    assert aead_decrypt(key, enc, b"ad", suite=suite) == test_text
+    # padded keys must also work for both of the suites
+    enc_padded = aead_encrypt(b"short key", test_text, pad=True, suite=suite)
+    assert (
+        aead_decrypt(b"short key", enc_padded, pad=True, suite=suite)
+        == test_text
+    )
+
+    other = next(s for s in CipherSuite if s is not suite)
+    with pytest.raises(InvalidTag):
+        aead_decrypt(key, enc, b"ad", suite=other)
+
+
+def test_benchmark_cipher_suites():
+    results = benchmark_cipher_suites(payload_size=64, rounds=2)
+    assert set(results) == set(CipherSuite)
+    assert all(t > 0 for t in results.values())
+
+
+def test_hkdf_hmac_rfc5869_vectors():
+    """Known answer tests from RFC 5869 (test case 1 and 3)"""
+    okm = hkdf_hmac(
+        bytes.fromhex("0b" * 22),
+        42,
+        salt=bytes.fromhex("000102030405060708090a0b0c"),
+        info=bytes.fromhex("f0f1f2f3f4f5f6f7f8f9"),
+    )
+    assert okm == bytes.fromhex(
+        "3cb25f25faacd57a90434f64d0362f2a2d2d0a90cf1a5a4c5db0"
+        "2d56ecc4c5bf34007208d5b887185865"
+    )
+
+    okm = hkdf_hmac(bytes.fromhex("0b" * 22), 42, salt=b"")
+    assert okm == bytes.fromhex(
+        "8da4e775a563c18f715f802a063c5a31b8a11f5c5ee1879ec345"
+        "4e5f3c738d2d9d201395faa4b61a96c8"
+    )
+
+
+@pytest.mark.parametrize(
+    "length", [1, SHARED_KEY_LENGTH, 33, RATCHET_STATE_KEY_LENGTH, 100]
+)
+def test_hkdf_hmac_equals_hkdf(length):
+    """
+    Fast kdf must give exactly the same output as the
+    original one, otherwise saved ratchets would be lost
+    """
+    for inp in (b"", token_bytes(15), token_bytes(32), token_bytes(96)):
+        assert hkdf_hmac(inp, length) == hkdf(inp, length)
+
+
+def test_ratchet_kdf_backends_are_interchangeable():
+    shared = token_bytes(SHARED_KEY_LENGTH)
+    slow = InnerRatchet(shared, kdf=get_kdf("cryptography"))
+    fast = InnerRatchet(shared, kdf=get_kdf("hmac"))
+
+    for i in range(20):
+        inp = token_bytes(32) if i % 5 == 0 else b""
+        assert slow.turn(inp) == fast.turn(inp)
+
+    assert slow.get_snapshot() == fast.get_snapshot()
+
+    with pytest.raises(ValueError):
+        get_kdf("md5")
+
+
 def test_diffie_hellman_exchange():
     key_0 = generate_DH()
     key_1 = generate_DH()
@@ -56,6 +168,66 @@ def test_diffie_hellman_exchange():
     assert secret_0 == secret_1
 
 
+def test_key_cache():
+    loaded = []
+
+    def loader(encoded):
+        loaded.append(encoded)
+        return create_public_key_from_b64(encoded)
+
+    cache = KeyCache(loader, 2)
+    keys = [
+        create_b64_from_public_key(generate_DH().public_key())
+        for _ in range(3)
+    ]
+
+    first = cache.get(keys[0])
+    assert cache.get(keys[0].decode(PREFFERED_ENCODING)) is first
+    cache.get(keys[1])
+    cache.get(keys[2])
+    assert len(cache) == 2, "cache must be bounded"
+    assert cache.stats == {"hits": 1, "misses": 3, "size": 2}
+
+    # the least recently used key was dropped
+    cache.get(keys[0])
+    assert loaded == [keys[0], keys[1], keys[2], keys[0]]
+
+    cache.evict(keys[0])
+    assert len(cache) == 1
+
+
+def test_evict_private_key():
+    private_key = generate_DH()
+    b64_key = create_b64_from_private_key(private_key)
+
+    decoded = create_private_key_from_b64(b64_key)
+    assert create_private_key_from_b64(b64_key) is decoded
+
+    evict_private_key(decoded)
+    assert create_private_key_from_b64(b64_key) is not decoded
+    private_key_cache.evict(b64_key)
+
+
+def test_key_pair_pool():
+    pool = KeyPairPool(high_water=4, low_water=2, autostart=False)
+    pool.fill()
+    assert len(pool) == 4
+
+    # pool is not started, so the keys are not refilled
+    keys = [pool.get() for _ in range(6)]
+    assert pool.stats == {"hits": 4, "misses": 2, "size": 0}
+    assert len({private_key_to_bytes(k) for k in keys}) == 6
+
+    pool.start()
+    pool.get()
+    for _ in range(200):
+        if len(pool) == pool.high_water:
+            break
+        time.sleep(0.01)
+    pool.stop()
+    assert len(pool) == pool.high_water, "pool was not refilled"
+
+
 def test_assigned_starter_keys(mocker):
     """Scenario: Alice wants to meet Bob
     in the app.
@@ -333,3 +505,120 @@ async def test_full_x3dh(mocker):
     assert (
         alice_shared_secret == bob_shared_secret
     ), "The end secrets are not equal!!!"
+
+
+@pytest.mark.asyncio
+async def test_crypto_executor():
+    # the work really leaves the event loop thread
+    worker = await run_in_crypto_executor(threading.current_thread)
+    assert worker is not threading.current_thread()
+
+    alice_id, alice_ephem = generate_DH(), generate_DH()
+    bob_id, bob_spk, bob_otk = generate_DH(), generate_DH(), generate_DH()
+
+    guest_key = await create_shared_key_X3DH_guest_async(
+        alice_id,
+        alice_ephem,
+        bob_id.public_key(),
+        bob_spk.public_key(),
+        bob_otk.public_key(),
+    )
+    estab_key = await create_shared_key_X3DH_establisher_async(
+        bob_id,
+        bob_spk,
+        bob_otk,
+        alice_id.public_key(),
+        alice_ephem.public_key(),
+    )
+    assert guest_key == estab_key == create_shared_key_X3DH_guest(
+        alice_id,
+        alice_ephem,
+        bob_id.public_key(),
+        bob_spk.public_key(),
+        bob_otk.public_key(),
+    )
+
+    key = token_bytes(SHARED_KEY_LENGTH)
+    # small payload stays on the loop, big one goes to the pool
+    for payload in (b"hi", os.urandom(256 * 1024)):
+        encrypted = await aead_encrypt_async(key, payload)
+        assert encrypted == aead_encrypt(key, payload)
+        assert await aead_decrypt_async(key, encrypted) == payload
+
+
+def make_alert(i: int) -> str:
+    return (
+        f"2026-10-18 12:{i % 60:02d}:07 ALERT host=db-{i % 7} "
+        "service=postgres severity=critical message=Replication lag "
+        f"exceeded threshold lag_seconds={i * 13} threshold_seconds=30 "
+        "runbook=https://wiki.example.com/runbooks/replication-lag"
+    )
+
+
+def test_compression_dictionary():
+    dictionary = train_dictionary(make_alert(i) for i in range(50))
+    assert 0 < len(dictionary) <= 32 * 1024
+
+    plain = MessageCompressor(min_size=64)
+    trained = MessageCompressor(dictionary, min_size=64)
+    message = make_alert(1234).encode()
+
+    compressed = trained.compress(message)
+    assert trained.decompress(compressed) == message
+    # alert is too short for zlib alone, the dictionary makes it work
+    assert len(compressed) < len(plain.compress(message) or message) / 2
+
+    # short messages and incompressible ones are left as they are
+    assert trained.compress(b"short") is None
+    assert trained.compress(os.urandom(1024)) is None
+
+    with pytest.raises(CompressionException):
+        plain.decompress(compressed)
+    with pytest.raises(CompressionException):
+        trained.decompress(compressed[:-4])
+    with pytest.raises(CompressionException):
+        plain.decompress(plain.compress(bytes(1 << 20)), max_size=1 << 16)
+
+
+def test_build_dictionary_file(tmp_path):
+    samples = tmp_path / "samples.txt"
+    samples.write_text("\n".join(make_alert(i) for i in range(50)) + "\n")
+    build_dictionary(str(samples), str(tmp_path / "dictionary.bin"))
+
+    dictionary = (tmp_path / "dictionary.bin").read_bytes()
+    message = make_alert(1234).encode()
+    compressor = MessageCompressor(dictionary, min_size=64)
+    assert len(compressor.compress(message)) < len(message) / 2
+
+
+@pytest.mark.parametrize("size", [0, 1, 4096, 4096 * 3 + 17])
+def test_stream_file_encryption(size):
+    key = token_bytes(SHARED_KEY_LENGTH)
+    data = os.urandom(size)
+    encryptor = StreamEncryptor(key, additional_data=b"transfer")
+
+    chunks = list(encrypt_file(encryptor, io.BytesIO(data), chunk_size=4096))
+    assert len(chunks) == max(1, -(-size // 4096))
+    assert [last for _, last in chunks] == [False] * (len(chunks) - 1) + [
+        True
+    ]
+
+    def decryptor():
+        return StreamDecryptor(
+            key, encryptor.nonce_prefix, additional_data=b"transfer"
+        )
+
+    sink = io.BytesIO()
+    assert decrypt_file(decryptor(), chunks, sink) == size
+    assert sink.getvalue() == data
+
+    # cutting off the end is detected, also on the chunk boundary
+    with pytest.raises(FileStreamException):
+        decrypt_file(decryptor(), chunks[:-1], io.BytesIO())
+    with pytest.raises(FileStreamException):
+        decrypt_file(decryptor(), [(chunks[-1][0], False)], io.BytesIO())
+    if len(chunks) > 1:
+        with pytest.raises(FileStreamException):
+            decrypt_file(decryptor(), chunks[::-1], io.BytesIO())
+    with pytest.raises(FileStreamException):
+        encryptor.encrypt_chunk(b"more", True)
@@ -1,12 +1,24 @@
 from app.user.user_state import UserState
 from secrets import token_bytes
-from app.config import PREFFERED_ENCODING, SHARED_KEY_LENGTH
+from app.config import PREFFERED_ENCODING, SHARED_KEY_LENGTH, CipherSuite
 from app.chat.crypto.inner_ratchet import InnerRatchet
 from app.chat.crypto_controller import (
     CryptoController,
     CryptoControllerException,
 )
-from app.chat.crypto.ratchet_set import RatchetSet
+from app.chat.crypto.ratchet_set import (
+    RatchetSet,
+    RatchetSetException,
+    SNAPSHOT_SIZE,
+)
+from app.chat.crypto.skipped_keys import SkippedKeyStore
+from app.chat.crypto.session_store import (
+    SessionStore,
+    SessionStoreException,
+)
+from app.chat.crypto.rotation_policy import RotationPolicy
+from app.chat.crypto.compression import MessageCompressor
+from app.chat.broadcast import encrypt_broadcast, encrypt_broadcast_async
 import pytest
 import os
 from app.chat.crypto.crypto_utils import (
@@ -18,11 +30,33 @@ from app.chat.crypto.crypto_utils import (
 )
 from app.user.user_functions import resolve_user_state
 from app.database.db_controller import DatabaseController
+import asyncio
 import binascii
+import copy
+import io
+from time import time
 
 TEST_DB_PATH = "test_user.db"
 
 
+def make_session_pair(alice_kwargs=None, bob_kwargs=None):
+    """
+    Alice and Bob with synchronized ratchets, without any database.
+    Alice is the one who sends the first message
+    """
+    exp_shared_key = token_bytes(SHARED_KEY_LENGTH)
+    alice = CryptoController(
+        UserState("alice"), "bob", True, **(alice_kwargs or {})
+    )
+    bob = CryptoController(
+        UserState("bob"), "alice", False, **(bob_kwargs or {})
+    )
+    alice.initialize_symmertic_ratchets(exp_shared_key)
+    bob.initialize_symmertic_ratchets(exp_shared_key)
+    alice.rotate_dh_ratchet(bob.get_dh_public_key())
+    return alice, bob
+
+
 def test_ratchet_set():
     # check if all getters and setters are running correctly. Sanity check
     rset = RatchetSet()
@@ -39,6 +73,72 @@ def test_ratchet_set():
     assert rset.root_ratchet.get_snapshot() == ir_root.get_snapshot()
 
 
+def test_ratchet_set_binary_snapshot():
+    alice, _ = make_session_pair()
+    r_set = alice.get_ratchet_set()
+    r_set.send_count, r_set.prev_send_count, r_set.recv_count = 4, 2, 9
+    r_set.pending_rotation = True
+    # chain states do not have to be 32 bytes long
+    r_set.root_ratchet = InnerRatchet(b"some secret key")
+
+    record = r_set.to_bytes(True)
+    assert len(record) == SNAPSHOT_SIZE
+
+    r_set_out, my_turn = RatchetSet.from_bytes(record)
+    assert my_turn
+    assert r_set_out.get_tuple() == r_set.get_tuple()
+    assert (
+        r_set_out.send_count,
+        r_set_out.prev_send_count,
+        r_set_out.recv_count,
+    ) == (4, 2, 9)
+    assert r_set_out.remote_dh_key == r_set.remote_dh_key
+    assert r_set_out.pending_rotation
+    assert r_set_out.to_bytes(True) == record
+    assert not RatchetSet.from_bytes(r_set.to_bytes(False))[1]
+
+    with pytest.raises(RatchetSetException):
+        RatchetSet.from_bytes(b"\x02" + record[1:])
+    with pytest.raises(RatchetSetException):
+        RatchetSet.from_bytes(record[:-1])
+
+
+def test_session_store():
+    store = SessionStore(capacity=2)
+    sessions = {}
+    for i in range(5):
+        alice, _ = make_session_pair()
+        sessions[("alice", f"bob{i}")] = alice.get_ratchet_set()
+        store.put(("alice", f"bob{i}"), alice.get_ratchet_set(), i % 2 == 0)
+
+    # store has grown over its initial capacity
+    assert len(store) == 5 and store.capacity >= 5
+    for i, (session, r_set) in enumerate(sessions.items()):
+        r_set_out, my_turn = store.get(session)
+        assert r_set_out.get_tuple() == r_set.get_tuple()
+        assert my_turn == store.my_turn(session) == (i % 2 == 0)
+
+    # turning the loaded ratchets does not touch the store
+    r_set_out, _ = store.get(("alice", "bob0"))
+    r_set_out.send_ratchet.turn()
+    assert store.get_record(("alice", "bob0")) == sessions[
+        ("alice", "bob0")
+    ].to_bytes(True)
+    store.put(("alice", "bob0"), r_set_out, False)
+    assert store.get(("alice", "bob0"))[0].get_tuple() == (
+        r_set_out.get_tuple()
+    )
+
+    capacity = store.capacity
+    store.remove(("alice", "bob1"))
+    assert ("alice", "bob1") not in store
+    with pytest.raises(SessionStoreException):
+        store.get(("alice", "bob1"))
+    # freed slot is reused
+    store.put(("alice", "carol"), sessions[("alice", "bob1")], True)
+    assert store.capacity == capacity and len(store) == 5
+
+
 def test_initialize_ratchets(mocker):
     """
     Integrity test:
@@ -616,3 +716,461 @@ async def test_continue_conversation():
     digested = alice_cryp.decrypt_json_message(enc_msg)
 
     assert bob_msg == digested, "Messages not encrypted correctly"
+
+
+def test_cipher_suite_negotiation():
+    """
+    Alice prefers chacha and bob aes. Bob should decrypt using
+    the suite from the header and answer with the same suite
+    """
+    alice, bob = make_session_pair(
+        {"cipher_suite": CipherSuite.CHACHA20_POLY1305},
+        {"cipher_suite": CipherSuite.AES_GCM},
+    )
+
+    msg = alice.encrypt_to_json_message("hello")
+    assert msg["head"]["cipher_suite"] == CipherSuite.CHACHA20_POLY1305.value
+    assert bob.decrypt_json_message(msg) == "hello"
+    assert bob.cipher_suite is CipherSuite.CHACHA20_POLY1305
+
+    msg = bob.encrypt_to_json_message("hi")
+    assert msg["head"]["cipher_suite"] == CipherSuite.CHACHA20_POLY1305.value
+    assert alice.decrypt_json_message(msg) == "hi"
+
+    # messages from older clients have no suite in the header
+    msg = alice.encrypt_to_json_message("legacy")
+    del msg["head"]["cipher_suite"]
+    with pytest.raises(CryptoControllerException):
+        bob.decrypt_json_message(msg)
+
+    # suite we do not know is an error of the message, not a crash
+    msg = alice.encrypt_to_json_message("unknown suite")
+    msg["head"]["cipher_suite"] = 99
+    with pytest.raises(CryptoControllerException):
+        bob.decrypt_json_message(msg)
+    msg["head"]["cipher_suite"] = CipherSuite.CHACHA20_POLY1305.value
+    assert bob.decrypt_json_message(msg) == "unknown suite"
+
+
+def test_cipher_suite_agreed_once():
+    alice, bob = make_session_pair(
+        {"cipher_suite": CipherSuite.CHACHA20_POLY1305},
+        {"cipher_suite": CipherSuite.AES_GCM},
+    )
+    # both send before they hear from each other
+    from_alice = alice.encrypt_to_json_message("a")
+    from_bob = [bob.encrypt_to_json_message(f"b{i}") for i in range(3)]
+    assert bob.decrypt_json_message(from_alice) == "a"
+    assert alice.decrypt_json_message(from_bob[0]) == "b0"
+    # and both agree on the same suite, whatever came first
+    assert alice.cipher_suite is bob.cipher_suite
+    assert bob.cipher_suite is CipherSuite.CHACHA20_POLY1305
+
+    # messages send before bob agreed are still read
+    assert alice.decrypt_json_message(from_bob[1]) == "b1"
+    assert alice.decrypt_json_message(
+        bob.encrypt_to_json_message("agreed")
+    ) == "agreed"
+    # once bob uses the agreed suite, he can not go back
+    with pytest.raises(CryptoControllerException):
+        alice.decrypt_json_message(from_bob[2])
+
+    # the suite is saved with the ratchets
+    restored, _ = RatchetSet.from_bytes(
+        alice.get_ratchet_set().to_bytes(alice.my_turn)
+    )
+    assert restored.cipher_suite is CipherSuite.CHACHA20_POLY1305
+    assert restored.contact_suite is CipherSuite.CHACHA20_POLY1305
+    assert restored.copy().cipher_suite is CipherSuite.CHACHA20_POLY1305
+
+
+def test_inner_ratchet_window():
+    """Precomputed keys must be exactly the keys of the next turns"""
+    initial = token_bytes(SHARED_KEY_LENGTH)
+    plain = InnerRatchet(initial)
+    windowed = InnerRatchet(initial, window_size=4)
+
+    assert windowed.refill_window() == 4
+    assert windowed.refill_window() == 0, "window must be bounded"
+    # computing ahead does not move the ratchet itself
+    assert windowed.get_snapshot() == plain.get_snapshot()
+
+    for _ in range(3):
+        assert windowed.turn() == plain.turn()
+    assert windowed.window_length == 1
+
+    windowed.refill_window()
+    for _ in range(6):
+        assert windowed.turn() == plain.turn()
+
+    windowed.refill_window()
+    inp = token_bytes(32)
+    assert windowed.turn(inp) == plain.turn(inp)
+    assert windowed.window_length == 0, "input turn must wipe the window"
+
+
+def test_key_windows_wiped_on_dh_rotation():
+    alice, bob = make_session_pair()
+
+    alice.refill_key_windows()
+    bob.refill_key_windows()
+    assert alice.get_ratchet_set().send_ratchet.window_length > 0
+
+    for text in ("one", "two", "three"):
+        msg = alice.encrypt_to_json_message(text)
+        assert bob.decrypt_json_message(msg) == text
+        alice.refill_key_windows()
+        bob.refill_key_windows()
+
+    old_send = bob.get_ratchet_set().send_ratchet
+    msg = bob.encrypt_to_json_message("reply")
+    assert alice.decrypt_json_message(msg) == "reply"
+    assert alice.get_ratchet_set().send_ratchet.window_length == 0
+
+    bob.my_turn = True
+    bob.rotate_dh_ratchet(alice.get_dh_public_key())
+    assert old_send.window_length == 0
+
+
+def test_out_of_order_messages():
+    alice, bob = make_session_pair()
+
+    texts = [f"message {i}" for i in range(6)]
+    messages = [alice.encrypt_to_json_message(t) for t in texts]
+
+    for i in (3, 0, 5, 1, 4, 2):
+        assert bob.decrypt_json_message(messages[i]) == texts[i]
+    assert len(bob.skipped_keys) == 0, "every skipped key was used"
+
+    with pytest.raises(CryptoControllerException):
+        bob.decrypt_json_message(messages[2])
+
+
+def test_out_of_order_across_dh_rotation():
+    """
+    Messages of the old chain arrive after the contact
+    already turned his dh ratchet
+    """
+    alice, bob = make_session_pair()
+
+    first = alice.encrypt_to_json_message("first")
+    late = alice.encrypt_to_json_message("late")
+    assert bob.decrypt_json_message(first) == "first"
+
+    reply = bob.encrypt_to_json_message("reply")
+    assert alice.decrypt_json_message(reply) == "reply"
+
+    # alice is now on a new sending chain
+    new_chain = alice.encrypt_to_json_message("new chain")
+    assert new_chain["head"]["pn"] == 2
+    assert new_chain["head"]["n"] == 0
+
+    assert bob.decrypt_json_message(new_chain) == "new chain"
+    assert bob.decrypt_json_message(late) == "late"
+
+
+def test_forged_message_does_not_change_session():
+    alice, bob = make_session_pair()
+    first = alice.encrypt_to_json_message("first")
+    assert bob.decrypt_json_message(first) == "first"
+    reply = bob.encrypt_to_json_message("reply")
+
+    # broken reply with the fresh dh key of someone else
+    forged = copy.deepcopy(reply)
+    forged["body"]["public_key"] = create_b64_from_public_key(
+        generate_DH().public_key()
+    )
+    forged["head"]["n"] = 3
+    with pytest.raises(CryptoControllerException):
+        alice.decrypt_json_message(forged)
+    # broken content of the skipped message
+    late = [alice.encrypt_to_json_message(str(i)) for i in range(3)]
+    broken = copy.deepcopy(late[0])
+    broken["body"]["content"] = binascii.b2a_base64(os.urandom(40))
+    assert bob.decrypt_json_message(late[2]) == "2"
+    with pytest.raises(CryptoControllerException):
+        bob.decrypt_json_message(broken)
+    assert len(bob.skipped_keys) == 2
+
+    assert alice.decrypt_json_message(reply) == "reply"
+    assert bob.decrypt_json_message(late[0]) == "0"
+    assert bob.decrypt_json_message(late[1]) == "1"
+    assert bob.decrypt_json_message(
+        alice.encrypt_to_json_message("next")
+    ) == "next"
+
+
+def test_forged_message_in_chain_is_undone(mocker):
+    alice, bob = make_session_pair()
+    assert bob.decrypt_json_message(
+        alice.encrypt_to_json_message("first")
+    ) == "first"
+    messages = [alice.encrypt_to_json_message(str(i)) for i in range(3)]
+    broken = copy.deepcopy(messages[1])
+    broken["body"]["content"] = binascii.b2a_base64(os.urandom(40))
+    bob.refill_key_windows()
+    copy_set = mocker.spy(RatchetSet, "copy")
+
+    assert bob.decrypt_json_message(messages[0]) == "0"
+    with pytest.raises(CryptoControllerException):
+        bob.decrypt_json_message(broken)
+    assert bob.decrypt_json_message(messages[1]) == "1"
+    assert bob.decrypt_json_message(messages[2]) == "2"
+    # messages of the current chain do not copy the whole set
+    copy_set.assert_not_called()
+
+
+def test_too_many_skipped_messages(mocker):
+    alice, bob = make_session_pair()
+    mocker.patch("app.chat.crypto_controller.MAX_SKIP", 3)
+
+    messages = [alice.encrypt_to_json_message(str(i)) for i in range(5)]
+    with pytest.raises(CryptoControllerException):
+        bob.decrypt_json_message(messages[4])
+    assert bob.decrypt_json_message(messages[0]) == "0"
+
+
+def test_skipped_key_store_eviction():
+    store = SkippedKeyStore(max_keys=3, ttl=10)
+    now = time()
+    for i in range(5):
+        store.put(b"dh", i, bytes([i]) * 64, created=now - 13 + i)
+
+    # the oldest keys are dropped first
+    assert len(store) == 3
+    assert store.pop(b"dh", 0) is None
+    # key 2 is older than ttl
+    assert store.evict_expired(now=now) == 1
+    assert store.pop(b"dh", 2) is None
+    assert store.pop(b"dh", 4) == bytes([4]) * 64
+    assert store.pop(b"dh", 4) is None, "keys can be used only once"
+    assert len(store) == 1
+
+
+def test_skipped_key_store_changes():
+    store = SkippedKeyStore()
+    store.load([(b"dh", i, bytes([i]) * 64, time()) for i in range(2)])
+    assert not store.dirty
+
+    store.put(b"dh", 2, bytes([2]) * 64, created=1.0)
+    store.put(b"dh", 3, bytes([3]) * 64)
+    assert store.pop(b"dh", 3) == bytes([3]) * 64
+    assert store.pop(b"dh", 0) == bytes([0]) * 64
+    # only what the database has to change
+    assert store.take_changes() == (
+        [(b"dh", 2, bytes([2]) * 64, 1.0)],
+        [(b"dh", 0)],
+    )
+    assert not store.dirty and len(store) == 2
+
+
+def test_batch_encrypt_decrypt_saves_once(mocker):
+    alice, bob = make_session_pair()
+    alice.db_controller = mocker.Mock()
+    bob.db_controller = mocker.Mock()
+
+    texts = [f"alert number {i}" for i in range(10)]
+    messages = alice.encrypt_many(texts)
+    assert alice.db_controller.save_ratchets.call_count == 1
+
+    assert bob.decrypt_many(reversed(messages)) == texts[::-1]
+    assert bob.db_controller.save_ratchets.call_count == 1
+    # keys skipped in the middle of the batch were used up by the batch
+    assert len(bob.skipped_keys) == 0
+
+    replies = bob.encrypt_many(["ok", "got it"])
+    broken = dict(replies[1], body=dict(replies[1]["body"], content=b"AAAA"))
+    with pytest.raises(CryptoControllerException):
+        alice.decrypt_many([replies[0], broken])
+    # state after the first message was still saved
+    assert alice.db_controller.save_ratchets.call_count == 2
+    # without the broken message, which did not change anything
+    assert alice.decrypt_json_message(replies[1]) == "got it"
+
+    # nothing decrypted, nothing saved
+    bob.db_controller.reset_mock()
+    assert bob.decrypt_many([]) == []
+    forged = alice.encrypt_to_json_message("forged")
+    forged["body"]["content"] = b"AAAA"
+    with pytest.raises(CryptoControllerException):
+        bob.decrypt_many([forged])
+    assert bob.db_controller.save_ratchets.call_count == 0
+
+
+def test_rotation_every_n_messages(mocker):
+    """
+    Bob answers the new keys of alice only every third message,
+    alice rotates on every reply. They must stay synchronized
+    """
+    alice, bob = make_session_pair(
+        bob_kwargs={"rotation_policy": RotationPolicy.every_n_messages(3)}
+    )
+    rotations = mocker.spy(bob, "_turn_sending_dh_ratchet")
+
+    bob_keys = set()
+    for i in range(12):
+        msg = alice.encrypt_to_json_message(f"ping {i}")
+        assert bob.decrypt_json_message(msg) == f"ping {i}"
+        reply = bob.encrypt_to_json_message(f"pong {i}")
+        bob_keys.add(reply["body"]["public_key"])
+        assert alice.decrypt_json_message(reply) == f"pong {i}"
+
+    # bob rotates on every third reply (his first key is the spk)
+    assert rotations.call_count == 3
+    assert len(bob_keys) == 4
+
+
+def test_rotation_min_interval(mocker):
+    alice, bob = make_session_pair(
+        bob_kwargs={"rotation_policy": RotationPolicy.at_most_every(60)}
+    )
+    clock = mocker.patch("app.chat.crypto_controller.time")
+    clock.return_value = 1000.0
+
+    def exchange(i):
+        msg = alice.encrypt_to_json_message(f"ping {i}")
+        assert bob.decrypt_json_message(msg) == f"ping {i}"
+        reply = bob.encrypt_to_json_message(f"pong {i}")
+        assert alice.decrypt_json_message(reply) == f"pong {i}"
+        return reply["body"]["public_key"]
+
+    first_key = exchange(0)
+    assert exchange(1) == first_key
+    assert exchange(2) == first_key
+
+    clock.return_value = 1061.0
+    # the deferred rotation happens on the next message of bob
+    assert exchange(3) != first_key
+
+
+@pytest.mark.asyncio
+async def test_async_operations_keep_session_order(mocker):
+    alice, bob = make_session_pair()
+    alice.db_controller = mocker.Mock()
+    bob.db_controller = mocker.Mock()
+
+    plaintexts = [f"message {i}" for i in range(10)]
+    # all started at once, still numbered in the order of the calls
+    messages = await asyncio.gather(
+        *(alice.encrypt_to_json_message_async(p) for p in plaintexts)
+    )
+    assert [m["head"]["n"] for m in messages] == list(range(10))
+    assert alice.db_controller.save_ratchets.call_count == 10
+
+    decrypted = await asyncio.gather(
+        *(bob.decrypt_json_message_async(m) for m in reversed(messages))
+    )
+    assert decrypted == plaintexts[::-1]
+
+    await bob.refill_key_windows_async()
+    replies = await bob.encrypt_many_async(["k", "bro"])
+    assert await alice.decrypt_many_async(replies) == ["k", "bro"]
+    assert alice.db_controller.save_ratchets.call_count == 11
+
+
+def test_compressed_messages():
+    compressor = MessageCompressor(b"disk usage on host is above", 32)
+    alice, bob = make_session_pair(
+        {"compressor": compressor}, {"compressor": compressor}
+    )
+    alice.compress_messages = True
+
+    long_message = "disk usage on host is above 90% " * 20
+    message = alice.encrypt_to_json_message(long_message)
+    assert message["head"]["compressed"]
+    assert len(binascii.a2b_base64(message["body"]["content"])) < 100
+    assert bob.decrypt_json_message(message) == long_message
+
+    message = alice.encrypt_to_json_message("hi")
+    assert not message["head"]["compressed"]
+    assert bob.decrypt_json_message(message) == "hi"
+
+    alice.compress_messages = False
+    message = alice.encrypt_to_json_message(long_message)
+    assert not message["head"]["compressed"]
+    assert bob.decrypt_json_message(message) == long_message
+
+    # bob got compressed messages, so he compresses his replies too
+    assert bob.encrypt_to_json_message(long_message)["head"]["compressed"]
+
+
+def test_file_transfer():
+    alice, bob = make_session_pair()
+    data = os.urandom(10_000)
+
+    messages = list(
+        alice.encrypt_file_to_json_messages(
+            io.BytesIO(data), "report.log", chunk_size=4096
+        )
+    )
+    # offer and three chunks
+    assert len(messages) == 4
+    assert alice.get_ratchet_set().send_count == 1
+
+    metadata, decryptor = bob.open_file_transfer(messages[0])
+    assert metadata["name"] == "report.log"
+    received = b"".join(
+        bob.decrypt_file_chunk(m, decryptor) for m in messages[1:]
+    )
+    assert received == data and decryptor.finished
+
+    # ratchets are still in sync after the transfer
+    reply = bob.encrypt_to_json_message("got it")
+    assert alice.decrypt_json_message(reply) == "got it"
+
+    first_transfer = messages
+    messages = list(
+        alice.encrypt_file_to_json_messages(io.BytesIO(data), "x", 4096)
+    )
+    _, decryptor = bob.open_file_transfer(messages[0])
+    # chunks of the other transfer and reordered chunks are rejected
+    with pytest.raises(CryptoControllerException):
+        bob.decrypt_file_chunk(first_transfer[1], decryptor)
+    with pytest.raises(CryptoControllerException, match="expected chunk 0"):
+        bob.decrypt_file_chunk(messages[2], decryptor)
+    assert bob.decrypt_file_chunk(messages[1], decryptor) == data[:4096]
+
+
+def test_broadcast(mocker):
+    pairs = [make_session_pair() for _ in range(3)]
+    senders = [alice for alice, _ in pairs]
+    db_controller = mocker.Mock()
+
+    alert = "ALERT replication lag on db-1 " * 50
+    messages = encrypt_broadcast(senders, alert, db_controller=db_controller)
+    db_controller.save_ratchets_many.assert_called_once()
+    assert len(list(db_controller.save_ratchets_many.call_args[0][0])) == 3
+
+    # payload is encrypted and encoded once, shared by every message
+    assert all(
+        m["body"]["payload"] is messages[0]["body"]["payload"]
+        for m in messages
+    )
+    for (_, bob), message in zip(pairs, messages):
+        assert bob.decrypt_json_message(message) == alert
+
+    # ratchets go on as usual after the broadcast
+    alice, bob = pairs[0]
+    assert bob.decrypt_json_message(
+        alice.encrypt_to_json_message("next")
+    ) == "next"
+
+    # one of the recievers cannot change the payload for the others
+    alice, bob = pairs[1]
+    message = encrypt_broadcast([alice], "original")[0]
+    message["body"]["payload"] = encrypt_broadcast([pairs[2][0]], "fake")[
+        0
+    ]["body"]["payload"]
+    with pytest.raises(CryptoControllerException):
+        bob.decrypt_json_message(message)
+
+
+@pytest.mark.asyncio
+async def test_broadcast_async():
+    pairs = [make_session_pair() for _ in range(2)]
+    messages = await encrypt_broadcast_async(
+        [alice for alice, _ in pairs], "hello all"
+    )
+    for (_, bob), message in zip(pairs, messages):
+        assert message["head"]["reciever"] == bob.user_state.login
+        assert bob.decrypt_json_message(message) == "hello all"
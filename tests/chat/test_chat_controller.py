@@ -1,3 +1,12 @@
+from app.api.api_controller import ApiController
+from app.api.response_type import ResponseType
+from app.chat.chat_controller import ChatController
+from app.database.db_controller import DatabaseController
+from app.user.user_state import UserState
+import asyncio
+import os
+import pytest
+
 # ???????????????
 # def test_get_timestamp():
 #     expr = re.search(
@@ -30,3 +39,136 @@
 
 #     assert result.sender == "bob"
 #     assert result.body == "Message1234"
+
+
+@pytest.mark.asyncio
+async def test_chat_history(mocker, tmp_path, capsys):
+    db_controller = DatabaseController(DB_PATH=str(tmp_path / "chat.db"))
+    alice = UserState("alice")
+    db_controller.create_user(alice)
+    db_controller.add_contact(
+        alice,
+        "bob",
+        "3+IWTHCIArgvY+WLWXSk6w==",
+        "LiF1F733QbLg1fMBjCmerQ==",
+        contact_ephemeral_key="cWpmLwqk5+/5ZPiD7FOnjw==",
+        my_otk_key="11CYXDhP3n3ND9S1nLk",
+    )
+    mocker.patch("app.chat.chat_controller.session_manager.acquire")
+    api_controller = ApiController(alice, db_controller, init_session=False)
+    chat = ChatController(api_controller, "bob")
+    chat.websocket_con = mocker.Mock(closed=True)
+    append = mocker.spy(db_controller, "append_messages")
+
+    # the messages which come meanwhile are saved in one batch
+    for i in range(10):
+        chat.remember("bob" if i % 2 else "alice", f"message {i}")
+    chat.remember("bob", "")
+    await chat.history_task
+    assert append.call_count <= 2
+    assert sum(len(call.args[2]) for call in append.call_args_list) == 10
+
+    # the chat opens with the newest page only
+    reopened = ChatController(api_controller, "bob")
+    reopened.websocket_con = mocker.Mock(closed=True)
+    reopened.history_page_size = 4
+    await reopened.show_history()
+    shown = capsys.readouterr().out
+    assert "message 9" in shown and "message 5" not in shown
+    await reopened.show_history(older=True)
+    shown = capsys.readouterr().out
+    assert "message 5" in shown and "message 2" in shown
+    assert "message 1" not in shown
+
+
+@pytest.mark.asyncio
+async def test_chat_files(mocker, tmp_path, capsys):
+    db_controller = DatabaseController(DB_PATH=str(tmp_path / "chat.db"))
+    alice = UserState("alice")
+    db_controller.create_user(alice)
+    db_controller.add_contact(
+        alice,
+        "bob",
+        "3+IWTHCIArgvY+WLWXSk6w==",
+        "LiF1F733QbLg1fMBjCmerQ==",
+        contact_ephemeral_key="cWpmLwqk5+/5ZPiD7FOnjw==",
+        my_otk_key="11CYXDhP3n3ND9S1nLk",
+    )
+    mocker.patch("app.chat.chat_controller.session_manager.acquire")
+    api_controller = ApiController(alice, db_controller, init_session=False)
+    chat = ChatController(api_controller, "bob")
+    chat.websocket_con = mocker.Mock(closed=True)
+
+    # path typed by the user does not end the chat
+    await chat.send_file(str(tmp_path / "missing.txt"))
+    assert "Cannot send" in capsys.readouterr().out
+
+    # unfinished files are dropped with the chat
+    blob = chat.blob_store.writer()
+    blob.write(b"half of the file")
+    chat.incoming_files["transfer"] = (mocker.Mock(), blob, "a.txt")
+    chat.drop_incoming_files()
+    assert not chat.incoming_files
+    assert not os.listdir(chat.blob_store.tmp_dir)
+
+    # recieved file is sent again from the map of its blob, with the
+    # name it came with
+    blob = chat.blob_store.writer()
+    blob.write(b"recieved file")
+    digest = blob.commit(alice, "bob", "notes.txt")
+    chat.crypto_controller = mocker.Mock(
+        session_lock=asyncio.Lock(),
+        settle_state=mocker.AsyncMock(),
+        **{
+            "encrypt_file_to_json_messages.side_effect": (
+                lambda source, name: iter([{"name": name}, source.read()])
+            )
+        },
+    )
+    chat.websocket_con = mocker.Mock(send_json=mocker.AsyncMock())
+    chat.messageQueue = asyncio.Queue()
+    open_blob = mocker.spy(chat.blob_store, "open")
+    await chat.send_file(chat.blob_store.path(digest))
+    open_blob.assert_called_once_with(digest)
+    sent = chat.websocket_con.send_json.mock_calls
+    assert [call.args[0] for call in sent] == [
+        {"name": "notes.txt"},
+        b"recieved file",
+    ]
+    await chat.history_task
+
+
+@pytest.mark.asyncio
+async def test_session_start_of_other_contact(mocker, tmp_path):
+    db_controller = DatabaseController(DB_PATH=str(tmp_path / "chat.db"))
+    alice = UserState("alice")
+    db_controller.create_user(alice)
+    for contact in ("bob", "carol"):
+        db_controller.add_contact(
+            alice,
+            contact,
+            "3+IWTHCIArgvY+WLWXSk6w==",
+            "LiF1F733QbLg1fMBjCmerQ==",
+            contact_ephemeral_key="cWpmLwqk5+/5ZPiD7FOnjw==",
+            my_otk_key="11CYXDhP3n3ND9S1nLk",
+        )
+    mocker.patch("app.chat.chat_controller.session_manager.acquire")
+    api_controller = ApiController(alice, db_controller, init_session=False)
+    chat = ChatController(api_controller, "bob")
+    chat.websocket_con = mocker.Mock(closed=True)
+
+    # carol's first message comes while the chat with bob is open
+    start = {
+        "head": {
+            "message_type": ResponseType.X3DH_SESSION_START,
+            "sender": "carol",
+        }
+    }
+    sender, contact = chat.message_origin(start)
+    assert sender == contact == "carol"
+    chat.remember(sender, "hi alice", contact=contact)
+    chat.remember("alice", "hi bob")
+    await chat.history_task
+
+    assert db_controller.load_messages(alice, "carol")[0][0][0] == "carol"
+    assert len(db_controller.load_messages(alice, "bob")[0]) == 1
@@ -0,0 +1,187 @@
+from app.chat.crypto_controller import CryptoController
+from app.chat.group_session import (
+    GroupSession,
+    GroupSessionException,
+    remove_group_member,
+)
+from app.chat.crypto.sender_keys import SenderKeyException, SenderKeyState
+from app.database.db_controller import DatabaseController
+from app.user.user_state import UserState
+from app.config import SHARED_KEY_LENGTH
+from secrets import token_bytes
+import binascii
+import pytest
+
+
+def make_pairwise(owner: str, contact: str):
+    """Synchronized pairwise sessions, owner sends first"""
+    shared_key = token_bytes(SHARED_KEY_LENGTH)
+    ours = CryptoController(UserState(owner), contact, True)
+    theirs = CryptoController(UserState(contact), owner, False)
+    ours.initialize_symmertic_ratchets(shared_key)
+    theirs.initialize_symmertic_ratchets(shared_key)
+    ours.rotate_dh_ratchet(theirs.get_dh_public_key())
+    return ours, theirs
+
+
+@pytest.fixture
+def db_controller(tmp_path):
+    return DatabaseController(DB_PATH=str(tmp_path / "groups.db"))
+
+
+@pytest.fixture
+def group(db_controller):
+    """alice made the group and every member knows every sender key"""
+    alice = GroupSession.create(
+        UserState("alice"), "ops", ["bob", "carol"], db_controller
+    )
+    sessions = {
+        member: make_pairwise("alice", member)
+        for member in ("bob", "carol")
+    }
+    messages = alice.sender_key_distribution(
+        [ours for ours, _ in sessions.values()], persist=False
+    )
+
+    members = {"alice": alice}
+    for message, (_, theirs) in zip(messages, sessions.values()):
+        assert message["head"]["reciever"] == theirs.user_state.login
+        members[theirs.user_state.login] = GroupSession.accept_distribution(
+            theirs, message, db_controller
+        )
+
+    # bob and carol send their keys too (their pairwise sessions are
+    # not needed for that here, the keys are given directly)
+    for name in ("bob", "carol"):
+        distribution = {
+            "group_id": alice.group_id,
+            **members[name].my_sender_key.distribution(),
+        }
+        for other in members:
+            if other != name:
+                members[other].accept_sender_key(name, distribution)
+    return members
+
+
+def test_sender_key_state():
+    ours = SenderKeyState.generate()
+    theirs = SenderKeyState.from_distribution(ours.distribution())
+
+    keys = [ours.sending_key() for _ in range(4)]
+    assert [iteration for iteration, _ in keys] == [0, 1, 2, 3]
+    # out of order, every key only once
+    assert theirs.message_key(2) == keys[2][1]
+    assert theirs.message_key(0) == keys[0][1]
+    assert theirs.message_key(3) == keys[3][1]
+    assert theirs.message_key(1) == keys[1][1]
+    with pytest.raises(SenderKeyException):
+        theirs.message_key(1)
+
+    # the copy of other member cannot send nor sign
+    with pytest.raises(SenderKeyException):
+        theirs.sending_key()
+
+    restored = SenderKeyState.from_bytes(ours.to_bytes())
+    assert restored.sending_key() == ours.sending_key()
+    assert SenderKeyState.from_bytes(theirs.to_bytes()).signing_key is None
+
+    # late messages still decrypt after the restart
+    keys = [ours.sending_key() for _ in range(3)]
+    assert theirs.message_key(keys[2][0]) == keys[2][1]
+    restored = SenderKeyState.from_bytes(theirs.to_bytes())
+    assert restored.message_key(keys[0][0]) == keys[0][1]
+    assert restored.message_key(keys[1][0]) == keys[1][1]
+    with pytest.raises(SenderKeyException):
+        SenderKeyState.from_bytes(theirs.to_bytes()[:-1])
+
+
+def test_group_messages(group, db_controller):
+    alice, bob, carol = group["alice"], group["bob"], group["carol"]
+    assert sorted(bob.members) == ["alice", "carol"]
+
+    # one message for the whole group
+    message = alice.encrypt_group_message("deploy at 5")
+    assert bob.decrypt_group_message(message) == "deploy at 5"
+    assert carol.decrypt_group_message(message) == "deploy at 5"
+
+    first = carol.encrypt_group_message("first")
+    second = carol.encrypt_group_message("second")
+    assert bob.decrypt_group_message(second) == "second"
+    assert bob.decrypt_group_message(first) == "first"
+    with pytest.raises(GroupSessionException):
+        bob.decrypt_group_message(first)
+
+    # member cannot send in the name of another member
+    forged = carol.encrypt_group_message("pay carol")
+    forged["head"]["sender"] = "alice"
+    forged["head"]["iteration"] = alice.my_sender_key.iteration
+    with pytest.raises(GroupSessionException):
+        bob.decrypt_group_message(forged)
+    # nor change the message on the way
+    message = alice.encrypt_group_message("original")
+    message["body"]["content"] = binascii.b2a_base64(b"\x00" * 32)
+    with pytest.raises(GroupSessionException):
+        bob.decrypt_group_message(message)
+    message = alice.encrypt_group_message("unknown suite")
+    message["head"]["cipher_suite"] = 99
+    with pytest.raises(GroupSessionException):
+        bob.decrypt_group_message(message)
+
+    # sender keys are kept in the database
+    reloaded = GroupSession.load(
+        UserState("bob"), alice.group_id, db_controller
+    )
+    assert reloaded.name == "ops"
+    assert reloaded.decrypt_group_message(
+        alice.encrypt_group_message("after restart")
+    ) == "after restart"
+
+
+def test_group_remove_member(group, db_controller):
+    alice, bob, carol = group["alice"], group["bob"], group["carol"]
+    old_key = alice.my_sender_key.chain_key
+
+    alice.remove_member("carol")
+    assert alice.members == ["bob"]
+    assert alice.my_sender_key.chain_key != old_key
+    assert "carol" not in db_controller.load_sender_keys(
+        UserState("alice"), alice.group_id
+    )
+
+    # carol does not get the new chain
+    message = alice.encrypt_group_message("without carol")
+    with pytest.raises(GroupSessionException):
+        carol.decrypt_group_message(message)
+
+    bob.accept_sender_key(
+        "alice",
+        {"group_id": alice.group_id, **alice.my_sender_key.distribution()},
+    )
+    # bob got the new chain after that message, it is lost for him
+    with pytest.raises(GroupSessionException):
+        bob.decrypt_group_message(message)
+    assert bob.decrypt_group_message(
+        alice.encrypt_group_message("next")
+    ) == "next"
+
+    with pytest.raises(GroupSessionException):
+        alice.remove_member("carol")
+
+
+@pytest.mark.asyncio
+async def test_remove_group_member_redistributes(group, mocker):
+    alice, bob = group["alice"], group["bob"]
+    ours, theirs = make_pairwise("alice", "bob")
+    mocker.patch(
+        "app.chat.group_session.session_manager.acquire", return_value=ours
+    )
+    api_controller = mocker.Mock(send_messages=mocker.AsyncMock())
+
+    await remove_group_member(api_controller, alice, "carol")
+    (messages,) = api_controller.send_messages.call_args.args
+    # the new chain goes only to the members who are left
+    assert [m["head"]["reciever"] for m in messages] == ["bob"]
+    bob.accept_sender_key("alice", theirs.decrypt_control_message(messages[0]))
+    assert bob.decrypt_group_message(
+        alice.encrypt_group_message("without carol")
+    ) == "without carol"
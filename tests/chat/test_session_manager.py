@@ -0,0 +1,121 @@
+from app.chat.crypto.inner_ratchet import InnerRatchet
+from app.chat.crypto.ratchet_set import RatchetSet
+from app.chat.crypto.crypto_utils import generate_DH
+from app.chat.session_manager import SessionManager
+from app.config import DEFAULT_DB_PATH
+from app.user.user_state import UserState
+from secrets import token_bytes
+
+
+def make_session(mocker):
+    r_set = RatchetSet()
+    r_set.dh_ratchet = generate_DH()
+    r_set.send_ratchet = InnerRatchet(token_bytes(32))
+    r_set.recv_ratchet = InnerRatchet(token_bytes(32))
+    r_set.root_ratchet = InnerRatchet(token_bytes(32))
+    return mocker.Mock(
+        db_path=DEFAULT_DB_PATH,
+        my_turn=True,
+        _session_lock=None,
+        **{"get_ratchet_set.return_value": r_set},
+    )
+
+
+def test_session_manager(mocker):
+    controller_cls = mocker.patch(
+        "app.chat.session_manager.CryptoController",
+        side_effect=lambda *args, **kwargs: make_session(mocker),
+    )
+    alice = UserState("alice")
+    manager = SessionManager(max_sessions=2)
+
+    bob = manager.get(alice, "bob")
+    bob.init_ratchets.assert_called_once_with()
+    # the same live session for every caller
+    assert manager.get(alice, "bob") is bob
+    assert manager.stats == {"hits": 1, "misses": 1, "size": 1}
+
+    carol = manager.init_session(alice, "carol", opt_public_key="key")
+    carol.init_ratchets.assert_called_once_with(
+        opt_public_key="key", opt_private_key=None
+    )
+
+    # bob was used after carol, so carol goes first and is saved
+    manager.get(alice, "bob")
+    dave = manager.get(alice, "dave")
+    carol.save_state.assert_called_once_with()
+    bob.save_state.assert_not_called()
+    assert ("alice", "carol") not in manager and len(manager) == 2
+
+    # dropped without saving, next get loads it again from the database
+    manager.invalidate("alice", "bob")
+    assert manager.get(alice, "bob") is not bob
+    bob.save_state.assert_not_called()
+    assert controller_cls.call_count == 4
+
+    # evicted session comes back from the parked ratchets, only
+    # its skipped keys are read from the database
+    carol_again = manager.get(alice, "carol")
+    dave.save_state.assert_called_once_with()
+    carol_again.init_ratchets.assert_not_called()
+    (restored, my_turn), _ = carol_again.restore_ratchets.call_args
+    assert my_turn is True
+    assert restored.get_tuple() == carol.get_ratchet_set().get_tuple()
+
+    manager.clear()
+    carol_again.save_state.assert_called_once_with()
+    assert len(manager) == 0
+    assert manager.get(alice, "carol").init_ratchets.called
+
+
+def test_session_in_use_is_not_evicted(mocker):
+    mocker.patch(
+        "app.chat.session_manager.CryptoController",
+        side_effect=lambda *args, **kwargs: make_session(mocker),
+    )
+    alice = UserState("alice")
+    manager = SessionManager(max_sessions=1)
+
+    bob = manager.get(alice, "bob")
+    bob._session_lock = mocker.Mock(**{"locked.return_value": True})
+    carol = manager.get(alice, "carol")
+    # bob is being used on the crypto thread, it stays for now
+    bob.save_state.assert_not_called()
+    assert ("alice", "bob") in manager and len(manager) == 2
+
+    bob._session_lock = None
+    manager.get(alice, "dave")
+    bob.save_state.assert_called_once_with()
+    carol.save_state.assert_called_once_with()
+    assert len(manager) == 1
+
+
+def test_acquired_session_is_not_evicted(mocker):
+    controller_cls = mocker.patch(
+        "app.chat.session_manager.CryptoController",
+        side_effect=lambda *args, **kwargs: make_session(mocker),
+    )
+    alice = UserState("alice")
+    manager = SessionManager(max_sessions=1)
+
+    # the open chat keeps bob while other sessions come and go
+    bob = manager.acquire(alice, "bob")
+    carol = manager.get(alice, "carol")
+    manager.get(alice, "dave")
+    carol.save_state.assert_called_once_with()
+    assert manager.get(alice, "bob") is bob
+    bob.save_state.assert_not_called()
+    assert controller_cls.call_count == 3
+
+    # every acquire needs its release
+    manager.acquire(alice, "bob")
+    manager.release("alice", "bob")
+    erin = manager.get(alice, "erin")
+    assert manager.get(alice, "bob") is bob
+
+    # last release makes room, for the least recently used one
+    manager.release("alice", "bob")
+    erin.save_state.assert_called_once_with()
+    assert ("alice", "bob") in manager and len(manager) == 1
+    manager.get(alice, "frank")
+    bob.save_state.assert_called_once_with()
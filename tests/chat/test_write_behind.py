@@ -0,0 +1,216 @@
+from app.chat.broadcast import encrypt_broadcast
+from app.chat.crypto_controller import CryptoController
+from app.chat.session_manager import SessionManager
+from app.chat.write_behind import WriteBehindStore
+from app.database.db_controller import DatabaseController
+from app.user.user_state import UserState
+from app.config import SHARED_KEY_LENGTH
+from concurrent.futures import Future
+from pathlib import Path
+from secrets import token_bytes
+import pickle
+import subprocess
+import sys
+import pytest
+
+ROOT = Path(__file__).parents[2]
+B64_ID = "3+IWTHCIArgvY+WLWXSk6w=="
+B64_SHARED = "LiF1F733QbLg1fMBjCmerQ=="
+
+# alice sends the burst and the process is killed before any other flush
+CRASHING_SENDER = """
+import os, pickle, signal, sys
+from app.chat.crypto_controller import CryptoController
+from app.chat.write_behind import WriteBehindStore
+from app.user.user_state import UserState
+
+db_path, count = sys.argv[1], int(sys.argv[2])
+alice = CryptoController(UserState("alice"), "bob", DB_PATH=db_path)
+alice.init_ratchets()
+alice.write_behind = WriteBehindStore(3600, 32)
+for i in range(count):
+    message = alice.encrypt_to_json_message(f"message {i}")
+    print(pickle.dumps(message).hex(), flush=True)
+os.kill(os.getpid(), signal.SIGKILL)
+"""
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_pairwise(db_controller, owner: str, contact: str):
+    """Synchronized sessions, the owner one is saved in the database"""
+    db_controller.add_contact(
+        UserState(owner),
+        contact,
+        B64_ID,
+        B64_SHARED,
+        contact_ephemeral_key="cWpmLwqk5+/5ZPiD7FOnjw==",
+        my_otk_key="11CYXDhP3n3ND9S1nLk",
+    )
+    shared_key = token_bytes(SHARED_KEY_LENGTH)
+    ours = CryptoController(
+        UserState(owner), contact, True, DB_PATH=db_controller.DB_PATH
+    )
+    theirs = CryptoController(UserState(contact), owner, False)
+    ours.initialize_symmertic_ratchets(shared_key)
+    theirs.initialize_symmertic_ratchets(shared_key)
+    ours.rotate_dh_ratchet(theirs.get_dh_public_key())
+    ours.db_controller = db_controller
+    ours.write_state()
+    return ours, theirs
+
+
+@pytest.fixture
+def db_controller(tmp_path):
+    db_controller = DatabaseController(DB_PATH=str(tmp_path / "wb.db"))
+    db_controller.create_user(UserState("alice"))
+    return db_controller
+
+
+def saved_send_count(db_controller, contact: str) -> int:
+    return db_controller.load_ratchets(
+        UserState("alice"), contact
+    ).send_count
+
+
+def test_write_behind_batches(db_controller, mocker):
+    clock = FakeClock()
+    store = WriteBehindStore(10, 4, clock=clock)
+    sessions = {}
+    for contact in ("bob", "carol"):
+        ours, theirs = make_pairwise(db_controller, "alice", contact)
+        ours.write_behind = store
+        sessions[contact] = (ours, theirs)
+    save_sessions = mocker.spy(db_controller, "save_sessions")
+    bob, bob_theirs = sessions["bob"]
+    carol, _ = sessions["carol"]
+
+    # the first change of the session is saved right away
+    bob.encrypt_to_json_message("hi")
+    carol.encrypt_to_json_message("hi")
+    assert save_sessions.call_count == 2 and len(store) == 0
+
+    # the rest waits for max_updates, then both go in one transaction
+    messages = [bob.encrypt_to_json_message("a") for _ in range(2)]
+    carol.encrypt_to_json_message("b")
+    assert save_sessions.call_count == 2 and len(store) == 2
+    messages.append(bob.encrypt_to_json_message("c"))
+    assert save_sessions.call_count == 3 and len(store) == 0
+    assert len(save_sessions.call_args.args[0]) == 2
+
+    # saved sending chain is ahead of the one in memory
+    assert saved_send_count(db_controller, "bob") == (
+        bob.get_ratchet_set().send_count + store.max_updates
+    )
+    for message, text in zip(messages, ("a", "a", "c")):
+        assert bob_theirs.decrypt_json_message(message) == text
+
+    # or the interval passes
+    bob.encrypt_to_json_message("d")
+    assert len(store) == 1
+    clock.now += 10
+    bob.encrypt_to_json_message("e")
+    assert len(store) == 0 and save_sessions.call_count == 4
+
+    # session in the middle of the operation is not touched
+    bob.encrypt_to_json_message("f")
+    carol.encrypt_to_json_message("f")
+    carol._session_lock = mocker.Mock(**{"locked.return_value": True})
+    assert store.flush() == 1 and len(store) == 1
+    carol._session_lock = None
+
+    # final flush saves exactly what is in memory, also for bob
+    # which is clean but has the keys reserved in the database
+    assert saved_send_count(db_controller, "bob") > (
+        bob.get_ratchet_set().send_count
+    )
+    assert store.flush(owner="alice", final=True) == 2
+    for session, contact in ((bob, "bob"), (carol, "carol")):
+        assert saved_send_count(db_controller, contact) == (
+            session.get_ratchet_set().send_count
+        )
+    assert store.flush(owner="alice", final=True) == 0
+
+
+def test_write_behind_crash(db_controller):
+    alice, bob = make_pairwise(db_controller, "alice", "bob")
+    count = 10
+    child = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            CRASHING_SENDER,
+            db_controller.DB_PATH,
+            str(count),
+        ],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    assert child.returncode == -9, child.stderr
+    sent = [pickle.loads(bytes.fromhex(line)) for line in child.stdout.split()]
+    assert len(sent) == count
+
+    restored = CryptoController(
+        UserState("alice"), "bob", DB_PATH=db_controller.DB_PATH
+    )
+    restored.init_ratchets()
+    after_crash = restored.encrypt_to_json_message("after crash")
+    # no message key of the burst is used again
+    assert after_crash["head"]["n"] >= count
+    assert after_crash["head"]["n"] not in [m["head"]["n"] for m in sent]
+
+    for i, message in enumerate(sent):
+        assert bob.decrypt_json_message(message) == f"message {i}"
+    assert bob.decrypt_json_message(after_crash) == "after crash"
+
+
+def test_broadcast_keeps_reservation(db_controller):
+    alice, bob = make_pairwise(db_controller, "alice", "bob")
+    alice.write_behind = WriteBehindStore(3600, 32)
+    sent = [alice.encrypt_to_json_message("first")]
+    sent += encrypt_broadcast([alice], "to all", db_controller=db_controller)
+    sent += [alice.encrypt_to_json_message(f"m{i}") for i in range(5)]
+
+    # crash, nothing else was flushed
+    restored = CryptoController(
+        UserState("alice"), "bob", DB_PATH=db_controller.DB_PATH
+    )
+    restored.init_ratchets()
+    after_crash = restored.encrypt_to_json_message("after crash")
+    assert after_crash["head"]["n"] not in [m["head"]["n"] for m in sent]
+
+    for message in sent:
+        bob.decrypt_json_message(message)
+    assert bob.decrypt_json_message(after_crash) == "after crash"
+
+
+def test_restore_before_release_is_saved(db_controller, mocker):
+    _, bob_theirs = make_pairwise(db_controller, "alice", "bob")
+    make_pairwise(db_controller, "alice", "carol")
+    # saves stay queued on the database thread
+    database_thread = mocker.Mock(
+        **{"submit.side_effect": lambda *args, **kwargs: Future()}
+    )
+    store = WriteBehindStore(10, 4, database_thread=database_thread)
+    manager = SessionManager(max_sessions=1, write_behind=store)
+    alice, path = UserState("alice"), db_controller.DB_PATH
+
+    bob = manager.get(alice, "bob", DB_PATH=path)
+    messages = [bob_theirs.encrypt_to_json_message(f"{i}") for i in range(3)]
+    assert bob.decrypt_json_message(messages[2]) == "2"
+    assert len(bob.skipped_keys) == 2
+
+    # bob is evicted and comes back before his release is written
+    manager.get(alice, "carol", DB_PATH=path)
+    restored = manager.get(alice, "bob", DB_PATH=path)
+    assert restored is not bob
+    assert db_controller.load_skipped_keys(alice, "bob") == []
+    assert restored.decrypt_json_message(messages[0]) == "0"
+    assert restored.decrypt_json_message(messages[1]) == "1"
@@ -0,0 +1,119 @@
+from app.chat.write_behind import WriteBehindStore
+from app.database.async_db import AsyncDatabase, DatabaseThread
+from app.database.db_controller import (
+    DatabaseController,
+    DatabaseControllerException,
+)
+from app.database.owner_dao import OwnerDAO
+from app.user.user_state import UserState
+from tests.chat.test_write_behind import make_pairwise
+import asyncio
+import threading
+import pytest
+
+B64_ID = "3+IWTHCIArgvY+WLWXSk6w=="
+B64_SHARED = "LiF1F733QbLg1fMBjCmerQ=="
+INVITE_KEYS = {
+    "contact_ephemeral_key": "cWpmLwqk5+/5ZPiD7FOnjw==",
+    "my_otk_key": "11CYXDhP3n3ND9S1nLk",
+}
+
+
+@pytest.fixture
+def thread():
+    thread = DatabaseThread("test-database")
+    yield thread
+    thread.shutdown()
+
+
+@pytest.fixture
+def db_controller(tmp_path):
+    db_controller = DatabaseController(DB_PATH=str(tmp_path / "async.db"))
+    db_controller.create_user(UserState("alice"))
+    return db_controller
+
+
+@pytest.mark.asyncio
+async def test_database_thread(thread):
+    loop_thread = threading.get_ident()
+    assert await thread.run(threading.get_ident) != loop_thread
+
+    # everything in the order of submission
+    done = []
+    futures = [thread.submit(done.append, i) for i in range(50)]
+    assert await thread.run(len, done) == 50
+    assert done == list(range(50)) and all(f.done() for f in futures)
+    # a burst does not wake the thread up for every request
+    assert thread.wakeups < thread.requests
+
+    assert await thread.run_many(
+        [lambda: 1, lambda: done.pop(), lambda: 3]
+    ) == [1, 49, 3]
+    with pytest.raises(ZeroDivisionError):
+        await thread.run(lambda: 1 / 0)
+
+    # the next request starts a new thread
+    thread.shutdown()
+    assert await thread.run(lambda: 4) == 4
+
+
+@pytest.mark.asyncio
+async def test_async_database(thread, db_controller):
+    dao = AsyncDatabase(
+        OwnerDAO(db_controller, UserState("alice")), thread=thread
+    )
+    assert await dao.add_contact("bob", B64_ID, B64_SHARED, **INVITE_KEYS)
+    assert await dao.contact_exists("bob")
+    with pytest.raises(DatabaseControllerException):
+        await dao.add_contact("alice", B64_ID, B64_SHARED)
+
+    requests = thread.requests
+    results = await dao.batch(
+        [
+            ("add_contact", ("carol", B64_ID, B64_SHARED), INVITE_KEYS),
+            ("get_contacts", (), {}),
+        ]
+    )
+    assert results == [True, ["bob", "carol"]]
+    assert thread.requests == requests + 1
+
+
+@pytest.mark.asyncio
+async def test_write_behind_on_database_thread(thread, db_controller, mocker):
+    store = WriteBehindStore(10, 4, database_thread=thread)
+    bob, _ = make_pairwise(db_controller, "alice", "bob")
+    bob.write_behind = store
+    save_threads = []
+    save_sessions = db_controller.save_sessions
+    mocker.patch.object(
+        db_controller,
+        "save_sessions",
+        side_effect=lambda rows: (
+            save_threads.append(threading.get_ident()),
+            save_sessions(rows),
+        ),
+    )
+
+    await bob.encrypt_to_json_message_async("hi")
+    # the message is returned only after its key is reserved on disk,
+    # which is not done by the event loop
+    assert len(save_threads) == 1
+    assert save_threads[0] != threading.get_ident()
+    saved = db_controller.load_ratchets(UserState("alice"), "bob")
+    assert saved.send_count == bob.get_ratchet_set().send_count + 4
+
+
+@pytest.mark.asyncio
+async def test_settled_waiters_share_batch(thread):
+    store = WriteBehindStore(10, 4, database_thread=thread)
+    committed = threading.Event()
+    store._pending.append(thread.submit(committed.wait, 5))
+
+    first = asyncio.ensure_future(store.settled())
+    await asyncio.sleep(0)
+    # the second waiter must not miss the batch the first one awaits
+    second = asyncio.ensure_future(store.settled())
+    await asyncio.sleep(0.05)
+    assert not first.done() and not second.done()
+    committed.set()
+    await asyncio.gather(first, second)
@@ -8,7 +8,19 @@ from app.user.user_state import UserState
 from app.chat.crypto.ratchet_set import RatchetSet
 from app.chat.crypto.crypto_utils import create_b64_from_private_key
 from app.chat.crypto.inner_ratchet import InnerRatchet
+from app.database.blob_store import BlobStore, BlobStoreException
+from app.database.owner_dao import OwnerDAO
+from app.config import DB_BUSY_TIMEOUT, DurabilityProfile
+from app.database.connection_registry import (
+    ConnectionRegistry,
+    connection_registry,
+)
+import hashlib
+import io
+import os
 import pytest
+import sqlite3
+import threading
 import types
 from secrets import token_bytes
 
@@ -221,6 +233,9 @@ def test_save_load_ratchets(db_init):
     r_set.send_ratchet = InnerRatchet(token_bytes(10))
     r_set.recv_ratchet = InnerRatchet(token_bytes(10))
     r_set.dh_ratchet = X25519PrivateKey.generate()
+    r_set.send_count, r_set.prev_send_count, r_set.recv_count = 3, 7, 11
+    r_set.remote_dh_key = token_bytes(32)
+    r_set.pending_rotation = True
 
     db_init.db_controller.save_ratchets(
         db_init.alice_state, test_contact, r_set, True
@@ -245,6 +260,38 @@ def test_save_load_ratchets(db_init):
     assert create_b64_from_private_key(
         r_set.dh_ratchet
     ) == create_b64_from_private_key(r_set_out.dh_ratchet)
+    assert (r_set_out.send_count, r_set_out.prev_send_count) == (3, 7)
+    assert r_set_out.recv_count == 11
+    assert r_set_out.remote_dh_key == r_set.remote_dh_key
+    assert r_set_out.pending_rotation
+
+
+def test_save_ratchets_many(db_init):
+    sessions = []
+    for contact in ("Bob", "Charlie"):
+        db_init.db_controller.add_contact(
+            db_init.alice_state,
+            contact,
+            db_init.b64_id,
+            db_init.b64_shared,
+            contact_ephemeral_key=db_init.con_ephem,
+            my_otk_key=db_init.con_otk,
+        )
+        r_set = RatchetSet()
+        r_set.root_ratchet = InnerRatchet(token_bytes(32))
+        r_set.send_ratchet = InnerRatchet(token_bytes(32))
+        r_set.recv_ratchet = InnerRatchet(token_bytes(32))
+        r_set.dh_ratchet = X25519PrivateKey.generate()
+        sessions.append((db_init.alice_state, contact, r_set, False))
+
+    db_init.db_controller.save_ratchets_many(iter(sessions))
+
+    for user_state, contact, r_set, _ in sessions:
+        r_set_out = db_init.db_controller.load_ratchets(user_state, contact)
+        assert r_set_out.get_tuple() == r_set.get_tuple()
+        assert not db_init.db_controller.load_chat_init_variables(
+            user_state, contact
+        )[1]
 
 
 def test_save_load_init_vars(db_init):
@@ -303,3 +350,310 @@ def test_ratchets_present(db_init):
     assert db_init.db_controller.ratchets_present(
         db_init.alice_state, test_contact
     )
+
+
+def test_save_load_skipped_keys(db_init):
+    args = db_init.b64_id, db_init.b64_shared
+    kwargs = {
+        "contact_ephemeral_key": db_init.con_ephem,
+        "my_otk_key": db_init.con_otk,
+    }
+    test_contact = "Charlie"
+    db_init.db_controller.add_contact(
+        db_init.alice_state, test_contact, *args, **kwargs
+    )
+
+    skipped = [
+        (token_bytes(32), 1, token_bytes(64), 10.0),
+        (token_bytes(32), 7, token_bytes(64), 20.0),
+    ]
+    db_init.db_controller.save_skipped_keys(
+        db_init.alice_state, test_contact, skipped
+    )
+    assert (
+        db_init.db_controller.load_skipped_keys(
+            db_init.alice_state, test_contact
+        )
+        == skipped
+    )
+
+    db_init.db_controller.save_skipped_keys(
+        db_init.alice_state, test_contact, skipped[1:]
+    )
+    assert (
+        db_init.db_controller.load_skipped_keys(
+            db_init.alice_state, test_contact
+        )
+        == skipped[1:]
+    )
+
+    # only the changed keys
+    added = (token_bytes(32), 3, token_bytes(64), 30.0)
+    db_init.db_controller.update_skipped_keys(
+        db_init.alice_state, test_contact, [added], [skipped[1][:2]]
+    )
+    assert db_init.db_controller.load_skipped_keys(
+        db_init.alice_state, test_contact
+    ) == [added]
+
+
+def test_message_history(db_init):
+    db_controller, alice = db_init.db_controller, db_init.alice_state
+    db_controller.add_contact(
+        alice,
+        "Charlie",
+        db_init.b64_id,
+        db_init.b64_shared,
+        contact_ephemeral_key=db_init.con_ephem,
+        my_otk_key=db_init.con_otk,
+    )
+    with pytest.raises(DatabaseControllerException):
+        db_controller.append_messages(alice, "Bob", [("Bob", 1.0, "hi")])
+
+    # a few messages share the timestamp, the insertion order is kept
+    history = [
+        ("Charlie" if i % 3 else "Alice", float(i // 2), f"message {i}")
+        for i in range(25)
+    ]
+    db_controller.append_messages(alice, "Charlie", history[:10])
+    db_controller.append_messages(alice, "Charlie", history[10:])
+
+    pages = []
+    page, cursor = db_controller.load_messages(alice, "Charlie", limit=10)
+    pages.append(page)
+    while cursor is not None:
+        page, cursor = db_controller.load_messages(
+            alice, "Charlie", before=cursor, limit=10
+        )
+        pages.append(page)
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert [m for page in reversed(pages) for m in page] == history
+
+    # the pages are read from the index, nothing is sorted
+    plan = db_controller.connection.execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM MESSAGES "
+        "WHERE owner=? AND contact=? AND (timestamp, id) < (?, ?) "
+        "ORDER BY timestamp DESC, id DESC LIMIT ?",
+        ("Alice", "Charlie", 1.0, 1, 10),
+    ).fetchall()
+    assert "MESSAGES_HISTORY" in plan[0][-1]
+    assert not any("TEMP B-TREE" in row[-1] for row in plan)
+
+    db_controller.delete_contact(alice, "Charlie")
+    assert db_controller.load_messages(alice, "Charlie") == ([], None)
+
+
+def test_migrate_legacy_database(db_init):
+    """
+    Database of the first version of the app must be
+    updated and not deleted
+    """
+    r_set = RatchetSet()
+    r_set.dh_ratchet = X25519PrivateKey.generate()
+    r_set.send_ratchet = InnerRatchet(token_bytes(32))
+    r_set.recv_ratchet = InnerRatchet(token_bytes(32))
+    r_set.root_ratchet = InnerRatchet(token_bytes(32))
+
+    # ratchets were saved as base64 text in the first version
+    connection = db_init.db_controller.connection
+    connection.executescript(
+        "DROP TABLE SKIPPED_MESSAGE_KEYS;"
+        "DROP TABLE CONTACTS;"
+        "CREATE TABLE CONTACTS(owner VARCHAR(255) NOT NULL,"
+        " login VARCHAR(255) NOT NULL, shared_x3dh_key TEXT NOT NULL,"
+        " dh_ratchet TEXT, send_ratchet TEXT, recv_ratchet TEXT,"
+        " root_ratchet TEXT, public_id_key TEXT NOT NULL,"
+        " public_signed_pre_key TEXT, my_ephemeral_key TEXT,"
+        " contact_ephemeral_key TEXT, my_otk_key TEXT,"
+        " contact_otk_key TEXT, my_turn INTEGER, approved_user INTEGER,"
+        " PRIMARY KEY (owner, login));"
+    )
+    connection.execute(
+        "INSERT INTO CONTACTS (owner, login, shared_x3dh_key, dh_ratchet,"
+        " send_ratchet, recv_ratchet, root_ratchet, public_id_key, my_turn)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            db_init.alice_state.login,
+            "Carol",
+            db_init.b64_shared,
+            *r_set.get_tuple(),
+            db_init.b64_id,
+            1,
+        ),
+    )
+    connection.commit()
+
+    # the schema is checked once per process, the old database
+    # is opened by the new process
+    connection_registry.discard(TEST_DB_PATH)
+    db_controller = DatabaseController(DB_PATH=TEST_DB_PATH)
+    assert db_controller.user_exists(db_init.alice_state)
+
+    assert db_controller.ratchets_present(db_init.alice_state, "Carol")
+    r_set_out = db_controller.load_ratchets(db_init.alice_state, "Carol")
+    assert r_set_out.get_tuple() == r_set.get_tuple()
+    assert db_controller.connection.execute(
+        "SELECT dh_ratchet, root_ratchet FROM CONTACTS"
+    ).fetchone() == (None, None)
+
+    assert db_controller.add_contact(
+        db_init.alice_state,
+        "Bob",
+        db_init.b64_id,
+        db_init.b64_shared,
+        contact_ephemeral_key=db_init.con_ephem,
+        my_otk_key=db_init.con_otk,
+    )
+    assert db_controller.load_skipped_keys(db_init.alice_state, "Bob") == []
+
+
+def test_blob_store(db_init, tmp_path):
+    store = BlobStore(db_init.db_controller, root=str(tmp_path))
+    data = os.urandom(100_000)
+    digest = hashlib.sha256(data).hexdigest()
+
+    # the same file from two contacts is stored once
+    assert store.put(io.BytesIO(data)) == digest
+    writer = store.writer()
+    writer.write(data[:10])
+    writer.write(data[10:])
+    assert writer.commit() == digest
+    assert db_init.db_controller.get_blob_refcount(digest) == 2
+    assert os.listdir(tmp_path / digest[:2]) == [digest]
+    assert os.listdir(tmp_path / "tmp") == []
+
+    with store.open(digest) as view:
+        assert view[:10] == data[:10] and len(view) == len(data)
+        assert view.read(10) == data[:10]
+
+    assert store.release(digest) == 1
+    assert store.exists(digest)
+    assert store.release(digest) == 0
+    assert not store.exists(digest)
+    with pytest.raises(BlobStoreException):
+        store.add_reference(digest)
+
+    empty = store.put(b"")
+    with store.open(empty) as view:
+        assert view.read() == b""
+
+    aborted = store.writer()
+    aborted.write(b"never stored")
+    aborted.abort()
+    assert os.listdir(tmp_path / "tmp") == []
+
+    with pytest.raises(BlobStoreException):
+        store.path("../../etc/passwd")
+
+
+def test_blob_references(db_init, tmp_path):
+    db_controller = DatabaseController(DB_PATH=str(tmp_path / "files.db"))
+    db_controller.create_user(db_init.alice_state)
+    for contact in ("Bob", "Carol"):
+        db_controller.add_contact(
+            db_init.alice_state,
+            contact,
+            db_init.b64_id,
+            db_init.b64_shared,
+            contact_ephemeral_key=db_init.con_ephem,
+            my_otk_key=db_init.my_otk,
+        )
+    # store is next to the database, wherever the app is started
+    store = BlobStore(db_controller)
+    assert store.root == str(tmp_path / "blobs")
+
+    def recieve(contact: str, data: bytes) -> str:
+        writer = store.writer()
+        writer.write(data)
+        return writer.commit(db_init.alice_state, contact, "a.txt")
+
+    shared = recieve("Bob", b"the same file")
+    assert recieve("Carol", b"the same file") == shared
+    only_bob = recieve("Bob", b"only from bob")
+    assert recieve("Bob", b"only from bob") == only_bob
+    assert db_controller.get_blob_refcount(only_bob) == 2
+
+    # files go with the contact, the shared one is still referenced
+    assert store.delete_contact(db_init.alice_state, "Bob") == 1
+    assert db_controller.get_blob_refcount(only_bob) == 0
+    assert db_controller.get_blob_refcount(shared) == 1
+    assert not store.exists(only_bob) and store.exists(shared)
+
+    OwnerDAO(db_controller, db_init.alice_state).delete_contact("Carol")
+    assert db_controller.get_unreferenced_blobs() == [shared]
+    assert store.collect() == 1 and not store.exists(shared)
+    assert db_controller.get_unreferenced_blobs() == []
+    assert store.collect() == 0
+
+
+def test_connection_registry(tmp_path):
+    registry = ConnectionRegistry()
+    path = str(tmp_path / "registry.db")
+
+    connection = registry.connect(path)
+    # the same connection for the same thread, another one for others
+    assert registry.connect(path) is connection
+    other = []
+    thread = threading.Thread(
+        target=lambda: other.append(registry.connect(path))
+    )
+    thread.start()
+    thread.join()
+    assert other[0] is not connection and len(registry) == 2
+
+    registry.mark_ready(path)
+    assert registry.is_ready(path)
+    # removed file is not ready anymore and gets a new connection
+    os.remove(path)
+    assert not registry.is_ready(path)
+    assert registry.connect(path) is not connection
+    assert len(registry) == 1
+
+    registry.close_all()
+    assert len(registry) == 0
+    with pytest.raises(sqlite3.ProgrammingError):
+        other[0].execute("SELECT 1")
+
+
+def test_controllers_share_connection():
+    first = DatabaseController(DB_PATH=TEST_DB_PATH)
+    second = DatabaseController(DB_PATH=TEST_DB_PATH)
+    assert first.connection is second.connection
+    assert connection_registry.is_ready(TEST_DB_PATH)
+
+
+def test_controller_keeps_connection(tmp_path, mocker):
+    db_controller = DatabaseController(DB_PATH=str(tmp_path / "kept.db"))
+    connect = mocker.spy(connection_registry, "connect")
+    connection = db_controller.connection
+    # no lock nor file check on every statement
+    for _ in range(10):
+        assert db_controller.connection is connection
+    assert connect.call_count <= 1
+
+    # closed connection is never handed out
+    connection_registry.discard(db_controller.DB_PATH)
+    assert db_controller.connection is not connection
+    db_controller.connection.execute("SELECT 1")
+
+
+@pytest.mark.parametrize(
+    "profile, journal_mode, synchronous",
+    [
+        (DurabilityProfile.STRICT, "delete", 2),
+        (DurabilityProfile.DURABLE, "wal", 2),
+        (DurabilityProfile.BALANCED, "wal", 1),
+        (DurabilityProfile.FAST, "wal", 0),
+    ],
+)
+def test_durability_profiles(tmp_path, profile, journal_mode, synchronous):
+    registry = ConnectionRegistry(profile=profile)
+    connection = registry.connect(str(tmp_path / "profile.db"))
+
+    def pragma(name):
+        return connection.execute(f"PRAGMA {name}").fetchone()[0]
+
+    assert pragma("journal_mode") == journal_mode
+    assert pragma("synchronous") == synchronous
+    assert pragma("busy_timeout") == DB_BUSY_TIMEOUT
+    registry.close_all()
@@ -0,0 +1,97 @@
+from app.database.db_controller import (
+    ContactParametersError,
+    DatabaseController,
+    DatabaseControllerException,
+)
+from app.database.owner_dao import OwnerDAO
+from app.user.user_state import UserState
+import pytest
+
+B64_ID = "3+IWTHCIArgvY+WLWXSk6w=="
+B64_SHARED = "LiF1F733QbLg1fMBjCmerQ=="
+GUEST_KEYS = {
+    "contact_signed_pre_key": "NauGyCz9V2QYyfIJ9x4XwQ==",
+    "my_ephemeral_key": "F2GQ8SMSm21jMyDrS6Y",
+    "contact_otk_key": "HjKlZZDAM1p7Gn6KhPw",
+}
+
+
+@pytest.fixture
+def dao(tmp_path):
+    db_controller = DatabaseController(DB_PATH=str(tmp_path / "dao.db"))
+    alice = UserState("alice")
+    db_controller.create_user(alice)
+    return OwnerDAO(db_controller, alice)
+
+
+def count_statements(dao, operation):
+    statements = []
+    dao.connection.set_trace_callback(statements.append)
+    try:
+        operation()
+    finally:
+        dao.connection.set_trace_callback(None)
+    # transaction control is not a round trip to the tables
+    return len(
+        [s for s in statements if not s.startswith(("BEGIN", "COMMIT"))]
+    )
+
+
+def test_owner_must_exist(dao):
+    with pytest.raises(DatabaseControllerException):
+        OwnerDAO(dao.db_controller, UserState("nobody"))
+
+
+def test_contacts(dao):
+    assert dao.add_contact("bob", B64_ID, B64_SHARED, **GUEST_KEYS)
+    # existing contact is not changed
+    assert not dao.add_contact("bob", "other", B64_SHARED, **GUEST_KEYS)
+    assert dao.get_contact_info("bob")["public_id_key"] == B64_ID
+    assert dao.get_contact_info("bob") == dao.db_controller.get_contact_info(
+        dao.user_state, "bob"
+    )
+    assert dao.get_contact_info("carol") is None
+
+    with pytest.raises(DatabaseControllerException):
+        dao.add_contact("alice", B64_ID, B64_SHARED, **GUEST_KEYS)
+    with pytest.raises(ContactParametersError):
+        dao.add_contact("carol", B64_ID, B64_SHARED, my_otk_key="key")
+
+    assert dao.contact_exists("bob") and dao.get_contacts() == ["bob"]
+    dao.delete_contact("bob")
+    assert not dao.contact_exists("bob")
+    with pytest.raises(DatabaseControllerException):
+        dao.delete_contact("bob")
+
+    assert len(dao.get_otk()) == len(
+        dao.db_controller.get_user_otk(dao.user_state)
+    )
+    assert all(dao.get_keys())
+
+
+def test_fewer_statements(dao):
+    db_controller, alice = dao.db_controller, dao.user_state
+    old = count_statements(
+        dao,
+        lambda: db_controller.add_contact(
+            alice, "bob", B64_ID, B64_SHARED, **GUEST_KEYS
+        ),
+    )
+    new = count_statements(
+        dao, lambda: dao.add_contact("carol", B64_ID, B64_SHARED, **GUEST_KEYS)
+    )
+    assert new * 2 <= old
+
+    for old_operation, new_operation in (
+        (
+            lambda: db_controller.contact_exists(alice, "bob"),
+            lambda: dao.contact_exists("bob"),
+        ),
+        (
+            lambda: db_controller.get_user_contacts(alice),
+            dao.get_contacts,
+        ),
+        (lambda: db_controller.get_user_keys(alice), dao.get_keys),
+    ):
+        assert count_statements(dao, new_operation) == 1
+        assert count_statements(dao, old_operation) == 2
@@ -6,6 +6,7 @@ from app.chat.crypto.crypto_utils import (
 )
 from app.user.user_state import UserState
 from app.app_controller import AppController
+from app.database.owner_dao import OwnerDAO
 import pytest
 
 TEST_DB_PATH = "test_user.db"
@@ -62,7 +63,7 @@ def init_mocker(mocker):
         assert (
             None not in kwargs.values()
         ), "not initialized key passed for exchange!!"
-        assert len(args) + len(kwargs) == 7
+        assert len(args) + len(kwargs) == 6
 
     mocker.patch(
         "app.api.api_controller.ApiController.check_contact",
@@ -90,7 +91,7 @@ def init_mocker(mocker):
     )
 
     mocker.patch(
-        "app.database.db_controller.DatabaseController.add_contact",
+        "app.database.owner_dao.OwnerDAO.add_contact",
         side_effect=mocked_db_add_contact,
     )
 
@@ -112,6 +113,9 @@ def app_cont_prep(mocker):
 
     app_controller = AppController(db_path=TEST_DB_PATH)
     app_controller.user_state = state
+    if not app_controller.db_controller.user_exists(state):
+        app_controller.db_controller.create_user(UserState("alice"))
+    app_controller.owner_dao = OwnerDAO(app_controller.db_controller, state)
     app_controller.api_controller = ApiController(
         state,
         app_controller.db_controller,
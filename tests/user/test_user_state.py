@@ -0,0 +1,47 @@
+from app.user.user_state import UserState, UserStateException
+from app.chat.crypto.crypto_utils import (
+    create_b64_from_public_key,
+    generate_DH,
+)
+import binascii
+import pytest
+
+
+def test_derived_credentials_are_cached():
+    state = UserState("alice")
+    with pytest.raises(UserStateException):
+        state.signature
+
+    state.id_key = generate_DH()
+    state.signed_pre_key = generate_DH()
+
+    signature = state.signature
+    assert signature == binascii.b2a_base64(
+        state.id_key.exchange(state.signed_pre_key.public_key())
+    )
+    assert state.public_id_key_b64 == create_b64_from_public_key(
+        state.id_key.public_key()
+    )
+
+    # the same objects are returned, nothing is computed again
+    assert state.signature is signature
+    assert state.public_id_key_b64 is state.public_id_key_b64
+
+
+def test_derived_credentials_invalidated():
+    state = UserState("alice")
+    state.id_key = generate_DH()
+    state.signed_pre_key = generate_DH()
+
+    old_signature = state.signature
+    old_spk = state.public_signed_pre_key_b64
+
+    state.signed_pre_key = generate_DH()
+    assert state.signature != old_signature
+    assert state.public_signed_pre_key_b64 != old_spk
+
+    old_signature = state.signature
+    old_id = state.public_id_key_b64
+    state.id_key = generate_DH()
+    assert state.signature != old_signature
+    assert state.public_id_key_b64 != old_id